@@ -0,0 +1,79 @@
+import json
+import os
+
+
+API_URL = os.getenv("LEXIA_API_URL") # Si se define, main.py envía los turnos a la API (api_server.py) en vez de llamar al LLM
+API_CONNECT_TIMEOUT_SECONDS = 10.0
+API_READ_TIMEOUT_SECONDS = 120.0 # Lectura larga: el SSE queda abierto mientras el LLM genera
+
+_client = None
+
+def _get_client():
+    # Un solo cliente httpx por proceso: reutiliza conexiones keep-alive con la API.
+    # httpx se importa aquí: sin LEXIA_API_URL, main.py no lo necesita
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.Client(timeout=httpx.Timeout(API_CONNECT_TIMEOUT_SECONDS, read=API_READ_TIMEOUT_SECONDS))
+    return _client
+
+class ChatTurnStream:
+    """Turno de chat contra la API en streaming (SSE), iterable con st.write_stream.
+
+    Al terminar la iteración, `saved` y `save_error` indican si la API guardó el turno, y
+    `rate_limited` si la API lo rechazó por los límites por minuto (429).
+    """
+
+    def __init__(self, base_url, access_token, conversation_id, content, provider, api_key,
+                 title=None, fallback=None, hedge=False, auto_title=False, use_cache=True):
+        self.url = f"{base_url.rstrip('/')}/conversations/{conversation_id}/messages"
+        self.headers = {"Authorization": f"Bearer {access_token}", "X-LLM-API-Key": api_key}
+        self.payload = {"content": content, "provider": provider, "title": title, "auto_title": auto_title, "hedge": hedge,
+                        "use_cache": use_cache}
+        if fallback:
+            self.payload["fallback_provider"] = fallback[0]
+            self.headers["X-LLM-Fallback-API-Key"] = fallback[1]
+        self.saved = False
+        self.save_error = None
+        self.rate_limited = False
+
+    def __iter__(self):
+        import httpx
+        try:
+            with _get_client().stream("POST", self.url, json=self.payload, headers=self.headers) as response:
+                if response.status_code != 200:
+                    response.read()
+                    self.rate_limited = response.status_code == 429
+                    self.save_error = _error_message(response)
+                    yield f"Error con la API de LexIA: {self.save_error}"
+                    return
+                for event, data in _iter_sse(response.iter_lines()):
+                    if event == "token":
+                        yield data["text"]
+                    elif event == "done":
+                        self.saved, self.save_error = data["saved"], data["save_error"]
+                    elif event == "error":
+                        self.save_error = data["error"]
+                        yield f"\n\nError con la API de LexIA: {data['error']}"
+        except httpx.HTTPError as e:
+            self.save_error = str(e)
+            yield f"Error con la API de LexIA: {str(e)}"
+
+def _iter_sse(lines):
+    """Pares (evento, datos JSON) de un stream text/event-stream."""
+    event, data = "message", []
+    for line in lines:
+        if not line: # Línea en blanco: fin del evento
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+def _error_message(response):
+    try:
+        return response.json().get("error") or f"HTTP {response.status_code}"
+    except ValueError:
+        return f"HTTP {response.status_code}"
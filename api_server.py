@@ -0,0 +1,267 @@
+"""API HTTP sin estado del flujo de chat (ASGI), para servir LexIA con varios procesos worker.
+
+Uso (desde la raíz del repositorio):
+    python -m api_server --host 0.0.0.0 --port 8000 --workers 4
+    # equivalente: uvicorn api_server:app --workers 4
+
+Cada petición se autentica con el access token de Supabase del usuario
+(`Authorization: Bearer <token>`) y usa un cliente con ese token, de modo que RLS aplica a
+cada petición por separado y ningún estado de sesión vive en el proceso: cualquier worker puede
+atender cualquier petición. Por eso la caché de conversaciones en memoria (chat_cache.py) está
+desactivada por defecto en este modo.
+
+Endpoints:
+    GET  /health
+    GET  /conversations?limit=&search=&before_updated_at=&before_id=
+    POST /conversations                      {"title"}
+    GET  /conversations/{id}/messages?limit=&before_created_at=&before_id=
+    POST /conversations/{id}/messages        {"content", "provider", "title", "auto_title", "fallback_provider", "hedge",
+                                              "use_cache"}
+         Cabeceras: X-LLM-API-Key (y X-LLM-Fallback-API-Key si hay proveedor de respaldo).
+         Respuesta en SSE: `queued` ({"position"}) mientras espera plaza en el proveedor, `token`
+         ({"text"}) y un `done` final ({"saved", "save_error"}). 429 (con Retry-After) si el
+         usuario o la API Key superan sus límites por minuto. Con "auto_title": true (primer
+         mensaje de una conversación sin título), el título se genera en segundo plano después
+         de guardar el turno. Con "use_cache": false no se lee ni se escribe la caché de
+         respuestas (LEXIA_RESPONSE_CACHE), igual que al desmarcarla en la app de Streamlit.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+from urllib.parse import parse_qs
+
+# Sin caché de conversaciones/mensajes en el proceso: un worker no ve lo que escriben los demás
+os.environ.setdefault("LEXIA_CHAT_CACHE_MB", "0")
+
+from chat_utils import (
+    CONVERSATIONS_PAGE_SIZE, MESSAGES_PAGE_SIZE, acquire_rate_limit, acreate_conversation, aget_conversation,
+    aget_messages_page, arun_turn, build_llm_context, get_user_conversations_page, request_auto_title
+)
+from rate_limits import is_rate_limited_response
+from supabase_client import create_user_client, use_client, verify_access_token
+from telemetry import start_turn
+
+
+logging.getLogger("streamlit").setLevel(logging.ERROR) # st.cache_resource fuera de `streamlit run`
+
+MAX_BODY_BYTES = 1024 * 1024
+PROVIDERS = ("openai", "gemini")
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = list(headers)
+
+# --- Utilidades ASGI ---
+
+def _headers(scope):
+    return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+def _query(scope):
+    return {key: values[-1] for key, values in parse_qs(scope["query_string"].decode("latin-1")).items()}
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPError(413, "Cuerpo de la petición demasiado grande.")
+        if not message.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "El cuerpo debe ser JSON.")
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json; charset=utf-8"),
+        (b"content-length", str(len(body)).encode()),
+        *headers
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+def _cursor(query, *fields):
+    """Cursor de paginación a partir de los parámetros before_<campo>; None si falta alguno."""
+    values = {field: query.get(f"before_{field}") for field in fields}
+    return values if all(values.values()) else None
+
+def _limit(query, default):
+    try:
+        return max(1, min(int(query.get("limit", default)), 200))
+    except ValueError:
+        raise HTTPError(400, "limit debe ser un entero.")
+
+# --- Handlers ---
+
+async def health(scope, receive, send, user, **_):
+    await _send_json(send, 200, {"status": "ok"})
+
+async def list_conversations(scope, receive, send, user, **_):
+    query = _query(scope)
+    conversations, cursor = await asyncio.to_thread(
+        get_user_conversations_page, user.id, _limit(query, CONVERSATIONS_PAGE_SIZE),
+        _cursor(query, "updated_at", "id"), query.get("search") or None
+    )
+    await _send_json(send, 200, {"conversations": conversations, "cursor": cursor})
+
+async def create_conversation_handler(scope, receive, send, user, **_):
+    body = await _read_json(receive)
+    conversation = await acreate_conversation(user.id, body.get("title") or "Nueva Conversación")
+    if conversation is None:
+        raise HTTPError(502, "No se pudo crear la conversación.")
+    await _send_json(send, 201, conversation)
+
+async def list_messages(scope, receive, send, user, conversation_id):
+    query = _query(scope)
+    messages, cursor = await aget_messages_page(
+        conversation_id, _limit(query, MESSAGES_PAGE_SIZE), _cursor(query, "created_at", "id"), user.id
+    )
+    await _send_json(send, 200, {"messages": messages, "cursor": cursor})
+
+async def post_message(scope, receive, send, user, conversation_id):
+    """Un turno completo (chat_utils.arun_turn): historial → LLM en streaming (SSE), con el mensaje
+    del usuario guardándose mientras tanto → guardado de la respuesta.
+
+    Sin cola de escritura diferida: el turno se guarda antes del evento `done`, así que un worker
+    que muera después no pierde nada ya confirmado al cliente.
+    """
+    body = await _read_json(receive)
+    headers = _headers(scope)
+    content = (body.get("content") or "").strip()
+    provider = body.get("provider") or "openai"
+    api_key = headers.get("x-llm-api-key")
+    if not content:
+        raise HTTPError(400, "Falta el contenido del mensaje.")
+    if provider not in PROVIDERS:
+        raise HTTPError(400, f"Proveedor no soportado: {provider}")
+    if not api_key:
+        raise HTTPError(400, "Falta la cabecera X-LLM-API-Key.")
+    use_cache = body.get("use_cache", True)
+    if not isinstance(use_cache, bool):
+        raise HTTPError(400, "use_cache debe ser true o false.")
+    fallback = None
+    if body.get("fallback_provider") in PROVIDERS and headers.get("x-llm-fallback-api-key"):
+        fallback = (body["fallback_provider"], headers["x-llm-fallback-api-key"])
+
+    # Antes del límite y de la plaza del LLM: una conversación ajena o borrada daría un historial vacío
+    # (RLS), una respuesta cobrada en la API Key del usuario y un guardado fallido
+    conversation, (history, _) = await asyncio.gather(
+        aget_conversation(conversation_id, user.id), aget_messages_page(conversation_id, user_id=user.id)
+    )
+    if conversation is None:
+        raise HTTPError(404, "Conversación no encontrada.")
+    history.append({"role": "user", "content": content})
+    # Recuperación y recuento de tokens una sola vez: lo reutilizan el límite, la caché y el proveedor
+    llm_context = await asyncio.to_thread(build_llm_context, history, provider)
+    admitted, retry_in, limited_scope = await asyncio.to_thread(
+        acquire_rate_limit, user.id, api_key, history, provider, llm_context
+    )
+    if not admitted:
+        raise HTTPError(429, f"Límite de consultas por minuto alcanzado ({limited_scope}).",
+                        [(b"retry-after", str(math.ceil(retry_in)).encode())])
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no") # Sin buffering en proxies nginx
+    ]})
+
+    async def send_queue_position(position):
+        await send({"type": "http.response.body", "body": _sse("queued", {"position": position}), "more_body": True})
+
+    async def send_chunk(chunk):
+        await send({"type": "http.response.body", "body": _sse("token", {"text": chunk}), "more_body": True})
+
+    with start_turn(provider=provider):
+        response_content, save_error = await arun_turn(
+            user.id, conversation_id, history, api_key, provider, fallback, bool(body.get("hedge")), body.get("title"),
+            on_chunk=send_chunk, on_queue_position=send_queue_position, use_cache=use_cache, llm_context=llm_context
+        )
+        saved = save_error is None and not is_rate_limited_response(response_content) # El aviso de 429 no se guarda
+        if saved and body.get("auto_title") and not body.get("title"):
+            request_auto_title(user.id, conversation_id, content, response_content, provider, api_key, "Nueva Conversación")
+    await send({"type": "http.response.body", "body": _sse("done", {"saved": saved, "save_error": save_error})})
+
+ROUTES = [
+    ("GET", re.compile(r"^/health$"), health, False),
+    ("GET", re.compile(r"^/conversations$"), list_conversations, True),
+    ("POST", re.compile(r"^/conversations$"), create_conversation_handler, True),
+    ("GET", re.compile(r"^/conversations/(?P<conversation_id>[0-9a-fA-F-]{36})/messages$"), list_messages, True),
+    ("POST", re.compile(r"^/conversations/(?P<conversation_id>[0-9a-fA-F-]{36})/messages$"), post_message, True),
+]
+
+async def _authenticate(scope):
+    authorization = _headers(scope).get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        raise HTTPError(401, "Falta la cabecera Authorization: Bearer <token>.")
+    access_token = authorization[7:].strip()
+    user, error = await asyncio.to_thread(verify_access_token, access_token)
+    if user is None:
+        raise HTTPError(401, error or "Token de acceso no válido.")
+    return user, access_token
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    response_started = False
+
+    async def tracking_send(message):
+        nonlocal response_started
+        response_started = response_started or message["type"] == "http.response.start"
+        await send(message)
+
+    try:
+        path_matches = [(method, match, handler, auth) for method, pattern, handler, auth in ROUTES
+                        if (match := pattern.match(scope["path"]))]
+        route = next(((match, handler, auth) for method, match, handler, auth in path_matches if method == scope["method"]), None)
+        if route is None:
+            raise HTTPError(405 if path_matches else 404, "Método no permitido." if path_matches else "No encontrado.")
+        match, handler, needs_auth = route
+        if not needs_auth:
+            await handler(scope, receive, tracking_send, None, **match.groupdict())
+            return
+        user, access_token = await _authenticate(scope)
+        with use_client(create_user_client(access_token)): # Cliente con el JWT del usuario solo para esta petición
+            await handler(scope, receive, tracking_send, user, **match.groupdict())
+    except HTTPError as e:
+        if not response_started:
+            await _send_json(send, e.status, {"error": e.message}, e.headers)
+    except Exception as e:
+        print(f"Error atendiendo {scope['method']} {scope['path']}: {str(e)}")
+        if response_started: # En mitad de un SSE: avisamos al cliente y cerramos el stream
+            await send({"type": "http.response.body", "body": _sse("error", {"error": str(e)})})
+        else:
+            await _send_json(send, 500, {"error": "Error interno del servidor."})
+
+def _main():
+    import uvicorn # Solo necesario para servir la API, no para la app de Streamlit
+
+    parser = argparse.ArgumentParser(description="API HTTP de LexIA")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Procesos worker (sin estado compartido entre ellos)")
+    args = parser.parse_args()
+    uvicorn.run("api_server:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,85 @@
+import asyncio
+import contextvars
+import threading
+
+import streamlit as st
+
+
+async def _in_context(coro, context):
+    """Ejecuta `coro` con las contextvars de quien la lanzó (cliente de Supabase, turno de telemetría).
+
+    run_coroutine_threadsafe crea la tarea con el contexto del hilo del loop, no con el del llamante.
+    """
+    for var, value in context.items():
+        var.set(value) # Solo afecta a la copia del contexto de esta tarea
+    return await coro
+
+class EventLoopThread:
+    """Event loop de asyncio en un hilo propio, compartido por todo el proceso.
+
+    Los clientes asíncronos (AsyncOpenAI, gRPC aio de Gemini) quedan ligados al loop en el que
+    abren conexiones; ejecutando siempre en este loop su pool de conexiones se reutiliza entre
+    mensajes, cosa que no ocurriría con un asyncio.run() nuevo por llamada.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="lexia-event-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro, timeout=None):
+        """Ejecuta una corrutina en el loop y espera su resultado desde código síncrono."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("run() no puede llamarse desde el propio hilo del event loop.")
+        return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), self.loop).result(timeout)
+
+    def iterate(self, async_gen):
+        """Recorre un generador asíncrono desde código síncrono, elemento a elemento."""
+        try:
+            while True:
+                try:
+                    yield self.run(async_gen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            # Si el consumidor abandona el generador (p. ej. rerun de Streamlit), se cierra en el loop
+            self.run(async_gen.aclose())
+
+    async def aiterate(self, async_gen):
+        """Recorre desde otro event loop (p. ej. el de uvicorn) un generador asíncrono que se ejecuta en este.
+
+        Los clientes LLM del registro están ligados a este loop, así que el generador no puede
+        ejecutarse directamente en el loop del servidor HTTP.
+        """
+        try:
+            while True:
+                future = asyncio.run_coroutine_threadsafe(
+                    _in_context(async_gen.__anext__(), contextvars.copy_context()), self.loop
+                )
+                try:
+                    yield await asyncio.wrap_future(future)
+                except StopAsyncIteration:
+                    return
+        finally:
+            try:
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(async_gen.aclose(), self.loop))
+            except RuntimeError: # El consumidor se canceló con un __anext__ aún en curso
+                pass
+
+@st.cache_resource
+def get_event_loop_thread():
+    return EventLoopThread()
+
+def run_sync(coro, timeout=None):
+    return get_event_loop_thread().run(coro, timeout)
+
+def iterate_sync(async_gen):
+    yield from get_event_loop_thread().iterate(async_gen)
+
+async def iterate_in_loop(async_gen):
+    async for item in get_event_loop_thread().aiterate(async_gen):
+        yield item
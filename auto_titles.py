@@ -0,0 +1,232 @@
+import asyncio
+import atexit
+import contextvars
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import streamlit as st
+
+from async_runtime import run_sync
+
+
+MAX_TITLE_LENGTH = 50
+DEFAULT_BATCH_SIZE = 50 # Títulos como máximo por vaciado del worker
+DEFAULT_LINGER_SECONDS = 0.2 # Espera breve para agrupar peticiones (y renombrados) que llegan juntas
+DEFAULT_GENERATE_TIMEOUT = 15.0 # Pasado este tiempo se usa el inicio de la consulta como título
+DEFAULT_WRITE_RETRIES = 3
+DEFAULT_SHUTDOWN_TIMEOUT = 5.0
+MAX_REMEMBERED_TITLES = 1000 # Títulos ya guardados que las sesiones aún pueden recoger con result()
+
+def fallback_title(prompt):
+    """El título de siempre: el inicio de la consulta."""
+    prompt = " ".join((prompt or "").split())
+    return prompt[:MAX_TITLE_LENGTH] + ("..." if len(prompt) > MAX_TITLE_LENGTH else "")
+
+def clean_title(text):
+    """Primera línea de la respuesta del modelo sin comillas, markdown ni punto final. None si queda vacía."""
+    lines = [line.strip() for line in (text or "").splitlines() if line.strip()]
+    if not lines:
+        return None
+    title = re.sub(r"^t[íi]tulo\s*:\s*", "", lines[0], flags=re.IGNORECASE)
+    title = " ".join(title.strip(" \"'«»“”*#`.").split())
+    if not title:
+        return None
+    if len(title) > MAX_TITLE_LENGTH:
+        title = title[:MAX_TITLE_LENGTH].rsplit(" ", 1)[0] + "..."
+    return title
+
+class AutoTitler:
+    """Títulos de conversación generados en segundo plano tras la primera respuesta.
+
+    request() encola la petición y vuelve enseguida, así que ni la llamada al LLM ni el
+    renombrado están en el camino del turno. El worker espera `linger_seconds` para agrupar las
+    peticiones que llegan juntas, genera sus títulos en paralelo con `generate(job)` (corrutina,
+    en el event loop compartido) y los guarda con una sola llamada a `writer(user_id, renames)`
+    por usuario. El writer se ejecuta en el contexto (contextvars) capturado al encolar, es
+    decir, con el cliente de Supabase de ese usuario, y devuelve los ids renombrados.
+
+    Si la generación falla, tarda demasiado o devuelve algo vacío se usa el inicio de la
+    consulta. Cada renombrado lleva `expected_title`: solo se aplica si la conversación aún
+    tiene ese título, de modo que nunca pisa un título que haya cambiado entretanto.
+    """
+
+    def __init__(self, generate, writer, batch_size=DEFAULT_BATCH_SIZE, linger_seconds=DEFAULT_LINGER_SECONDS,
+                 generate_timeout=DEFAULT_GENERATE_TIMEOUT, write_retries=DEFAULT_WRITE_RETRIES, sleep=time.sleep):
+        self._generate = generate
+        self._writer = writer
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.generate_timeout = generate_timeout
+        self.write_retries = write_retries
+        self._sleep = sleep
+        self._pending = deque()
+        self._in_flight = []
+        self._results = OrderedDict() # conversation_id -> título guardado
+        self._cond = threading.Condition()
+        self._closing = False
+        self._thread = None
+        self.generated_titles = 0
+        self.fallback_titles = 0
+        self.renamed_conversations = 0
+        self.write_calls = 0
+        self.failed_writes = 0
+
+    # --- Productor ---
+
+    def request(self, user_id, conversation_id, prompt, answer, provider, api_key, expected_title=None):
+        job = {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "prompt": prompt,
+            "answer": answer,
+            "provider": provider,
+            "api_key": api_key,
+            "expected_title": expected_title,
+            "context": contextvars.copy_context()
+        }
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("La cola de títulos está cerrada.")
+            self._pending.append(job)
+            self._cond.notify_all()
+
+    # --- Consumidores (sesiones) ---
+
+    def is_pending(self, conversation_id):
+        with self._cond:
+            return any(job["conversation_id"] == conversation_id for job in list(self._pending) + self._in_flight)
+
+    def result(self, conversation_id):
+        """Título ya guardado para la conversación, o None si aún no hay (o no se pudo guardar)."""
+        with self._cond:
+            return self._results.get(conversation_id)
+
+    def stats(self):
+        with self._cond:
+            depth = len(self._pending) + len(self._in_flight)
+        return {
+            "depth": depth,
+            "generated_titles": self.generated_titles,
+            "fallback_titles": self.fallback_titles,
+            "renamed_conversations": self.renamed_conversations,
+            "write_calls": self.write_calls,
+            "failed_writes": self.failed_writes
+        }
+
+    # --- Worker ---
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lexia-auto-titles", daemon=True)
+                self._thread.start()
+        return self
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending and not self._closing:
+                self._cond.wait()
+            if not self._pending:
+                return None
+        if self.linger_seconds and not self._closing:
+            self._sleep(self.linger_seconds)
+        with self._cond:
+            count = min(self.batch_size, len(self._pending))
+            self._in_flight = [self._pending.popleft() for _ in range(count)]
+            return list(self._in_flight)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            titles = self._generate_titles(batch)
+            for user_id, jobs in self._group_by_user(batch).items():
+                self._write(user_id, [(job, titles[idx]) for idx, job in jobs])
+            with self._cond:
+                self._in_flight = []
+                self._cond.notify_all()
+
+    async def _generate_one(self, job):
+        try:
+            return clean_title(await asyncio.wait_for(self._generate(job), self.generate_timeout))
+        except Exception as e:
+            print(f"Error generando el título de conv {job['conversation_id']}: {str(e)}")
+            return None
+
+    def _generate_titles(self, batch):
+        async def generate_all():
+            return await asyncio.gather(*(self._generate_one(job) for job in batch))
+        try:
+            generated = run_sync(generate_all())
+        except Exception as e:
+            print(f"Error generando títulos: {str(e)}")
+            generated = [None] * len(batch)
+        titles = []
+        for job, title in zip(batch, generated):
+            if title:
+                self.generated_titles += 1
+            else:
+                self.fallback_titles += 1
+            titles.append(title or fallback_title(job["prompt"]))
+        return titles
+
+    @staticmethod
+    def _group_by_user(batch):
+        groups = {}
+        for idx, job in enumerate(batch):
+            groups.setdefault(job["user_id"], []).append((idx, job))
+        return groups
+
+    def _write(self, user_id, jobs_and_titles):
+        # Si una conversación aparece dos veces en el lote, vale la última petición
+        renames = {job["conversation_id"]: {
+            "id": job["conversation_id"], "title": title, "expected_title": job["expected_title"]
+        } for job, title in jobs_and_titles}
+        context = jobs_and_titles[-1][0]["context"]
+        for attempt in range(1, self.write_retries + 1):
+            try:
+                self.write_calls += 1
+                renamed = context.run(self._writer, user_id, list(renames.values())) or set()
+                break
+            except Exception as e:
+                self.failed_writes += 1
+                print(f"Error guardando títulos del usuario {user_id} (intento {attempt}): {str(e)}")
+                if attempt == self.write_retries or self._closing:
+                    return
+                self._sleep(min(5.0, 0.5 * (2 ** (attempt - 1))))
+        with self._cond:
+            for conversation_id in renamed:
+                self._results[conversation_id] = renames[conversation_id]["title"]
+                self._results.move_to_end(conversation_id)
+            while len(self._results) > MAX_REMEMBERED_TITLES:
+                self._results.popitem(last=False)
+            self.renamed_conversations += len(renamed)
+
+    # --- Cierre ---
+
+    def flush(self, timeout=None):
+        """Espera a que no quede nada pendiente. Devuelve False si vence el timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        return self.flush(timeout)
+
+@st.cache_resource
+def get_auto_titler(_generate, _writer):
+    """Cola de títulos compartida por todas las sesiones del proceso."""
+    titler = AutoTitler(_generate, _writer).start()
+    atexit.register(titler.close)
+    return titler
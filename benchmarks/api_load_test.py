@@ -0,0 +1,156 @@
+"""Escalado horizontal de la API (api_server.py) con varios procesos worker y backends falsos.
+
+Uso (desde la raíz del repositorio; requiere uvicorn y httpx):
+    python -m benchmarks.api_load_test --workers 1,2,4 --clients 32 --requests 400
+
+Para cada número de workers arranca N procesos uvicorn que comparten un socket de escucha (como
+`uvicorn --workers N`). Cada worker tiene su propio Supabase falso, sembrado con los mismos
+usuarios y conversaciones (ids deterministas), de modo que cualquier worker atiende a cualquier
+usuario. Después lanza `--clients` clientes concurrentes que envían turnos por
+POST /conversations/{id}/messages y leen el SSE completo.
+
+El LLM falso genera sin pausa entre tokens (--tokens-per-second 0), así que el coste dominante es
+la CPU del worker (contexto, puente asyncio, SSE): el throughput debe crecer con los workers hasta
+agotar los núcleos de la máquina. Con un solo núcleo no hay escalado que medir.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+
+os.environ.setdefault("LEXIA_TELEMETRY_JSON_LOGS", "0")
+os.environ.setdefault("LEXIA_CHAT_CACHE_MB", "0") # Como en api_server: sin caché entre peticiones
+for limit in ("LEXIA_RATE_USER_RPM", "LEXIA_RATE_USER_TPM", "LEXIA_RATE_KEY_RPM", "LEXIA_RATE_KEY_TPM"):
+    os.environ.setdefault(limit, "0") # Se mide el throughput, no los límites por minuto (todos comparten la API Key falsa)
+
+import httpx
+
+from benchmarks.load_test import StageTimings, install_fakes
+
+
+SEED_NAMESPACE = uuid.UUID("6f1c1d3e-52a4-4b8e-9a0c-4f3b7e2d9a10")
+
+def seeded_user_id(user_idx):
+    return str(uuid.uuid5(SEED_NAMESPACE, f"user-{user_idx}"))
+
+def seeded_conversation_id(user_idx, conv_idx):
+    return str(uuid.uuid5(SEED_NAMESPACE, f"conversation-{user_idx}-{conv_idx}"))
+
+def seed(fake_db, users, conversations):
+    for user_idx in range(users):
+        user_id = seeded_user_id(user_idx)
+        fake_db.auth.sign_up({"email": f"user{user_idx}@example.com", "password": "benchmark"}, user_id=user_id)
+        for conv_idx in range(conversations):
+            fake_db.table("conversations").insert({
+                "id": seeded_conversation_id(user_idx, conv_idx), "user_id": user_id, "title": f"Consulta {conv_idx}"
+            }).execute()
+
+def serve_worker(sock, args):
+    import uvicorn
+    import api_server
+
+    fake_db, _ = install_fakes(args.db_latency, args.ttft, args.tokens_per_second, args.output_tokens, 0.0)
+    seed(fake_db, args.users, args.conversations)
+    api_server.create_user_client = lambda access_token: fake_db # El fake no aplica RLS
+    uvicorn.Server(uvicorn.Config(api_server.app, log_level="warning", lifespan="off")).run(sockets=[sock])
+
+async def wait_until_ready(base_url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{base_url}/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("La API no arrancó a tiempo.")
+
+async def run_clients(base_url, args, timings):
+    next_request = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0), limits=limits) as client:
+        async def client_loop():
+            for request_idx in next_request: # El iterador compartido reparte las peticiones
+                user_idx = request_idx % args.users
+                url = f"{base_url}/conversations/{seeded_conversation_id(user_idx, request_idx % args.conversations)}/messages"
+                headers = {"Authorization": f"Bearer token-{seeded_user_id(user_idx)}", "X-LLM-API-Key": "sk-fake"}
+                payload = {"content": f"Consulta {request_idx}: ¿qué plazo de prescripción aplica?", "provider": "openai"}
+                started = time.perf_counter()
+                first_token, saved = None, False
+                try:
+                    async with client.stream("POST", url, json=payload, headers=headers) as response:
+                        event = None
+                        async for line in response.aiter_lines():
+                            if line.startswith("event:"):
+                                event = line[6:].strip()
+                            elif line.startswith("data:") and event == "token" and first_token is None:
+                                first_token = time.perf_counter()
+                            elif line.startswith("data:") and event == "done":
+                                saved = json.loads(line[5:])["saved"]
+                except httpx.HTTPError:
+                    pass
+                if first_token is None or not saved:
+                    timings.errors += 1
+                    continue
+                timings.record("ttft", first_token - started)
+                timings.record("turn", time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(args.clients)))
+        return time.perf_counter() - started
+
+def run_with_workers(workers, args):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(2048)
+    base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    context = multiprocessing.get_context("fork") # Los hijos heredan el socket ya abierto
+    processes = [context.Process(target=serve_worker, args=(sock, args), daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(wait_until_ready(base_url))
+        timings = StageTimings()
+        wall = asyncio.run(run_clients(base_url, args, timings))
+        return timings, wall
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        sock.close()
+
+def run(args):
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    print(f"clientes={args.clients} peticiones={args.requests} tokens/respuesta={args.output_tokens} "
+          f"TTFT LLM={args.ttft * 1000:.0f} ms latencia BD={args.db_latency * 1000:.0f} ms núcleos={os.cpu_count()}")
+    baseline = None
+    for workers in worker_counts:
+        timings, wall = run_with_workers(workers, args)
+        completed = len(timings._samples["turn"])
+        throughput = completed / wall
+        baseline = baseline or throughput
+        print(f"\n=== {workers} worker(s): {throughput:.1f} turnos/s (x{throughput / baseline:.2f} frente a {worker_counts[0]})")
+        timings.report(wall, completed)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="Números de workers a comparar, separados por comas")
+    parser.add_argument("--clients", type=int, default=32, help="Clientes HTTP concurrentes")
+    parser.add_argument("--requests", type=int, default=400, help="Turnos totales por ronda")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--conversations", type=int, default=3, help="Conversaciones por usuario")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="Segundos por round trip a Supabase")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Time-to-first-token del LLM falso (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="0: sin pausa entre tokens")
+    parser.add_argument("--output-tokens", type=int, default=300)
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
@@ -0,0 +1,55 @@
+"""Coste de ensamblar el contexto del LLM según crece la conversación.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_context
+
+Simula turnos sucesivos: en cada uno se añade un mensaje y se reconstruye el contexto, igual que
+en main.py. Con los recuentos de tokens cacheados, el coste por turno debe mantenerse plano
+aunque el historial pase de decenas a miles de mensajes.
+"""
+import argparse
+import random
+import time
+
+from context_builder import DEFAULT_CONTEXT_TOKEN_BUDGET, TokenCounter, build_context
+
+
+SAMPLE_SENTENCES = [
+    "El plazo de prescripción de las acciones personales es de cinco años según el artículo 1964 CC.",
+    "La responsabilidad extracontractual del artículo 1902 CC exige acción u omisión, daño y nexo causal.",
+    "En arrendamientos urbanos, la LAU regula la duración mínima del contrato de vivienda.",
+    "El Reglamento General de Protección de Datos se aplica a todo tratamiento de datos personales.",
+]
+
+def synthetic_message(rng, idx):
+    sentences = rng.randint(1, 40) # Mezcla de preguntas cortas y normas pegadas enteras
+    content = " ".join(rng.choice(SAMPLE_SENTENCES) for _ in range(sentences)) + f" ({idx})"
+    return {"role": "user" if idx % 2 == 0 else "assistant", "content": content}
+
+def run(sizes, turns, provider, budget, summarize):
+    rng = random.Random(42)
+    print(f"proveedor={provider} presupuesto={budget} resumen={summarize}")
+    print(f"{'mensajes':>10} {'primer turno (ms)':>18} {'turno medio (ms)':>17} {'en contexto':>12}")
+    for size in sizes:
+        counter = TokenCounter()
+        history = [synthetic_message(rng, idx) for idx in range(size)]
+        started = time.perf_counter()
+        build_context(history, provider, budget, summarize=summarize, counter=counter)
+        cold_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        for turn in range(turns):
+            history.append(synthetic_message(rng, size + turn))
+            context, _ = build_context(history, provider, budget, summarize=summarize, counter=counter)
+        warm_ms = (time.perf_counter() - started) * 1000 / turns
+        print(f"{size:>10} {cold_ms:>18.3f} {warm_ms:>17.3f} {len(context):>12}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--provider", choices=["openai", "gemini"], default="openai")
+    parser.add_argument("--budget", type=int, default=DEFAULT_CONTEXT_TOKEN_BUDGET)
+    parser.add_argument("--summarize", action="store_true")
+    args = parser.parse_args()
+    run(args.sizes, args.turns, args.provider, args.budget, args.summarize)
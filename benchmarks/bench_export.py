@@ -0,0 +1,173 @@
+"""Exportación e importación de conversaciones (conversation_export.py) sobre un historial sintético.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_export --messages 1000000 --conversations 5000
+
+Siembra un usuario con --messages mensajes repartidos entre --conversations conversaciones en
+FakeSupabase (con los índices del README), y mide:
+  * la exportación a JSONL gzip: tiempo, filas/s, round trips y tamaño del fichero;
+  * la importación en una base vacía, en lotes con un lote en vuelo;
+  * la reimportación del mismo fichero, que no debe añadir ninguna fila (ids idempotentes);
+  * la ida y vuelta: reexportar lo importado da exactamente los mismos registros.
+La reimportación y la reexportación se ejecutan con tracemalloc para medir el pico de memoria de
+Python, que debe depender del tamaño de página y de lote, no del historial. tracemalloc las hace
+bastante más lentas, así que los tiempos que cuentan son los de la primera exportación e importación.
+"""
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import conversation_export
+from benchmarks.fakes import FakeSupabase
+from supabase_client import use_client
+
+
+SENTENCES = [
+    "El plazo de prescripción de las acciones personales sin plazo especial es de cinco años.",
+    "Conforme al artículo 1902 del Código Civil, quien causa daño a otro por culpa está obligado a repararlo.",
+    "La Ley de Arrendamientos Urbanos limita la actualización de la renta a la fecha de cada año de contrato.",
+    "El trabajador debe ser informado previamente de la instalación de cámaras en el lugar de trabajo.",
+    "¿Qué ocurre si el arrendador no devuelve la fianza al terminar el contrato?",
+    "El despido sin causa se califica como improcedente y da derecho a indemnización.",
+    "La herencia se acepta pura y simplemente o a beneficio de inventario.",
+    "El Reglamento General de Protección de Datos exige una base jurídica para cada tratamiento.",
+    "Los consumidores disponen de catorce días naturales para desistir de un contrato a distancia.",
+    "La responsabilidad del transportista se rige por el Convenio CMR en el transporte internacional.",
+    "¿Puede la comunidad de propietarios prohibir el alquiler turístico en el edificio?",
+    "La custodia compartida se acuerda atendiendo al interés superior del menor.",
+]
+WORDS = " ".join(SENTENCES).split() # Palabras al azar: comprime como texto real, no como frases repetidas
+
+def seed_history(db, user_id, messages, conversations, seed):
+    """Conversaciones que se abren a lo largo del historial y mensajes intercalados entre las ya abiertas."""
+    rng = random.Random(seed)
+    base = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    conversation_rows, message_rows = db.tables["conversations"], db.tables["messages"]
+    opened = []
+    for idx in range(messages):
+        created_at = (base + timedelta(seconds=idx)).isoformat()
+        if len(opened) < conversations and (not opened or idx * conversations >= len(opened) * messages):
+            opened.append(str(uuid.UUID(int=rng.getrandbits(128))))
+            conversation_rows.append({"id": opened[-1], "user_id": user_id, "title": f"Consulta {len(opened)}",
+                                      "created_at": created_at, "updated_at": created_at})
+        conversation_id = rng.choice(opened)
+        message_rows.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "role": "user" if idx % 2 == 0 else "assistant",
+            "content": " ".join(rng.choices(WORDS, k=rng.randint(5, 30) if idx % 2 == 0 else rng.randint(20, 120))),
+            "created_at": created_at
+        })
+    last_seen = {row["conversation_id"]: row["created_at"] for row in message_rows}
+    for conv in conversation_rows:
+        conv["updated_at"] = last_seen.get(conv["id"], conv["created_at"])
+
+def create_indexes(db):
+    """Los índices del README; construirlos fuera de las medidas evita contar su memoria y su tiempo."""
+    db.create_index("conversations", "user_id", "created_at", "id")
+    db.create_index("messages", "user_id", "created_at", "id")
+
+def records_digest(path):
+    """sha256 de los registros del fichero sin la cabecera (que lleva la hora de exportación)."""
+    digest = hashlib.sha256()
+    with gzip.open(path, "rb") as lines:
+        next(lines)
+        for line in lines:
+            digest.update(line)
+    return digest.hexdigest()
+
+def measured(func, *args, trace_memory=True):
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        stats, error = func(*args)
+    finally:
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        tracemalloc.stop()
+    if error:
+        raise RuntimeError(error)
+    return stats, time.perf_counter() - started, peak
+
+def report(label, stats, seconds, peak, round_trips, extra=""):
+    rows = stats["conversations"] + stats["messages"]
+    memory = f", pico de memoria {peak / 2**20:.1f} MiB (con tracemalloc)" if peak is not None else ""
+    print(f"{label}: {rows} filas en {seconds:.1f} s ({rows / seconds:,.0f} filas/s), {round_trips} round trips{memory}{extra}")
+
+def export_to(db, user_id, path, args, trace_memory):
+    round_trips = db.round_trips
+    with use_client(db), open(path, "wb") as output:
+        stats, seconds, peak = measured(conversation_export.export_conversations, user_id, output, args.page_size,
+                                        trace_memory=trace_memory)
+    return stats, seconds, peak, db.round_trips - round_trips
+
+def import_from(db, user_id, path, args, trace_memory):
+    round_trips = db.round_trips
+    with use_client(db):
+        stats, seconds, peak = measured(conversation_export.import_conversations, user_id, path, args.batch_size,
+                                        trace_memory=trace_memory)
+    return stats, seconds, peak, db.round_trips - round_trips
+
+def run(args):
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    workdir = tempfile.mkdtemp(prefix="lexia-export-")
+    exported, reexported = os.path.join(workdir, "export.jsonl.gz"), os.path.join(workdir, "reexport.jsonl.gz")
+
+    source, user_id = FakeSupabase(latency=args.db_latency, jitter=0.0, seed=0), str(uuid.uuid4())
+    started = time.perf_counter()
+    seed_history(source, user_id, args.messages, args.conversations, args.seed)
+    create_indexes(source)
+    print(f"Historial sintético: {args.messages} mensajes en {args.conversations} conversaciones "
+          f"({time.perf_counter() - started:.1f} s); latencia por round trip {args.db_latency * 1000:.0f} ms, "
+          f"páginas de {args.page_size} y lotes de {args.batch_size} filas")
+
+    stats, seconds, peak, round_trips = export_to(source, user_id, exported, args, False)
+    size = os.path.getsize(exported)
+    report("Exportación", stats, seconds, peak, round_trips,
+           f"; {size / 2**20:.1f} MiB en disco ({size / max(stats['messages'], 1):.0f} B/mensaje)")
+    del source # La importación va a una base vacía: no hace falta tener las dos en memoria
+
+    target, target_user = FakeSupabase(latency=args.db_latency, jitter=0.0, seed=0), str(uuid.uuid4())
+    stats, seconds, peak, round_trips = import_from(target, target_user, exported, args, False)
+    report("Importación", stats, seconds, peak, round_trips, f"; {stats['batches']} lotes")
+    rows_after_import = {table: len(rows) for table, rows in target.tables.items()}
+
+    stats, seconds, peak, round_trips = import_from(target, target_user, exported, args, not args.no_trace_memory)
+    rows_after_reimport = {table: len(rows) for table, rows in target.tables.items()}
+    idempotent = rows_after_import == rows_after_reimport
+    report("Reimportación", stats, seconds, peak, round_trips,
+           f"; filas nuevas: {sum(rows_after_reimport.values()) - sum(rows_after_import.values())}  "
+           f"{'ok' if idempotent else 'FALLO'}")
+
+    create_indexes(target)
+    stats, seconds, peak, round_trips = export_to(target, target_user, reexported, args, not args.no_trace_memory)
+    same = records_digest(exported) == records_digest(reexported)
+    report("Reexportación", stats, seconds, peak, round_trips,
+           f"; registros idénticos a la exportación  {'ok' if same else 'FALLO'}")
+    for path in (exported, reexported):
+        os.remove(path)
+    os.rmdir(workdir)
+    print("\nTodo correcto." if idempotent and same else "\nHay comprobaciones fallidas.")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--conversations", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=conversation_export.EXPORT_PAGE_SIZE)
+    parser.add_argument("--batch-size", type=int, default=conversation_export.IMPORT_BATCH_SIZE)
+    parser.add_argument("--db-latency", type=float, default=0.01, help="Segundos por round trip a Supabase")
+    parser.add_argument("--no-trace-memory", action="store_true", help="Sin tracemalloc (más rápido, sin pico de memoria)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
@@ -0,0 +1,180 @@
+"""Latencia del primer turno de una conversación nueva (título automático) con backends falsos.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_first_turn --turns 20 --conversations 40
+
+Ejecuta main.py con streamlit.testing (AppTest, sin navegador) contra FakeSupabase y proveedores
+LLM falsos. En cada turno crea una conversación ("➕ Nueva Conversación"), envía su primer mensaje
+y mide:
+  * el tiempo hasta que el script termina, que es lo que el usuario espera antes de poder seguir;
+  * las ejecuciones completas del script que provoca el turno (un st.rerun() cuenta una más);
+  * el tiempo hasta que el título queda guardado en la BD, ya fuera del camino del turno.
+Después, --users usuarios piden títulos a la vez para comprobar que los renombrados se agrupan:
+una llamada a la RPC rename_conversations por usuario y lote, no una por conversación.
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+
+os.environ.setdefault("LEXIA_TELEMETRY_JSON_LOGS", "0")
+for limit in ("LEXIA_RATE_USER_RPM", "LEXIA_RATE_USER_TPM", "LEXIA_RATE_KEY_RPM", "LEXIA_RATE_KEY_TPM"):
+    os.environ.setdefault(limit, "0") # Se mide la latencia del turno, no los límites por minuto
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import chat_utils
+import supabase_client
+from benchmarks.fakes import FakeProvider
+from benchmarks.load_test import install_fakes, percentile
+
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+PLACEHOLDER_TITLE = "Nueva Conversación"
+PROMPTS = [
+    "¿Cuál es el plazo de prescripción de las acciones personales sin plazo especial en el Código Civil?",
+    "Mi casero quiere subirme la renta a mitad de contrato, ¿puede hacerlo según la LAU?",
+    "¿Qué requisitos exige el artículo 1902 del Código Civil para reclamar daños extracontractuales?",
+    "¿Puede mi empresa instalar cámaras en el puesto de trabajo sin avisar a la plantilla?",
+]
+
+class ScriptRunCounter:
+    """Cuenta las ejecuciones completas de main.py (cada una llama una vez a st.set_page_config)."""
+
+    def __init__(self):
+        self.runs = 0
+        self._original = st.set_page_config
+        st.set_page_config = self._count
+
+    def _count(self, *args, **kwargs):
+        self.runs += 1
+        return self._original(*args, **kwargs)
+
+def seed_conversations(fake_db, user_id, conversations, messages):
+    for conv_idx in range(conversations):
+        created = chat_utils.create_conversation(user_id, f"Consulta previa {conv_idx}")
+        chat_utils.save_turn(user_id, created["id"], f"Pregunta {conv_idx}", "Respuesta " * messages)
+
+def wait_for_title(fake_db, conversation_id, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for conv in fake_db.tables["conversations"]:
+            if conv["id"] == conversation_id and conv["title"] != PLACEHOLDER_TITLE:
+                return conv["title"]
+        time.sleep(0.005)
+    return None
+
+def find_button(elements, label):
+    return next(button for button in elements if button.label == label)
+
+def run_first_turns(args, fake_db, counter):
+    fake_db.auth.sign_up({"email": "bench@example.com", "password": "benchmark"})
+    user, user_session, error = supabase_client.sign_in_user("bench@example.com", "benchmark")
+    if error:
+        raise RuntimeError(error)
+    supabase_client.bind_client(user_session.client())
+    seed_conversations(fake_db, user.id, args.conversations, args.messages)
+
+    app = AppTest.from_file(MAIN_SCRIPT, default_timeout=120)
+    app.session_state["user_session"] = user
+    app.session_state["auth_session"] = user_session
+    app.session_state["api_key"] = "sk-fake"
+    app.session_state["selected_provider"] = args.provider
+    app.run()
+
+    turn_seconds, title_seconds, script_runs, titles = [], [], [], []
+    for turn in range(args.warmup + args.turns):
+        find_button(app.sidebar.button, "➕ Nueva Conversación").click().run()
+        conversation_id = app.session_state["active_conversation_id"]
+        prompt = PROMPTS[turn % len(PROMPTS)]
+        counter.runs = 0
+        started = time.perf_counter()
+        app.chat_input[0].set_value(prompt).run()
+        turn_seconds.append(time.perf_counter() - started)
+        script_runs.append(counter.runs)
+        title = wait_for_title(fake_db, conversation_id, args.title_timeout)
+        title_seconds.append(time.perf_counter() - started)
+        titles.append(title)
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+    # Los primeros turnos calientan imports, event loop y colas: no se cuentan
+    del turn_seconds[:args.warmup], title_seconds[:args.warmup], script_runs[:args.warmup], titles[:args.warmup]
+
+    p50, p95 = (percentile(turn_seconds, pct) * 1000 for pct in (50, 95))
+    print(f"Primer turno ({args.turns} conversaciones nuevas, {args.conversations} en la barra lateral, "
+          f"TTFT {args.ttft * 1000:.0f} ms, {args.output_tokens} tokens a {args.tokens_per_second:.0f} tokens/s):")
+    print(f"  hasta terminar el script: p50 {p50:.0f} ms, p95 {p95:.0f} ms")
+    print(f"  ejecuciones del script por turno: {sum(script_runs) / len(script_runs):.2f}")
+    landed = [seconds for seconds, title in zip(title_seconds, titles) if title]
+    if landed:
+        print(f"  título guardado a los: p50 {percentile(landed, 50) * 1000:.0f} ms (en segundo plano); "
+              f"{len(landed)}/{len(titles)} conversaciones renombradas")
+    print(f"  ejemplos: {sorted(set(t for t in titles if t))[:3]}")
+
+def run_batched_renames(args, fake_db):
+    users = []
+    for user_idx in range(args.users):
+        fake_db.auth.sign_up({"email": f"batch{user_idx}@example.com", "password": "benchmark"})
+        user, user_session, _ = supabase_client.sign_in_user(f"batch{user_idx}@example.com", "benchmark")
+        supabase_client.bind_client(user_session.client())
+        users.append((user, [chat_utils.create_conversation(user.id, PLACEHOLDER_TITLE)["id"]
+                             for _ in range(args.conversations_per_user)]))
+    before = chat_utils.get_auto_title_stats()
+    round_trips = fake_db.round_trips
+    barrier = threading.Barrier(args.users)
+
+    def request_titles(user, conversation_ids):
+        barrier.wait() # Todos a la vez, como varios usuarios terminando su primer turno
+        for conversation_id in conversation_ids:
+            chat_utils.request_auto_title(user.id, conversation_id, PROMPTS[0], "Respuesta", args.provider,
+                                          "sk-fake", PLACEHOLDER_TITLE)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=request_titles, args=user_and_ids) for user_and_ids in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pending = {conversation_id for _, conversation_ids in users for conversation_id in conversation_ids}
+    while pending and time.perf_counter() - started < args.title_timeout:
+        _, pending = chat_utils.get_auto_title_updates(pending)
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    after = chat_utils.get_auto_title_stats()
+    renamed = after["renamed_conversations"] - before["renamed_conversations"]
+    write_calls = after["write_calls"] - before["write_calls"]
+    print(f"\nTítulos en lote: {args.users} usuarios × {args.conversations_per_user} conversaciones a la vez")
+    print(f"  {renamed} renombradas con {write_calls} llamadas a rename_conversations "
+          f"({fake_db.round_trips - round_trips} round trips) en {elapsed * 1000:.0f} ms")
+
+def run(args):
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    fake_db, _ = install_fakes(args.db_latency, args.ttft, args.tokens_per_second, args.output_tokens, 0.0)
+    title_llm = FakeProvider(ttft=args.title_ttft, tokens_per_second=0, output_tokens=5)
+    for provider in list(getattr(chat_utils, "LLM_TITLE_PROVIDERS", {})):
+        chat_utils.LLM_TITLE_PROVIDERS[provider] = title_llm.complete
+    counter = ScriptRunCounter()
+    run_first_turns(args, fake_db, counter)
+    run_batched_renames(args, fake_db)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=20, help="Conversaciones nuevas con su primer turno")
+    parser.add_argument("--warmup", type=int, default=1, help="Turnos iniciales que no se miden")
+    parser.add_argument("--conversations", type=int, default=40, help="Conversaciones previas en la barra lateral")
+    parser.add_argument("--messages", type=int, default=50, help="Palabras de cada respuesta previa")
+    parser.add_argument("--provider", default="gemini", help="gemini: recuento de tokens aproximado, sin descargar el BPE de tiktoken")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="Segundos por round trip a Supabase")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Time-to-first-token del LLM falso (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--output-tokens", type=int, default=120)
+    parser.add_argument("--title-ttft", type=float, default=0.3, help="Latencia del modelo barato de títulos (s)")
+    parser.add_argument("--title-timeout", type=float, default=10.0)
+    parser.add_argument("--users", type=int, default=20, help="Usuarios que piden títulos a la vez")
+    parser.add_argument("--conversations-per-user", type=int, default=3)
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
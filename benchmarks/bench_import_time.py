@@ -0,0 +1,91 @@
+"""Coste de arranque en frío de main.py medido con `python -X importtime`.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_import_time --repeat 5 [--budget-ms 800]
+
+main.py es un script de Streamlit y no se puede importar sin ejecutar la interfaz, así que se
+extraen sus imports de nivel superior (con ast) y se ejecutan en intérpretes nuevos, como haría
+un proceso de Streamlit recién arrancado. Para cada repetición se suma el tiempo acumulado de los
+módulos de primer nivel; se informa de la mediana, de los módulos más costosos y de si los SDK
+pesados (proveedores LLM, supabase, numpy) se han cargado ya al arrancar o quedan diferidos.
+Con --budget-ms el proceso termina con código 1 si la mediana lo supera (para vigilarlo en CI).
+"""
+import argparse
+import ast
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+DEFERRED_MODULES = ["openai", "google.generativeai", "supabase", "gotrue", "postgrest", "httpx", "numpy"]
+
+def import_statements(script):
+    """Código con los imports de nivel superior de `script` (sin ejecutar el resto)."""
+    with open(os.path.join(ROOT, script), encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=script)
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+def measure_once(code):
+    """Devuelve ({módulo de primer nivel: ms acumulados}, {módulo: ms acumulados} de todos los niveles)."""
+    probe = f"{code}\nimport sys\nprint(' '.join(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], cwd=ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"El import falló:\n{result.stderr[-2000:]}")
+    top_level, all_modules = {}, {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        module = match.group(4)
+        all_modules[module] = cumulative_ms
+        if len(match.group(3)) <= 1: # Un espacio: importado directamente por el código medido
+            top_level[module] = cumulative_ms
+    loaded = set(result.stdout.split())
+    return top_level, all_modules, loaded
+
+def run(args):
+    code = import_statements(args.script)
+    measure_once(code) # Calienta la caché de bytecode (.pyc): no se mide la compilación
+    interpreter_startup = set(measure_once("pass")[0]) # site, encodings...: no son coste de la app
+    totals, runs = [], []
+    for _ in range(args.repeat):
+        top_level, all_modules, loaded = measure_once(code)
+        top_level = {module: ms for module, ms in top_level.items() if module not in interpreter_startup}
+        totals.append(sum(top_level.values()))
+        runs.append(top_level)
+    median_total = statistics.median(totals)
+    print(f"Imports de {args.script} ({len(code.splitlines())} sentencias), {args.repeat} intérpretes nuevos")
+    print(f"  total: mediana {median_total:.0f} ms (mín {min(totals):.0f}, máx {max(totals):.0f})")
+
+    modules = {module for top_level in runs for module in top_level}
+    medians = {module: statistics.median(top_level.get(module, 0.0) for top_level in runs) for module in modules}
+    print(f"\n{'módulo (primer nivel)':<32} {'ms':>8}")
+    for module, ms in sorted(medians.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{module:<32} {ms:>8.1f}")
+
+    print("\nSDK pesados al arrancar:")
+    for module in DEFERRED_MODULES:
+        state = f"cargado ({all_modules.get(module, 0.0):.0f} ms)" if module in loaded else "diferido"
+        print(f"  {module:<24} {state}")
+
+    if args.budget_ms and median_total > args.budget_ms:
+        print(f"\nFALLO: {median_total:.0f} ms supera el presupuesto de {args.budget_ms:.0f} ms")
+        return 1
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--script", default="main.py", help="Script cuyos imports se miden (p. ej. api_server.py)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="Módulos de primer nivel a listar")
+    parser.add_argument("--budget-ms", type=float, default=0, help="Si >0, falla cuando la mediana lo supera")
+    return parser
+
+if __name__ == "__main__":
+    sys.exit(run(build_parser().parse_args()))
@@ -0,0 +1,113 @@
+"""Ingesta y consulta del índice de normativa (RAG) sobre un corpus sintético, sin red ni modelos.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_rag --documents 200 --articles 150 --queries 200
+
+Genera leyes sintéticas (.txt y .html) con artículos, las indexa en modo exacto, cuantizado
+(int8) e IVF, e informa del throughput de ingesta, la latencia de consulta p50/p95 (embedding +
+búsqueda + lectura de fragmentos) y el recall@k de los modos aproximados frente al exacto.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.load_test import percentile
+from embeddings import get_embedder
+from legal_corpus import Retriever, ingest_directory
+from vector_index import VectorIndex
+
+
+TOPICS = [
+    "arrendamiento", "prescripción", "responsabilidad", "contrato", "herencia", "usufructo", "hipoteca",
+    "despido", "salario", "protección de datos", "consumidor", "sociedad", "administrador", "concurso",
+    "tributo", "sanción", "recurso", "plazo", "notificación", "competencia", "indemnización", "servidumbre"
+]
+FILLER = [
+    "en los términos que se establezcan reglamentariamente", "salvo pacto en contrario de las partes",
+    "sin perjuicio de lo dispuesto en la legislación especial", "con arreglo a lo previsto en este capítulo",
+    "cuando concurran circunstancias que lo justifiquen", "a instancia de cualquiera de los interesados"
+]
+
+def synthetic_article(rng, law_idx, article_idx):
+    topics = rng.sample(TOPICS, 3)
+    sentences = [
+        f"El régimen de {topics[0]} aplicable a {topics[1]} se regirá por lo dispuesto en la ley {law_idx}, "
+        f"{rng.choice(FILLER)}."
+        for _ in range(rng.randint(1, 6))
+    ]
+    sentences.append(f"El plazo para ejercitar la acción de {topics[2]} será de {rng.randint(1, 15)} años.")
+    return f"Artículo {article_idx}.\n" + "\n".join(sentences)
+
+def write_corpus(directory, documents, articles, seed=0):
+    rng = random.Random(seed)
+    for law_idx in range(documents):
+        body = [synthetic_article(rng, law_idx, idx + 1) for idx in range(articles)]
+        if law_idx % 2: # La mitad como exportación HTML del BOE
+            paragraphs = "".join(f"<p>{line}</p>" for article in body for line in article.split("\n"))
+            content = f"<html><head><title>Ley {law_idx}/2024</title><style>p{{}}</style></head><body>{paragraphs}</body></html>"
+            name = f"ley_{law_idx}.html"
+        else:
+            content = f"Ley {law_idx}/2024\n\n" + "\n\n".join(body)
+            name = f"ley_{law_idx}.txt"
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            f.write(content)
+
+def recall_at_k(approximate, exact):
+    hits = sum(len({i for i, _ in a} & {i for i, _ in e}) for a, e in zip(approximate, exact))
+    return hits / max(1, sum(len(e) for e in exact))
+
+def run(args):
+    rng = random.Random(1)
+    embedder = get_embedder(args.embedder)
+    queries = [f"¿Qué plazo tiene la acción de {rng.choice(TOPICS)} en materia de {rng.choice(TOPICS)}?"
+               for _ in range(args.queries)]
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus_dir = os.path.join(workdir, "corpus")
+        os.makedirs(corpus_dir)
+        write_corpus(corpus_dir, args.documents, args.articles)
+        query_vectors = embedder.embed(queries)
+
+        print(f"Embedder: {embedder.spec}; consultas: {len(queries)}; top-k: {args.top_k}")
+        print(f"{'modo':<10} {'fragm.':>8} {'ingesta s':>10} {'fragm./s':>9} {'MB/s':>7} {'disco MB':>9} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'lote ms/q':>10} {'recall':>7}")
+        exact_results = None
+        for mode, options in [("exacto", {}), ("int8", {"quantize": True}), ("ivf", {"ivf_lists": args.ivf_lists}),
+                              ("ivf+int8", {"quantize": True, "ivf_lists": args.ivf_lists})]:
+            index_path = os.path.join(workdir, f"index_{mode}")
+            stats = ingest_directory(corpus_dir, index_path, embedder, **options)
+            index = VectorIndex(index_path)
+            retriever = Retriever(index, embedder, top_k=args.top_k, min_score=0.0, nprobe=args.nprobe)
+
+            samples = []
+            for query in queries: # Camino de la app: una consulta por turno, sin caché
+                started = time.perf_counter()
+                retriever.retrieve(query)
+                samples.append(time.perf_counter() - started)
+                retriever._cache.clear()
+            started = time.perf_counter()
+            results = index.search(query_vectors, k=args.top_k, nprobe=args.nprobe) # Búsqueda por lotes
+            batch_ms = (time.perf_counter() - started) * 1000 / len(queries)
+            if exact_results is None:
+                exact_results = results
+            disk_mb = sum(os.path.getsize(os.path.join(index_path, name)) for name in os.listdir(index_path)) / 2 ** 20
+            p50, p95 = (percentile(samples, pct) * 1000 for pct in (50, 95))
+            print(f"{mode:<10} {stats['chunks']:>8} {stats['seconds']:>10.2f} {stats['chunks'] / stats['seconds']:>9.0f} "
+                  f"{stats['bytes'] / 2 ** 20 / stats['seconds']:>7.2f} {disk_mb:>9.1f} {p50:>8.2f} {p95:>8.2f} "
+                  f"{batch_ms:>10.3f} {recall_at_k(results, exact_results):>7.3f}")
+            index.close()
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=200, help="Leyes sintéticas")
+    parser.add_argument("--articles", type=int, default=150, help="Artículos por ley")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--ivf-lists", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--embedder", default="hashing", help="Especificación del embedder (ver embeddings.get_embedder)")
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
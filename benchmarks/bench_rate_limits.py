@@ -0,0 +1,128 @@
+"""Límites de uso (rate_limits.py) con reloj falso: cubos de tokens, cola por proveedor y reintentos de 429.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_rate_limits --users 200 --minutes 10
+
+Todas las comprobaciones usan FakeClock, así que no esperan en tiempo real:
+  * cubos: usuarios que envían muy por encima de su límite durante N minutos simulados; ninguno
+    debe superar ráfaga + límite por minuto, y se informa del coste de acquire() en µs;
+  * cola: el semáforo por proveedor concede las plazas en orden de llegada y los puestos son 1..n;
+  * 429: un proveedor falso que responde 429 las primeras llamadas se recupera con reintentos
+    (backoff con jitter, respetando Retry-After) y, si agota los reintentos, el aviso no se guarda.
+
+Las mismas comprobaciones, como asserts de pytest, están en tests/test_rate_limits.py; este
+script además mide el coste de acquire() con muchos usuarios y muestra el detalle.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import chat_utils
+from benchmarks.fakes import FakeClock, FakeProvider
+from rate_limits import (
+    RATE_LIMIT_MAX_BACKOFF, RATE_LIMIT_RETRIES, ProviderConcurrency, RateLimiter,
+    astream_with_rate_limit_retry, is_rate_limited_response
+)
+
+
+def check_token_buckets(args):
+    clock = FakeClock()
+    limiter = RateLimiter(user_rpm=args.user_rpm, user_tpm=args.user_tpm, key_rpm=args.key_rpm, key_tpm=0, clock=clock)
+    rng = random.Random(0)
+    admitted = {idx: 0 for idx in range(args.users)}
+    calls = 0
+    tick = 60.0 / args.attempts_per_minute
+    started = time.perf_counter()
+    for _ in range(int(args.minutes * args.attempts_per_minute)):
+        for idx in range(args.users): # Cada usuario con su propia API Key, salvo que se compartan
+            api_key = f"sk-{idx % args.shared_keys}" if args.shared_keys else f"sk-{idx}"
+            ok, wait, _ = limiter.acquire(f"user-{idx}", api_key, tokens=rng.randint(200, 2000))
+            calls += 1
+            if ok:
+                admitted[idx] += 1
+                limiter.record_usage(f"user-{idx}", api_key, rng.randint(100, 800))
+            elif wait <= 0:
+                raise AssertionError("Una petición rechazada debe indicar cuánto esperar.")
+        clock.advance(tick)
+    elapsed = time.perf_counter() - started
+
+    ceiling = args.user_rpm * (args.minutes + 1) # Ráfaga inicial + relleno durante la simulación
+    worst = max(admitted.values())
+    status = "ok" if worst <= ceiling else "FALLO"
+    print(f"Cubos de tokens: {args.users} usuarios × {args.attempts_per_minute} intentos/min durante {args.minutes} min simulados")
+    print(f"  admitidas por usuario: mín {min(admitted.values())}, máx {worst} (techo {ceiling})  {status}")
+    print(f"  {limiter.stats()}")
+    print(f"  acquire + record_usage: {elapsed / calls * 1e6:.1f} µs por llamada ({calls} llamadas)")
+    return worst <= ceiling
+
+def check_provider_queue():
+    concurrency = ProviderConcurrency(limit=3)
+    slots = [concurrency.reserve("openai") for _ in range(10)]
+    positions = [slot.position() for slot in slots]
+    granted_order = [idx for idx, slot in enumerate(slots) if slot.granted]
+    for slot in slots: # Cada plaza liberada pasa al primero de la cola
+        if slot.granted:
+            slot.release()
+            granted_order.extend(idx for idx, other in enumerate(slots) if other.granted and idx not in granted_order)
+    slots_left = concurrency.reserve("gemini") # Otro proveedor no comparte semáforo
+    ok = positions == [0, 0, 0] + list(range(1, 8)) and granted_order == list(range(10)) and slots_left.granted
+    slots_left.release()
+    print(f"Cola por proveedor: puestos {positions}, orden de concesión {granted_order}  {'ok' if ok else 'FALLO'}")
+    print(f"  {concurrency.stats()}")
+    return ok
+
+async def _collect(stream):
+    return "".join([chunk async for chunk in stream])
+
+def check_rate_limit_retries():
+    ok = True
+    for failures, retry_after in ((2, None), (1, 7), (RATE_LIMIT_RETRIES + 1, None)):
+        clock = FakeClock()
+        provider = FakeProvider(ttft=0, tokens_per_second=0, output_tokens=5, rate_limited_calls=failures, retry_after=retry_after)
+        stream = astream_with_rate_limit_retry(lambda: provider([], "sk-fake"), retries=RATE_LIMIT_RETRIES,
+                                               sleep=clock.asleep, rng=random.Random(1))
+        try:
+            text, error = asyncio.run(_collect(stream)), None
+        except Exception as e:
+            text, error = "", e
+        recovered = failures <= RATE_LIMIT_RETRIES
+        expected = text.startswith("tok0") if recovered else error is not None and len(clock.sleeps) == RATE_LIMIT_RETRIES
+        delays_ok = all(0 <= delay <= RATE_LIMIT_MAX_BACKOFF for delay in clock.sleeps) \
+            and (retry_after is None or all(delay >= retry_after for delay in clock.sleeps))
+        ok = ok and expected and delays_ok
+        print(f"429 × {failures} (Retry-After {retry_after}): llamadas {provider.calls}, esperas "
+              f"{[round(d, 2) for d in clock.sleeps]} → {'respuesta' if recovered else 'error'}  "
+              f"{'ok' if expected and delays_ok else 'FALLO'}")
+
+    # Camino completo: el aviso final de 429 no debe guardarse como respuesta del asistente
+    original = chat_utils.LLM_STREAM_PROVIDERS["openai"]
+    chat_utils.LLM_STREAM_PROVIDERS["openai"] = FakeProvider(ttft=0, rate_limited_calls=100)
+    try:
+        # Los reintentos ya se han comprobado arriba; aquí, sin esperas reales
+        text = asyncio.run(_collect(chat_utils.astream_llm_response(
+            [{"role": "user", "content": "hola"}], "sk-fake", retries=0
+        )))
+    finally:
+        chat_utils.LLM_STREAM_PROVIDERS["openai"] = original
+    not_persisted = is_rate_limited_response(text)
+    print(f"Aviso tras agotar los reintentos: {text!r}  {'ok (no se guarda)' if not_persisted else 'FALLO'}")
+    return ok and not_persisted
+
+def run(args):
+    results = [check_token_buckets(args), check_provider_queue(), check_rate_limit_retries()]
+    print("\nTodo correcto." if all(results) else "\nHay comprobaciones fallidas.")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--minutes", type=float, default=10, help="Minutos simulados")
+    parser.add_argument("--attempts-per-minute", type=int, default=120, help="Intentos por usuario y minuto")
+    parser.add_argument("--user-rpm", type=int, default=20)
+    parser.add_argument("--user-tpm", type=int, default=100000)
+    parser.add_argument("--key-rpm", type=int, default=60)
+    parser.add_argument("--shared-keys", type=int, default=0, help="Si >0, los usuarios comparten este número de API Keys")
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
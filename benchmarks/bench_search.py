@@ -0,0 +1,87 @@
+"""Búsqueda de texto completo en el historial del usuario (search_messages) contra el Supabase falso.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.bench_search --conversations 200 --turns 20
+
+Genera un historial sintético, recorre las primeras páginas de resultados de varias consultas y
+comprueba que el orden por relevancia es estable entre páginas (sin duplicados ni huecos) antes
+de informar de la latencia por página. La relevancia del backend falso es una aproximación de
+ts_rank: sirve para validar el contrato de chat_utils, no la calidad del ranking de Postgres.
+"""
+import argparse
+import logging
+import os
+import time
+
+os.environ.setdefault("LEXIA_TELEMETRY_JSON_LOGS", "0")
+
+import chat_utils
+import supabase_client
+from benchmarks.bench_context import SAMPLE_SENTENCES
+from benchmarks.fakes import FakeSupabase
+from benchmarks.load_test import percentile
+
+
+QUERIES = ["arrendamientos urbanos", "prescripción", "protección de datos", "responsabilidad daño", "usucapión"]
+
+def seed_history(fake_db, user_id, conversations, turns):
+    for conv_idx in range(conversations):
+        conv = chat_utils.create_conversation(user_id, f"Consulta {conv_idx}")
+        for turn in range(turns):
+            question = SAMPLE_SENTENCES[(conv_idx + turn) % len(SAMPLE_SENTENCES)]
+            answer = " ".join(SAMPLE_SENTENCES[(conv_idx * turn + k) % len(SAMPLE_SENTENCES)] for k in range(3))
+            fake_db.rpc("save_turn", {
+                "p_user_id": user_id,
+                "p_conversation_id": conv["id"],
+                "p_messages": [
+                    {"role": "user", "content": f"{question} ({conv_idx}.{turn})"},
+                    {"role": "assistant", "content": answer}
+                ]
+            }).execute()
+
+def expected_hits(fake_db, user_id, query):
+    """Todos los resultados en una sola llamada, para comparar con la paginación."""
+    return fake_db.rpc("search_messages", {"p_user_id": user_id, "p_query": query, "p_limit": 10 ** 9}).execute().data
+
+def run(args):
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    fake_db = FakeSupabase(latency=args.db_latency, seed=0)
+    supabase_client.get_supabase_client = lambda: fake_db
+    supabase_client.SUPABASE_URL, supabase_client.SUPABASE_KEY = "http://supabase.fake", "fake-anon-key"
+    user_id = "bench-user"
+    seed_history(fake_db, user_id, args.conversations, args.turns)
+    print(f"Mensajes: {len(fake_db.tables['messages'])} en {args.conversations} conversaciones "
+          f"(latencia BD {args.db_latency * 1000:.0f} ms)")
+    print(f"{'consulta':<26} {'leídos':>6} {'páginas':>8} {'p50 ms':>8} {'p95 ms':>8}  paginación")
+
+    for query in QUERIES:
+        samples, paged, cursor = [], [], None
+        while True:
+            started = time.perf_counter()
+            results, cursor = chat_utils.search_messages(user_id, query, limit=args.page_size, cursor=cursor)
+            samples.append(time.perf_counter() - started)
+            paged.extend(results)
+            if cursor is None or len(samples) >= args.max_pages:
+                break
+        ranks = [hit["rank"] for hit in paged]
+        consistent = (
+            [hit["message_id"] for hit in paged] == [hit["message_id"] for hit in expected_hits(fake_db, user_id, query)][:len(paged)]
+            and ranks == sorted(ranks, reverse=True)
+        )
+        p50, p95 = (percentile(samples, pct) * 1000 for pct in (50, 95))
+        print(f"{query:<26} {len(paged):>6} {len(samples):>8} {p50:>8.1f} {p95:>8.1f}  {'ok' if consistent else 'INCONSISTENTE'}")
+        if paged and args.show_snippet:
+            print(f"    {paged[0]['conversation_title']}: {paged[0]['snippet']}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=20, help="Turnos por conversación")
+    parser.add_argument("--page-size", type=int, default=chat_utils.MESSAGE_SEARCH_PAGE_SIZE)
+    parser.add_argument("--max-pages", type=int, default=10, help="Páginas recorridas por consulta")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="Segundos por round trip a Supabase")
+    parser.add_argument("--show-snippet", action="store_true", help="Muestra el fragmento del mejor resultado")
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
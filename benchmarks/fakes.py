@@ -0,0 +1,554 @@
+"""Backends falsos en proceso para benchmarks offline: Supabase (PostgREST + Auth) y proveedores LLM.
+
+FakeSupabase implementa el subconjunto de la API de supabase-py que usa la aplicación
+(table().select/insert/update/delete con eq/lt/gt/or_/ilike/order/limit, rpc() y auth) con la
+semántica del esquema del README: ids y timestamps por defecto, ON DELETE CASCADE de
+conversations a messages, la RPC save_turn idempotente por id de mensaje (con la FK a conversations),
+rename_conversations y una aproximación de search_messages (sin stemming real de Postgres: minúsculas, sin tildes y prefijos de 5 letras).
+Con create_index() las consultas paginadas por cursor recorren un índice ordenado en lugar de toda
+la tabla, para poder medir historiales de millones de filas.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+
+class _Clock:
+    """Timestamps ISO estrictamente crecientes (como now() en transacciones distintas)."""
+
+    def __init__(self):
+        self._base = datetime.now(timezone.utc)
+        self._ticks = itertools.count()
+        self._lock = threading.Lock()
+
+    def now(self):
+        with self._lock:
+            tick = next(self._ticks)
+        return (self._base + timedelta(microseconds=tick)).isoformat()
+
+def _unquote(value):
+    return value[1:-1] if len(value) >= 2 and value[0] == value[-1] == '"' else value
+
+def _split_top_level(expr):
+    parts, depth, current = [], 0, []
+    for char in expr:
+        if char == "," and depth == 0:
+            parts.append("".join(current))
+            current = []
+            continue
+        depth += char == "("
+        depth -= char == ")"
+        current.append(char)
+    parts.append("".join(current))
+    return parts
+
+def _like_to_regex(pattern):
+    """Patrón LIKE (%, _, * de PostgREST y escapes con \\) a expresión regular."""
+    parts, chars = [], iter(pattern)
+    for char in chars:
+        if char == "\\":
+            parts.append(re.escape(next(chars, "\\")))
+        elif char in "%*":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return "".join(parts)
+
+_OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+    "ilike": lambda a, b: a is not None and re.fullmatch(_like_to_regex(b.lower()), a.lower(), re.DOTALL) is not None
+}
+
+def _parse_logic(expr):
+    """Traduce una expresión or_ de PostgREST (p. ej. 'a.lt.1,and(a.eq.1,b.lt.2)') a un predicado."""
+    terms = []
+    for part in _split_top_level(expr):
+        if part.startswith("and(") and part.endswith(")"):
+            inner = _split_top_level(part[4:-1])
+            terms.append(lambda row, inner=[_parse_logic(p) for p in inner]: all(t(row) for t in inner))
+            continue
+        if part.startswith("or(") and part.endswith(")"):
+            terms.append(_parse_logic(part[3:-1]))
+            continue
+        column, op, value = part.split(".", 2)
+        terms.append(lambda row, c=column, o=_OPERATORS[op], v=_unquote(value): o(row.get(c), v))
+    return lambda row: any(term(row) for term in terms)
+
+class _Query:
+    def __init__(self, db, table):
+        self._db = db
+        self._table = table
+        self._filters = []
+        self._conditions = [] # (columna, operador, valor) de los filtros simples, para los índices
+        self._orders = []
+        self._limit = None
+        self._columns = None
+        self._operation = "select"
+        self._payload = None
+        self._upsert_options = None
+        self._returning = "representation"
+
+    # --- Operaciones ---
+    def select(self, columns="*"):
+        self._columns = None if columns.strip() == "*" else [c.strip() for c in columns.split(",")]
+        return self
+
+    def insert(self, payload):
+        self._operation, self._payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict="id", ignore_duplicates=False, returning="representation"):
+        self._operation, self._payload = "upsert", payload
+        self._upsert_options = (on_conflict, ignore_duplicates)
+        self._returning = returning
+        return self
+
+    def update(self, payload):
+        self._operation, self._payload = "update", payload
+        return self
+
+    def delete(self):
+        self._operation = "delete"
+        return self
+
+    # --- Filtros y modificadores ---
+    def _filter(self, column, op, value):
+        self._filters.append(lambda row: _OPERATORS[op](row.get(column), value))
+        self._conditions.append((column, op, value))
+        return self
+
+    def eq(self, column, value): return self._filter(column, "eq", value)
+    def neq(self, column, value): return self._filter(column, "neq", value)
+    def lt(self, column, value): return self._filter(column, "lt", value)
+    def lte(self, column, value): return self._filter(column, "lte", value)
+    def gt(self, column, value): return self._filter(column, "gt", value)
+    def gte(self, column, value): return self._filter(column, "gte", value)
+    def ilike(self, column, pattern): return self._filter(column, "ilike", pattern)
+
+    def in_(self, column, values):
+        values = set(values)
+        self._filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def or_(self, expr):
+        self._filters.append(_parse_logic(expr))
+        return self
+
+    def order(self, column, desc=False):
+        self._orders.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def execute(self):
+        return self._db._execute(self)
+
+class FakeAuth:
+    """Supabase Auth en memoria. Los access tokens son "token-<user_id>" (sin firma) y duran `token_ttl` s."""
+
+    def __init__(self, simulate_network=lambda: None, token_ttl=3600):
+        self._simulate_network = simulate_network
+        self.token_ttl = token_ttl
+        self._users = {}
+        self._refresh_tokens = {} # refresh token -> usuario
+        self._lock = threading.Lock()
+        self.admin = SimpleNamespace(sign_out=self._admin_sign_out)
+        self.refreshes = 0
+
+    def sign_up(self, credentials, user_id=None):
+        """`user_id` (solo en el fake) fija el id, para sembrar los mismos usuarios en varios procesos."""
+        with self._lock:
+            user = SimpleNamespace(id=user_id or str(uuid.uuid4()), email=credentials["email"])
+            self._users[credentials["email"]] = (credentials["password"], user)
+        return SimpleNamespace(user=user, session=None, error=None)
+
+    def _new_session(self, user):
+        refresh_token = uuid.uuid4().hex
+        with self._lock:
+            self._refresh_tokens[refresh_token] = user
+        return SimpleNamespace(access_token=f"token-{user.id}", refresh_token=refresh_token, user=user,
+                               expires_in=self.token_ttl, expires_at=int(time.time()) + self.token_ttl)
+
+    def sign_in_with_password(self, credentials):
+        self._simulate_network()
+        with self._lock:
+            password, user = self._users.get(credentials["email"], (None, None))
+        if user is None or password != credentials["password"]:
+            raise ValueError("Invalid login credentials")
+        return SimpleNamespace(user=user, session=self._new_session(user), error=None)
+
+    def refresh_session(self, refresh_token):
+        self._simulate_network()
+        with self._lock: # Cada refresh token se usa una sola vez, como en Supabase
+            user = self._refresh_tokens.pop(refresh_token, None)
+            self.refreshes += 1
+        if user is None:
+            raise ValueError("Invalid Refresh Token")
+        session = self._new_session(user)
+        return SimpleNamespace(user=user, session=session)
+
+    def get_user(self, jwt):
+        self._simulate_network()
+        with self._lock:
+            user = next((u for _, u in self._users.values() if f"token-{u.id}" == jwt), None)
+        return SimpleNamespace(user=user)
+
+    def _admin_sign_out(self, jwt, scope="global"):
+        self._simulate_network()
+
+class FakeSupabase:
+    """Cliente Supabase en memoria con latencia configurable por round trip.
+
+    `latency` (segundos) y `jitter` (fracción) simulan la red; `round_trips` cuenta las llamadas
+    a execute(), útil para verificar cuántas peticiones genera cada flujo.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.2, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.tables = {"conversations": [], "messages": []}
+        self.auth = FakeAuth(self._simulate_network)
+        self.round_trips = 0
+        self.rpc_functions = {
+            "save_turn": self._rpc_save_turn,
+            "search_messages": self._rpc_search_messages,
+            "rename_conversations": self._rpc_rename_conversations
+        }
+        self._clock = _Clock()
+        self._lock = threading.RLock()
+        self._id_maps = {} # tabla -> (lista de filas, filas vistas, {id: fila})
+        self._indexes = {} # tabla -> (columna de igualdad, columnas de orden)
+        self._index_cache = {} # tabla -> (versión, {valor: (claves ordenadas, filas)})
+        self._versions = {} # tabla -> escrituras, para invalidar los índices
+        self._rng = random.Random(seed)
+        self._search_stems = {} # id de mensaje -> stems del contenido (el equivalente a content_tsv)
+
+    def table(self, name):
+        return _Query(self, name)
+
+    def rpc(self, name, params=None):
+        return SimpleNamespace(execute=lambda: self._execute_rpc(name, params or {}))
+
+    def set_access_token(self, access_token):
+        pass # El fake no aplica RLS: un único cliente sirve para todos los usuarios
+
+    def create_index(self, table, eq_column, *order_columns):
+        """Como `create index on table (eq_column, order_columns...)`: lo usan las consultas con eq
+        sobre eq_column y order por order_columns (todas asc o todas desc), que con un gt/gte (o
+        lt/lte si es desc) sobre la primera columna de orden empiezan el recorrido en ese punto.
+        Se construye aquí y se reconstruye en la primera consulta tras cada escritura."""
+        with self._lock:
+            self._indexes[table] = (eq_column, tuple(order_columns))
+            self._build_index(table)
+
+    # --- Internos ---
+
+    def _simulate_network(self):
+        if self.latency:
+            time.sleep(self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter)))
+
+    def _execute_rpc(self, name, params):
+        self._simulate_network()
+        with self._lock:
+            self.round_trips += 1
+            for table in self.tables: # Las RPC pueden escribir en cualquier tabla
+                self._versions[table] = self._versions.get(table, 0) + 1
+            return SimpleNamespace(data=self.rpc_functions[name](params))
+
+    def _id_map(self, table):
+        """{id: fila} de la tabla, ampliado con las filas añadidas al final desde la última vez."""
+        rows = self.tables.setdefault(table, [])
+        cached_rows, seen, ids = self._id_maps.get(table, (None, 0, None))
+        if cached_rows is not rows or seen > len(rows): # delete reemplaza la lista
+            seen, ids = 0, {}
+        for row in rows[seen:]:
+            ids[row["id"]] = row
+        self._id_maps[table] = (rows, len(rows), ids)
+        return ids
+
+    def _index_version(self, table):
+        rows = self.tables.setdefault(table, [])
+        return self._versions.get(table, 0), id(rows), len(rows) # len: filas añadidas directamente (siembras)
+
+    def _build_index(self, table):
+        eq_column, order_columns = self._indexes[table]
+        groups = {}
+        for row in self.tables.setdefault(table, []):
+            groups.setdefault(row.get(eq_column), []).append(row)
+        entries = {}
+        for value, group in groups.items():
+            group.sort(key=lambda row: tuple(row.get(c) for c in order_columns))
+            entries[value] = ([tuple(row.get(c) for c in order_columns) for row in group], group)
+        cached = self._index_cache[table] = (self._index_version(table), entries)
+        return cached
+
+    def _index_scan(self, query):
+        """Filas de la consulta (ya ordenadas y limitadas) recorriendo el índice, o None si no aplica."""
+        index = self._indexes.get(query._table)
+        if index is None or query._limit is None:
+            return None
+        eq_column, order_columns = index
+        desc = {d for _, d in query._orders}
+        if tuple(c for c, _ in query._orders) != order_columns or len(desc) != 1:
+            return None
+        desc = desc.pop()
+        eq_values = [value for column, op, value in query._conditions if column == eq_column and op == "eq"]
+        if not eq_values:
+            return None
+        cached = self._index_cache.get(query._table)
+        if cached is None or cached[0] != self._index_version(query._table):
+            cached = self._build_index(query._table)
+        keys, group = cached[1].get(eq_values[0], ([], []))
+        first = order_columns[0]
+        bounds = [value for column, op, value in query._conditions
+                  if column == first and op in (("lt", "lte") if desc else ("gt", "gte"))]
+        if desc:
+            end = bisect.bisect_right(keys, min(bounds), key=lambda key: key[0]) if bounds else len(keys)
+            candidates = (group[idx] for idx in range(end - 1, -1, -1))
+        else:
+            start = bisect.bisect_left(keys, max(bounds), key=lambda key: key[0]) if bounds else 0
+            candidates = (group[idx] for idx in range(start, len(group)))
+        matched = []
+        for row in candidates:
+            if all(f(row) for f in query._filters):
+                matched.append(row)
+                if len(matched) == query._limit:
+                    break
+        return matched
+
+    def _with_defaults(self, table, row):
+        row = dict(row)
+        row.setdefault("id", str(uuid.uuid4()))
+        now = self._clock.now()
+        row.setdefault("created_at", now)
+        if table == "conversations":
+            row.setdefault("updated_at", row["created_at"])
+        return row
+
+    @staticmethod
+    def _project(rows, columns):
+        if columns is None:
+            return [dict(row) for row in rows]
+        return [{c: row.get(c) for c in columns} for row in rows]
+
+    def _execute(self, query):
+        self._simulate_network()
+        with self._lock:
+            self.round_trips += 1
+            rows = self.tables.setdefault(query._table, [])
+            if query._operation != "select":
+                self._versions[query._table] = self._versions.get(query._table, 0) + 1
+            if query._operation in ("insert", "upsert"):
+                payload = query._payload if isinstance(query._payload, list) else [query._payload]
+                existing = self._id_map(query._table)
+                inserted = []
+                for item in payload:
+                    row = self._with_defaults(query._table, item)
+                    if row["id"] in existing:
+                        if query._operation == "insert":
+                            raise ValueError(f'duplicate key value violates unique constraint "{query._table}_pkey"')
+                        if not query._upsert_options[1]: # ignore_duplicates=False: actualiza
+                            existing[row["id"]].update(item)
+                            inserted.append(dict(existing[row["id"]]))
+                        continue
+                    rows.append(row)
+                    existing[row["id"]] = row
+                    inserted.append(dict(row))
+                return SimpleNamespace(data=[] if query._returning == "minimal" else inserted)
+
+            if query._operation == "select":
+                scanned = self._index_scan(query)
+                if scanned is not None:
+                    return SimpleNamespace(data=self._project(scanned, query._columns))
+            matched = [row for row in rows if all(f(row) for f in query._filters)]
+            if query._operation == "update":
+                for row in matched:
+                    for key, value in query._payload.items():
+                        row[key] = self._clock.now() if value == "now()" else value
+                return SimpleNamespace(data=[dict(row) for row in matched])
+            if query._operation == "delete":
+                matched_ids = {row["id"] for row in matched}
+                self.tables[query._table] = [row for row in rows if row["id"] not in matched_ids]
+                if query._table == "conversations": # ON DELETE CASCADE
+                    self.tables["messages"] = [m for m in self.tables["messages"] if m["conversation_id"] not in matched_ids]
+                return SimpleNamespace(data=[dict(row) for row in matched])
+
+            for column, desc in reversed(query._orders):
+                matched.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+            if query._limit is not None:
+                matched = matched[:query._limit]
+            return SimpleNamespace(data=self._project(matched, query._columns))
+
+    def _rpc_save_turn(self, params):
+        if not any(conv["id"] == params["p_conversation_id"] for conv in self.tables["conversations"]):
+            raise FakeAPIError("23503", 'insert or update on table "messages" violates foreign key constraint '
+                                        '"messages_conversation_id_fkey"')
+        messages = self.tables["messages"]
+        existing_ids = self._id_map("messages")
+        for msg in params["p_messages"]:
+            if msg.get("id") in existing_ids: # ON CONFLICT (id) DO NOTHING
+                continue
+            messages.append(self._with_defaults("messages", {
+                "id": msg.get("id") or str(uuid.uuid4()),
+                "user_id": params["p_user_id"],
+                "conversation_id": params["p_conversation_id"],
+                "role": msg["role"],
+                "content": msg["content"]
+            }))
+        for conv in self.tables["conversations"]:
+            if conv["id"] == params["p_conversation_id"]:
+                conv["updated_at"] = self._clock.now()
+                if params.get("p_title") is not None:
+                    conv["title"] = params["p_title"]
+        return None
+
+    def _rpc_rename_conversations(self, params):
+        renames = {rename["id"]: rename for rename in params["p_renames"]}
+        renamed = []
+        for conv in self.tables["conversations"]:
+            rename = renames.get(conv["id"])
+            if rename and (rename.get("expected_title") is None or conv["title"] == rename["expected_title"]):
+                conv["title"] = rename["title"] # Sin tocar updated_at
+                renamed.append({"id": conv["id"]})
+        return renamed
+
+    def _rpc_search_messages(self, params):
+        terms = {_search_stem(word) for word in _SEARCH_WORD.findall(params["p_query"])} - _SEARCH_STOPWORDS
+        titles = {conv["id"]: conv.get("title") for conv in self.tables["conversations"]}
+        hits = []
+        for msg in self.tables["messages"]:
+            if msg.get("user_id") != params["p_user_id"] or not terms:
+                continue
+            stems = self._search_stems.get(msg["id"])
+            if stems is None:
+                stems = self._search_stems[msg["id"]] = [_search_stem(word) for word in _SEARCH_WORD.findall(msg["content"])]
+            if not terms.issubset(stems): # websearch_to_tsquery une los términos con AND
+                continue
+            matches = sum(stem in terms for stem in stems)
+            hits.append((round(matches / (1 + len(stems)) * 10, 6), msg["id"], msg))
+        hits.sort(key=lambda hit: (hit[0], hit[1]), reverse=True)
+        if params.get("p_cursor_rank") is not None:
+            cursor = (params["p_cursor_rank"], params["p_cursor_id"])
+            hits = [hit for hit in hits if (hit[0], hit[1]) < cursor]
+        return [{
+            "message_id": msg["id"],
+            "conversation_id": msg["conversation_id"],
+            "conversation_title": titles.get(msg["conversation_id"]),
+            "role": msg["role"],
+            "created_at": msg["created_at"],
+            "rank": rank,
+            "snippet": _search_headline(msg["content"], terms),
+            "content_md5": hashlib.md5(msg["content"].encode("utf-8")).hexdigest()
+        } for rank, _, msg in hits[:params.get("p_limit", 20)]]
+
+_SEARCH_WORD = re.compile(r"\w+")
+_SEARCH_STOPWORDS = {"de", "la", "el", "en", "y", "a", "los", "las", "del", "que", "por", "con", "un", "una", "para"}
+
+def _search_stem(word):
+    folded = unicodedata.normalize("NFKD", word.lower())
+    return "".join(c for c in folded if not unicodedata.combining(c))[:5]
+
+def _search_headline(content, terms, max_words=30):
+    """Equivalente aproximado de ts_headline: ventana alrededor de la primera coincidencia en **negrita**."""
+    words = content.split()
+    positions = {idx for idx, word in enumerate(words)
+                 if any(_search_stem(w) in terms for w in _SEARCH_WORD.findall(word))}
+    start = max(0, min(positions) - max_words // 3) if positions else 0
+    window = words[start:start + max_words]
+    marked = [f"**{word}**" if start + idx in positions else word for idx, word in enumerate(window)]
+    return ("… " if start else "") + " ".join(marked) + (" …" if start + max_words < len(words) else "")
+
+class FakeAPIError(Exception):
+    """Error de PostgREST con la forma de postgrest.exceptions.APIError (code es el SQLSTATE)."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+class FakeProviderError(Exception):
+    pass
+
+class FakeRateLimitError(Exception):
+    """429 simulado, con la forma de los errores de los SDK (status_code y cabeceras de la respuesta)."""
+
+    status_code = 429
+
+    def __init__(self, retry_after=None):
+        super().__init__("429 Too Many Requests (simulado)")
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after": str(retry_after)} if retry_after else {})
+
+class FakeClock:
+    """Reloj manual para probar límites y backoff sin esperar: se llama como time.monotonic."""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.advance(seconds)
+
+    async def asleep(self, seconds):
+        self.sleep(seconds)
+
+class FakeProvider:
+    """Proveedor LLM falso con time-to-first-token, velocidad y tasa de errores configurables.
+
+    Es un generador asíncrono con la firma de chat_utils.LLM_STREAM_PROVIDERS, así que puede
+    sustituir a un proveedor real: LLM_STREAM_PROVIDERS["openai"] = FakeProvider(...).
+    """
+
+    def __init__(self, ttft=0.3, tokens_per_second=80.0, output_tokens=200, error_rate=0.0, seed=None,
+                 rate_limited_calls=0, retry_after=None):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.rate_limited_calls = rate_limited_calls # Las primeras N llamadas responden 429
+        self.retry_after = retry_after
+        self.calls = 0
+        self._rng = random.Random(seed)
+
+    async def __call__(self, chat_history_for_llm, api_key, llm_context=None):
+        self.calls += 1
+        await asyncio.sleep(self.ttft)
+        if self.calls <= self.rate_limited_calls:
+            raise FakeRateLimitError(self.retry_after)
+        if self._rng.random() < self.error_rate:
+            raise FakeProviderError("429 Too Many Requests (simulado)")
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+        for idx in range(self.output_tokens):
+            yield f"tok{idx} "
+            if delay:
+                await asyncio.sleep(delay)
+
+    def complete(self, chat_history_for_llm, api_key):
+        """Variante no-streaming (misma latencia total), para sustituir a LLM_TITLE_PROVIDERS."""
+        async def run():
+            return "".join([chunk async for chunk in self(chat_history_for_llm, api_key)])
+        return run()
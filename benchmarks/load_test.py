@@ -0,0 +1,157 @@
+"""Prueba de carga offline del flujo de chat con Supabase y proveedores LLM falsos.
+
+Uso (desde la raíz del repositorio):
+    python -m benchmarks.load_test --users 20 --turns 5 --db-latency 0.02 --ttft 0.3
+
+Cada usuario simulado es un hilo (como una sesión de Streamlit) que recorre
+login → listar conversaciones → cambiar de conversación → enviar turnos, usando las mismas
+funciones de chat_utils/supabase_client que main.py. Al final se informa del throughput y de
+los percentiles p50/p95/p99 por etapa.
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+
+os.environ.setdefault("LEXIA_TELEMETRY_JSON_LOGS", "0") # Un log JSON por turno ensuciaría el informe
+
+import chat_utils
+import supabase_client
+from benchmarks.fakes import FakeProvider, FakeSupabase
+
+
+STAGES = ["login", "list_conversations", "create_conversation", "switch_conversation", "ttft", "turn"]
+
+def percentile(samples, pct):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[idx]
+
+class StageTimings:
+    def __init__(self):
+        self._samples = {stage: [] for stage in STAGES}
+        self._lock = threading.Lock()
+        self.errors = 0
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def report(self, wall_seconds, turns_completed):
+        print(f"\nTurnos completados: {turns_completed} en {wall_seconds:.2f} s "
+              f"→ {turns_completed / wall_seconds:.2f} turnos/s (errores: {self.errors})")
+        print(f"{'etapa':<22} {'n':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+        for stage, samples in self._samples.items():
+            if not samples:
+                continue
+            p50, p95, p99 = (percentile(samples, pct) * 1000 for pct in (50, 95, 99))
+            print(f"{stage:<22} {len(samples):>6} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}")
+
+def install_fakes(db_latency, ttft, tokens_per_second, output_tokens, error_rate, seed=0):
+    """Sustituye Supabase y los proveedores LLM por los backends falsos. Devuelve (db, proveedor)."""
+    fake_db = FakeSupabase(latency=db_latency, seed=seed)
+    fake_llm = FakeProvider(ttft=ttft, tokens_per_second=tokens_per_second,
+                            output_tokens=output_tokens, error_rate=error_rate, seed=seed)
+    supabase_client.get_supabase_client = lambda: fake_db
+    supabase_client.SUPABASE_URL, supabase_client.SUPABASE_KEY = "http://supabase.fake", "fake-anon-key"
+    supabase_client.get_auth = lambda: fake_db.auth
+    supabase_client.create_user_client = lambda access_token: fake_db
+    for provider in list(chat_utils.LLM_STREAM_PROVIDERS):
+        chat_utils.LLM_STREAM_PROVIDERS[provider] = fake_llm
+    title_llm = FakeProvider(ttft=ttft, tokens_per_second=0, output_tokens=5, seed=seed) # Títulos: respuesta corta
+    for provider in list(chat_utils.LLM_TITLE_PROVIDERS):
+        chat_utils.LLM_TITLE_PROVIDERS[provider] = title_llm.complete
+    return fake_db, fake_llm
+
+def timed_call(timings, stage, func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.record(stage, time.perf_counter() - started)
+    return result
+
+def simulate_user(idx, args, fake_db, timings, completed, barrier):
+    email, password = f"user{idx}@example.com", "benchmark"
+    fake_db.auth.sign_up({"email": email, "password": password})
+    barrier.wait() # Todos los usuarios empiezan a la vez
+
+    user, user_session, error = timed_call(timings, "login", supabase_client.sign_in_user, email, password)
+    if error:
+        timings.errors += 1
+        return
+    supabase_client.bind_client(user_session.client()) # Como main.py: cliente del usuario para este hilo (sesión)
+    conversations = timed_call(timings, "list_conversations", chat_utils.get_user_conversations, user.id)
+    while len(conversations) < args.conversations:
+        created = timed_call(timings, "create_conversation", chat_utils.create_conversation, user.id)
+        conversations.insert(0, created)
+
+    for turn in range(args.turns):
+        conversation = conversations[turn % len(conversations)]
+        messages, _ = timed_call(timings, "switch_conversation", chat_utils.get_messages_page,
+                                 conversation["id"], user_id=user.id)
+        prompt = f"Consulta {turn} del usuario {idx}: ¿qué plazo de prescripción aplica?"
+        history = messages + [{"role": "user", "content": prompt}]
+
+        started = time.perf_counter()
+        chunks = []
+        for chunk in chat_utils.stream_llm_response(history, "sk-fake", args.provider):
+            if not chunks:
+                timings.record("ttft", time.perf_counter() - started)
+            chunks.append(chunk)
+        response = "".join(chunks)
+        if response.startswith("Error"):
+            timings.errors += 1
+        error = chat_utils.queue_turn(user.id, conversation["id"], prompt, response)
+        timings.record("turn", time.perf_counter() - started)
+        if error:
+            timings.errors += 1
+        with completed["lock"]:
+            completed["turns"] += 1
+
+def run(args):
+    logging.getLogger("streamlit").setLevel(logging.ERROR) # st.cache_resource fuera de `streamlit run`
+    fake_db, fake_llm = install_fakes(args.db_latency, args.ttft, args.tokens_per_second,
+                                      args.output_tokens, args.error_rate)
+    timings = StageTimings()
+    completed = {"turns": 0, "lock": threading.Lock()}
+    barrier = threading.Barrier(args.users + 1)
+    threads = [
+        threading.Thread(target=simulate_user, args=(idx, args, fake_db, timings, completed, barrier), daemon=True)
+        for idx in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    flush_started = time.perf_counter()
+    flushed = chat_utils.get_write_behind_queue(chat_utils._write_turn_rows).flush(timeout=60)
+    print(f"usuarios={args.users} turnos/usuario={args.turns} latencia BD={args.db_latency * 1000:.0f} ms "
+          f"TTFT={args.ttft * 1000:.0f} ms tokens/s={args.tokens_per_second}")
+    timings.report(wall, completed["turns"])
+    print(f"\nVaciado de la cola de escritura: {(time.perf_counter() - flush_started) * 1000:.1f} ms "
+          f"({'completo' if flushed else 'incompleto'}); round trips a la BD: {fake_db.round_trips}; "
+          f"mensajes guardados: {len(fake_db.tables['messages'])}; llamadas al LLM: {fake_llm.calls}")
+    print(f"Caché de conversaciones: {chat_utils.get_cache_stats()}")
+    return timings
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5, help="Turnos por usuario")
+    parser.add_argument("--conversations", type=int, default=3, help="Conversaciones por usuario")
+    parser.add_argument("--provider", choices=["openai", "gemini"], default="openai")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="Segundos por round trip a Supabase")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Time-to-first-token del LLM falso (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--output-tokens", type=int, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    return parser
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
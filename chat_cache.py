@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+
+
+DEFAULT_MAX_BYTES = int(os.getenv("LEXIA_CHAT_CACHE_MB", "64")) * 1024 * 1024 # Tamaño aproximado máximo (0 la desactiva)
+DEFAULT_TTL_SECONDS = 300
+
+def estimate_size(value):
+    """Tamaño aproximado en bytes de las listas/dicts de filas que devuelve Supabase."""
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 8 + sum(estimate_size(v) for v in value)
+    return 8
+
+def copy_rows(rows):
+    """Copia superficial de cada fila para que la UI pueda mutarlas sin tocar la caché."""
+    return [dict(row) for row in rows]
+
+class ChatCache:
+    """Caché LRU acotada por bytes, con TTL, para conversaciones y mensajes.
+
+    Las claves son tuplas que empiezan por el tipo de entrada y el user_id, p. ej.
+    ("conversations", user_id) o ("messages", user_id, conversation_id), de modo que cada
+    usuario solo ve las filas que se leyeron con su sesión (y por tanto con sus políticas RLS).
+    Los valores se guardan y se devuelven como copias.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict() # key -> (rows, size, expires_at)
+        self._lock = threading.RLock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Devuelve una copia de las filas cacheadas o None si no hay entrada válida."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            rows, _, expires_at = entry
+            if expires_at <= self._clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy_rows(rows)
+
+    def set(self, key, rows):
+        rows = copy_rows(rows)
+        size = estimate_size(rows)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (rows, size, self._clock() + self.ttl_seconds)
+            self.current_bytes += size
+            self._evict()
+
+    def update(self, key, mutate):
+        """Aplica `mutate(rows)` in situ a una entrada existente (sin renovar el TTL).
+
+        `mutate` devuelve la variación de tamaño en bytes (estimate_size de lo añadido menos lo
+        quitado), para no recorrer la entrada entera en cada escritura; si devuelve None se vuelve
+        a estimar la entrada completa. Si la entrada crece, se desalojan las menos usadas.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            rows, old_size, expires_at = entry
+            delta = mutate(rows)
+            size = estimate_size(rows) if delta is None else old_size + delta
+            self._entries[key] = (rows, size, expires_at)
+            self.current_bytes += size - old_size
+            if size > self.max_bytes:
+                self._remove(key)
+                self.evictions += 1
+            self._evict()
+            return True
+
+    def keys(self, kind):
+        with self._lock:
+            return [key for key in self._entries if key[0] == kind]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == user_id]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+@st.cache_resource
+def get_chat_cache():
+    """Caché compartida por todas las sesiones del proceso."""
+    return ChatCache()
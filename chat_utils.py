@@ -1,68 +1,300 @@
-from supabase_client import supabase 
-from openai import OpenAI 
-import google.generativeai as genai 
+from supabase_client import get_supabase
+from llm_clients import get_llm_client_registry, import_provider_sdk
+from write_queue import get_write_behind_queue, new_message_id
+from chat_cache import estimate_size, get_chat_cache
+from context_builder import build_context, token_counter
+from telemetry import span, timed, timed_stream, current_turn
+from response_cache import get_response_cache, make_cache_key
+from async_runtime import iterate_in_loop, iterate_sync, run_sync
+from llm_router import get_llm_router
+from rate_limits import (
+    RATE_LIMITED_MARKER, astream_with_rate_limit_retry, get_provider_concurrency, get_rate_limiter,
+    is_rate_limit_error, is_rate_limited_response
+)
+from legal_corpus import get_retriever
+from auto_titles import get_auto_titler
+import asyncio
 import os
+import time
+from datetime import datetime, timezone
 
 
 SYSTEM_PROMPT = "Eres LexIA, asistente jurídico especializado en Derecho español y europeo. Responde con lenguaje claro y, cuando proceda, menciona la norma o jurisprudencia aplicable."
-MAX_CONTEXT_MESSAGES = 10
+CONTEXT_TOKEN_BUDGET = int(os.getenv("LEXIA_CONTEXT_TOKEN_BUDGET", "8000")) # Tokens de entrada por petición
+SUMMARIZE_EVICTED_TURNS = os.getenv("LEXIA_SUMMARIZE_EVICTED_TURNS", "0") == "1"
+RESPONSE_CACHE_ENABLED = os.getenv("LEXIA_RESPONSE_CACHE", "0") == "1" # Caché de respuestas opt-in
+OPENAI_MODEL = "gpt-4.1-nano"
+GEMINI_MODEL = "gemini-1.5-flash"
+CONVERSATIONS_PAGE_SIZE = 30 # Conversaciones por página en la barra lateral
+MESSAGE_SEARCH_PAGE_SIZE = 20 # Resultados por página en la búsqueda de mensajes
+MESSAGES_PAGE_SIZE = 50 # Mensajes de la primera página; también es lo que ve el constructor de contexto del LLM
+AUTO_TITLES_WITH_LLM = os.getenv("LEXIA_AUTO_TITLES", "1") == "1" # 0: el título es el inicio de la consulta
+TITLE_MODELS = { # El modelo más barato de cada proveedor basta para un título
+    "openai": os.getenv("LEXIA_TITLE_MODEL_OPENAI", "gpt-4.1-nano"),
+    "gemini": os.getenv("LEXIA_TITLE_MODEL_GEMINI", "gemini-1.5-flash-8b")
+}
+TITLE_SYSTEM_PROMPT = "Escribe un título de 3 a 7 palabras, en español, que resuma el asunto jurídico de esta conversación. Responde solo con el título, sin comillas ni punto final."
+TITLE_INPUT_CHARS = 1200 # De la consulta y de la respuesta: con el principio de cada una basta
+TITLE_MAX_OUTPUT_TOKENS = 24
+
+# --- Cache ---
+# Las lecturas de conversaciones y mensajes se sirven desde una caché de proceso (chat_cache.py).
+# Cada escritura de este módulo actualiza la caché in situ en lugar de invalidarla entera: solo las
+# entradas del usuario que escribe, y devolviendo a ChatCache.update la variación de tamaño.
+
+def _conversations_key(user_id):
+    return ("conversations", user_id)
+
+def _conversations_meta_key(user_id):
+    # [{"complete": bool}]: indica si la lista cacheada contiene todas las conversaciones del usuario
+    return ("conversations_meta", user_id)
+
+def _messages_key(user_id, conversation_id):
+    return ("messages", user_id, conversation_id)
+
+def _messages_meta_key(user_id, conversation_id):
+    # [{"complete": bool}]: indica si la entrada de mensajes contiene el historial completo
+    return ("messages_meta", user_id, conversation_id)
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+def _rows_size(rows):
+    """Variación de tamaño de la caché al añadir (o, en negativo, quitar) estas filas de una entrada."""
+    return sum(estimate_size(row) for row in rows)
+
+def _set_meta_complete(meta, complete):
+    meta[0]["complete"] = complete
+    return 0
+
+def _cached_conversation_lists(user_id):
+    """Claves de las listas cacheadas que pueden contener una conversación: la de su dueño o, si la
+    llamada no indica user_id, las de todos los usuarios (recorrido completo, evitar en el camino caliente)."""
+    if user_id:
+        return [_conversations_key(user_id)]
+    return get_chat_cache().keys("conversations")
+
+def _cache_touch_conversation(user_id, conversation_id, title=None):
+    """Actualiza updated_at (y el título) en la lista cacheada y sube la conversación al principio."""
+    updated_at = _now_iso()
+    def mutate(rows):
+        for idx, row in enumerate(rows):
+            if row["id"] == conversation_id:
+                old_size = estimate_size(row)
+                if title is not None:
+                    row["title"] = title
+                row["updated_at"] = updated_at
+                rows.insert(0, rows.pop(idx))
+                return estimate_size(row) - old_size
+        return 0
+    cache = get_chat_cache()
+    for key in _cached_conversation_lists(user_id):
+        cache.update(key, mutate)
+
+def _cache_append_messages(user_id, conversation_id, rows):
+    created_at = _now_iso()
+    appended = [
+        {"id": row.get("id"), "role": row["role"], "content": row["content"], "created_at": created_at}
+        for row in rows
+    ]
+    def append(cached):
+        cached.extend(appended)
+        return _rows_size(appended)
+    get_chat_cache().update(_messages_key(user_id, conversation_id), append)
+    _cache_touch_conversation(user_id, conversation_id)
+
+def get_cache_stats():
+    """Contadores de aciertos/fallos y ocupación de la caché de conversaciones y mensajes."""
+    return get_chat_cache().stats()
 
 # --- Conversation Management ---
 
+@timed("db.create_conversation", kind="db_write")
 def create_conversation(user_id, title="Nueva Conversación"):
     """Crea una nueva conversación para un usuario."""
     try:
-        response = supabase.table("conversations").insert({
+        response = get_supabase().table("conversations").insert({
             "user_id": user_id,
             "title": title
             # created_at y updated_at tienen valores por defecto
         }).execute()
         if response.data:
-            return response.data[0] # Devuelve la conversación creada
+            created = response.data[0]
+            def prepend(rows):
+                rows.insert(0, dict(created))
+                return _rows_size([created])
+            get_chat_cache().update(_conversations_key(user_id), prepend)
+            return created # Devuelve la conversación creada
         return None
     except Exception as e:
         print(f"Error creando conversación para user_id {user_id}: {str(e)}")
         return None
 
+@timed("db.get_user_conversations", kind="db_read")
 def get_user_conversations(user_id):
     """Obtiene todas las conversaciones de un usuario, ordenadas por última actualización."""
+    cached = get_chat_cache().get(_conversations_key(user_id))
+    if cached is not None:
+        return cached
     try:
-        response = supabase.table("conversations") \
+        response = get_supabase().table("conversations") \
             .select("id, title, created_at, updated_at") \
             .eq("user_id", user_id) \
             .order("updated_at", desc=True) \
             .execute()
-        return response.data if response.data else []
+        conversations = response.data if response.data else []
+        get_chat_cache().set(_conversations_key(user_id), conversations)
+        get_chat_cache().set(_conversations_meta_key(user_id), [{"complete": True}])
+        return conversations
     except Exception as e:
         print(f"Error obteniendo conversaciones para user_id {user_id}: {str(e)}")
         return []
 
-def update_conversation_timestamp(conversation_id):
-    """Actualiza el campo updated_at de una conversación."""
+@timed("db.get_conversation", kind="db_read")
+def get_conversation(conversation_id, user_id):
+    """La conversación si existe y es de `user_id`; None si no (borrada o de otro usuario).
+
+    A diferencia de las demás lecturas, lanza excepción si la consulta falla: un error de la base
+    de datos no debe confundirse con una conversación inexistente.
+    """
+    response = get_supabase().table("conversations") \
+        .select("id, title, created_at, updated_at") \
+        .eq("id", conversation_id) \
+        .eq("user_id", user_id) \
+        .limit(1) \
+        .execute()
+    return response.data[0] if response.data else None
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _cached_conversations_page(user_id, limit, before):
+    """Intenta servir la página desde la lista cacheada (más reciente primero). Devuelve (filas, hay_más) o None."""
+    cache = get_chat_cache()
+    cached = cache.get(_conversations_key(user_id))
+    meta = cache.get(_conversations_meta_key(user_id))
+    if cached is None or meta is None:
+        return None
+    if before is None:
+        candidates = cached
+    else:
+        positions = [idx for idx, row in enumerate(cached) if row["id"] == before["id"]]
+        if not positions:
+            return None
+        candidates = cached[positions[0] + 1:]
+    if len(candidates) > limit:
+        return candidates[:limit], True
+    if meta[0]["complete"]:
+        return candidates, False
+    if len(candidates) == limit:
+        return candidates, True
+    return None
+
+@timed("db.get_user_conversations_page", kind="db_read")
+def get_user_conversations_page(user_id, limit=CONVERSATIONS_PAGE_SIZE, before=None, search=None):
+    """Obtiene una página de conversaciones (por updated_at descendente) con paginación por cursor.
+
+    Con `search`, filtra por título en el servidor (ilike) y no usa la caché. Devuelve
+    (conversaciones, cursor); cursor es None cuando no hay más páginas.
+    """
+    if not search:
+        cached_page = _cached_conversations_page(user_id, limit, before)
+        if cached_page is not None:
+            rows, has_more = cached_page
+            return rows, ({"updated_at": rows[-1]["updated_at"], "id": rows[-1]["id"]} if has_more and rows else None)
     try:
-        supabase.table("conversations") \
+        query = get_supabase().table("conversations") \
+            .select("id, title, created_at, updated_at") \
+            .eq("user_id", user_id)
+        if search:
+            query = query.ilike("title", f"%{_escape_like(search)}%")
+        if before is not None:
+            before_ts, before_id = before["updated_at"], before["id"]
+            query = query.or_(f'updated_at.lt."{before_ts}",and(updated_at.eq."{before_ts}",id.lt.{before_id})')
+        response = query \
+            .order("updated_at", desc=True) \
+            .order("id", desc=True) \
+            .limit(limit + 1) \
+            .execute()
+        fetched = response.data if response.data else []
+        has_more = len(fetched) > limit
+        rows = fetched[:limit]
+        cursor = {"updated_at": rows[-1]["updated_at"], "id": rows[-1]["id"]} if has_more and rows else None
+        if not search:
+            cache = get_chat_cache()
+            if before is None:
+                cache.set(_conversations_key(user_id), rows)
+                cache.set(_conversations_meta_key(user_id), [{"complete": not has_more}])
+            else:
+                # Solo ampliamos la lista cacheada si la página es contigua a ella
+                def extend(cached):
+                    if cached and cached[-1]["id"] == before["id"]:
+                        cached.extend(rows)
+                        return _rows_size(rows)
+                    return 0
+                if cache.update(_conversations_key(user_id), extend):
+                    cache.update(_conversations_meta_key(user_id), lambda meta: _set_meta_complete(meta, not has_more))
+        return rows, cursor
+    except Exception as e:
+        print(f"Error obteniendo página de conversaciones para user_id {user_id}: {str(e)}")
+        return [], None
+
+@timed("db.update_conversation_timestamp", kind="db_write")
+def update_conversation_timestamp(conversation_id, user_id=None):
+    """Actualiza el campo updated_at de una conversación.
+
+    Con user_id solo se toca la lista cacheada de ese usuario; sin él, las de todos.
+    """
+    try:
+        get_supabase().table("conversations") \
             .update({"updated_at": "now()"}) \
             .eq("id", conversation_id) \
             .execute()
+        _cache_touch_conversation(user_id, conversation_id)
     except Exception as e:
         print(f"Error actualizando timestamp para conversation_id {conversation_id}: {str(e)}")
 
-def delete_conversation_and_messages(conversation_id):
-    """Borra una conversación y sus mensajes (ON DELETE CASCADE está configurado)."""
+@timed("db.delete_conversation", kind="db_write")
+def delete_conversation_and_messages(conversation_id, user_id=None):
+    """Borra una conversación y sus mensajes (ON DELETE CASCADE está configurado).
+
+    Con user_id solo se tocan las entradas cacheadas de ese usuario; sin él, las de todos.
+    """
     try:
-        supabase.table("conversations").delete().eq("id", conversation_id).execute()
+        get_supabase().table("conversations").delete().eq("id", conversation_id).execute()
+        get_write_behind_queue(_write_turn_rows).discard_conversation(conversation_id)
+        def drop_conversation(rows):
+            removed = [row for row in rows if row["id"] == conversation_id]
+            if removed:
+                rows[:] = [row for row in rows if row["id"] != conversation_id]
+            return -_rows_size(removed)
+        cache = get_chat_cache()
+        for key in _cached_conversation_lists(user_id):
+            cache.update(key, drop_conversation)
+        if user_id:
+            cache.invalidate(_messages_key(user_id, conversation_id))
+            cache.invalidate(_messages_meta_key(user_id, conversation_id))
+        else:
+            for key in cache.keys("messages") + cache.keys("messages_meta"):
+                if key[2] == conversation_id:
+                    cache.invalidate(key)
         return None # Éxito
     except Exception as e:
         print(f"Error borrando conversación {conversation_id}: {str(e)}")
         return str(e) 
 
-def rename_conversation(conversation_id, new_title):
-    """Renombra una conversación."""
+@timed("db.rename_conversation", kind="db_write")
+def rename_conversation(conversation_id, new_title, user_id=None):
+    """Renombra una conversación.
+
+    Con user_id solo se toca la lista cacheada de ese usuario; sin él, las de todos.
+    """
     try:
-        supabase.table("conversations") \
+        get_supabase().table("conversations") \
             .update({"title": new_title, "updated_at": "now()"}) \
             .eq("id", conversation_id) \
             .execute()
+        _cache_touch_conversation(user_id, conversation_id, title=new_title)
         return None
     except Exception as e:
         print(f"Error renombrando conversación {conversation_id}: {str(e)}")
@@ -70,92 +302,699 @@ def rename_conversation(conversation_id, new_title):
 
 # --- Message Management ---
 
+@timed("db.save_message", kind="db_write")
 def save_message(user_id, conversation_id, role, content): 
     """Guarda un mensaje en una conversación específica."""
     try:
-        supabase.table("messages").insert({
+        message_id = new_message_id()
+        get_supabase().table("messages").insert({
+            "id": message_id,
             "user_id": user_id, 
             "conversation_id": conversation_id,
             "role": role,
             "content": content
         }).execute()
+        _cache_append_messages(user_id, conversation_id, [{"id": message_id, "role": role, "content": content}])
         # Después de guardar el mensaje, actualiza el timestamp de la conversación
-        update_conversation_timestamp(conversation_id)
+        update_conversation_timestamp(conversation_id, user_id)
         return None
     except Exception as e:
         print(f"Error guardando mensaje en conv {conversation_id}: {str(e)}")
         return str(e)
 
-def get_messages_for_conversation(conversation_id):
-    """Obtiene todos los mensajes de una conversación específica, ordenados cronológicamente."""
+@timed("db.save_turn_rpc", kind="db_write")
+def _write_turn_rows(user_id, conversation_id, rows, title=None):
+    """Llama a la RPC `save_turn` (ver README). Lanza excepción si falla."""
+    get_supabase().rpc("save_turn", {
+        "p_user_id": user_id,
+        "p_conversation_id": conversation_id,
+        "p_messages": rows,
+        "p_title": title
+    }).execute()
+
+def save_turn(user_id, conversation_id, user_msg, assistant_msg, new_title=None):
+    """Guarda un turno completo (mensaje del usuario + respuesta) en un único round trip.
+
+    Usa la función RPC `save_turn` (ver README): inserta ambos mensajes en bloque y actualiza
+    updated_at (y el título, si se indica) de la conversación en la misma transacción.
+    """
+    return save_turn_messages(user_id, conversation_id, [
+        {"id": new_message_id(), "role": "user", "content": user_msg},
+        {"id": new_message_id(), "role": "assistant", "content": assistant_msg}
+    ], new_title)
+
+def save_turn_messages(user_id, conversation_id, rows, new_title=None):
+    """Guarda parte de un turno (filas con id, role y content) con la RPC `save_turn`.
+
+    arun_turn la usa para guardar el mensaje del usuario mientras el LLM genera la respuesta.
+    """
+    try:
+        _write_turn_rows(user_id, conversation_id, rows, new_title)
+        _cache_append_messages(user_id, conversation_id, rows)
+        if new_title is not None:
+            _cache_touch_conversation(user_id, conversation_id, title=new_title)
+        return None
+    except Exception as e:
+        print(f"Error guardando turno en conv {conversation_id}: {str(e)}")
+        return str(e)
+
+@timed("db.discard_messages", kind="db_write")
+def _discard_messages(user_id, conversation_id, message_ids):
+    """Borra mensajes ya guardados de un turno que no se completa (el aviso de 429 no se guarda)."""
+    try:
+        get_supabase().table("messages").delete().in_("id", message_ids).execute()
+    except Exception as e:
+        print(f"Error borrando mensajes de conv {conversation_id}: {str(e)}")
+    cache = get_chat_cache()
+    cache.invalidate(_messages_key(user_id, conversation_id))
+    cache.invalidate(_messages_meta_key(user_id, conversation_id))
+
+def queue_turn(user_id, conversation_id, user_msg, assistant_msg, new_title=None):
+    """Encola el turno en la cola de escritura diferida; no bloquea la UI.
+
+    Devuelve None si se encoló o el mensaje de error si la cola no acepta más escrituras.
+    """
+    try:
+        rows = get_write_behind_queue(_write_turn_rows).enqueue_turn(user_id, conversation_id, [
+            {"role": "user", "content": user_msg},
+            {"role": "assistant", "content": assistant_msg}
+        ], new_title)
+        # La caché refleja el turno de inmediato, aunque la escritura aún esté pendiente
+        _cache_append_messages(user_id, conversation_id, rows)
+        if new_title is not None:
+            _cache_touch_conversation(user_id, conversation_id, title=new_title)
+        return None
+    except Exception as e:
+        print(f"Error encolando turno en conv {conversation_id}: {str(e)}")
+        return str(e)
+
+def note_remote_turn(user_id, conversation_id, new_title=None):
+    """Refleja en la caché un turno que guardó otro proceso (la API de api_server.py)."""
+    cache = get_chat_cache()
+    cache.invalidate(_messages_key(user_id, conversation_id))
+    cache.invalidate(_messages_meta_key(user_id, conversation_id))
+    _cache_touch_conversation(user_id, conversation_id, title=new_title)
+
+def get_persistence_stats():
+    """Profundidad y retraso de la cola de escritura diferida."""
+    return get_write_behind_queue(_write_turn_rows).stats()
+
+@timed("db.get_messages_for_conversation", kind="db_read")
+def get_messages_for_conversation(conversation_id, user_id=None):
+    """Obtiene todos los mensajes de una conversación específica, ordenados cronológicamente.
+
+    Si se indica user_id, la lectura se sirve (y se guarda) en la caché de ese usuario.
+    """
+    cache_key = _messages_key(user_id, conversation_id) if user_id else None
+    if cache_key:
+        cached = get_chat_cache().get(cache_key)
+        if cached is not None:
+            return [{"role": msg["role"], "content": msg["content"]} for msg in cached]
     try:
-        response = supabase.table("messages") \
-            .select("role, content, created_at") \
+        response = get_supabase().table("messages") \
+            .select("id, role, content, created_at") \
             .eq("conversation_id", conversation_id) \
             .order("created_at", desc=False) \
             .execute()
+        rows = response.data if response.data else []
+        # Añadimos los mensajes que aún están en la cola de escritura diferida
+        stored_ids = {msg["id"] for msg in rows}
+        pending = get_write_behind_queue(_write_turn_rows).pending_messages(conversation_id)
+        rows.extend(msg for msg in pending if msg["id"] not in stored_ids)
+        if cache_key:
+            get_chat_cache().set(cache_key, rows)
+            get_chat_cache().set(_messages_meta_key(user_id, conversation_id), [{"complete": True}])
         # Devolvemos solo role y content para mantener la estructura que espera la UI
-        return [{"role": msg["role"], "content": msg["content"]} for msg in response.data] if response.data else []
+        return [{"role": msg["role"], "content": msg["content"]} for msg in rows]
     except Exception as e:
         print(f"Error obteniendo mensajes para conv {conversation_id}: {str(e)}")
         return []
 
+def _page_cursor(row):
+    return {"created_at": row["created_at"], "id": row["id"]}
+
+def _cached_messages_page(user_id, conversation_id, limit, before):
+    """Intenta servir la página desde la caché. Devuelve (filas, hay_anteriores) o None."""
+    cache = get_chat_cache()
+    cached = cache.get(_messages_key(user_id, conversation_id))
+    meta = cache.get(_messages_meta_key(user_id, conversation_id))
+    if cached is None or meta is None:
+        return None
+    if before is None:
+        candidates = cached
+    else:
+        positions = [idx for idx, row in enumerate(cached) if row.get("id") == before["id"]]
+        if not positions:
+            return None
+        candidates = cached[:positions[0]]
+    if len(candidates) > limit:
+        return candidates[-limit:], True
+    if meta[0]["complete"]:
+        return candidates, False
+    if len(candidates) == limit:
+        return candidates, True
+    return None
+
+@timed("db.get_messages_page", kind="db_read")
+def get_messages_page(conversation_id, limit=MESSAGES_PAGE_SIZE, before=None, user_id=None):
+    """Obtiene una página de mensajes con paginación por cursor (keyset sobre created_at, id).
+
+    Devuelve (mensajes, cursor): los `limit` mensajes más recientes anteriores a `before`, en orden
+    cronológico, y el cursor para pedir la página anterior (None si no quedan mensajes más antiguos).
+    Con user_id, la ventana cargada se guarda en la caché y las páginas siguientes la amplían.
+    """
+    if user_id:
+        cached_page = _cached_messages_page(user_id, conversation_id, limit, before)
+        if cached_page is not None:
+            rows, has_older = cached_page
+            cursor = _page_cursor(rows[0]) if has_older and rows else None
+            return [{"role": msg["role"], "content": msg["content"]} for msg in rows], cursor
+    try:
+        query = get_supabase().table("messages") \
+            .select("id, role, content, created_at") \
+            .eq("conversation_id", conversation_id)
+        if before is not None:
+            before_ts, before_id = before["created_at"], before["id"]
+            query = query.or_(f'created_at.lt."{before_ts}",and(created_at.eq."{before_ts}",id.lt.{before_id})')
+        response = query \
+            .order("created_at", desc=True) \
+            .order("id", desc=True) \
+            .limit(limit + 1) \
+            .execute()
+        fetched = response.data if response.data else []
+        has_older = len(fetched) > limit
+        rows = list(reversed(fetched[:limit]))
+        cursor = _page_cursor(rows[0]) if has_older and rows else None
+
+        if before is None:
+            stored_ids = {msg["id"] for msg in rows}
+            pending = get_write_behind_queue(_write_turn_rows).pending_messages(conversation_id)
+            rows.extend(msg for msg in pending if msg["id"] not in stored_ids)
+        if user_id:
+            cache = get_chat_cache()
+            if before is None:
+                cache.set(_messages_key(user_id, conversation_id), rows)
+                cache.set(_messages_meta_key(user_id, conversation_id), [{"complete": not has_older}])
+            else:
+                # Solo ampliamos la ventana cacheada si la página es contigua a ella
+                def prepend(cached):
+                    if cached and cached[0].get("id") == before["id"]:
+                        cached[:0] = rows
+                        return _rows_size(rows)
+                    return 0
+                if cache.update(_messages_key(user_id, conversation_id), prepend):
+                    cache.update(
+                        _messages_meta_key(user_id, conversation_id),
+                        lambda meta: _set_meta_complete(meta, not has_older)
+                    )
+        return [{"role": msg["role"], "content": msg["content"]} for msg in rows], cursor
+    except Exception as e:
+        print(f"Error obteniendo página de mensajes para conv {conversation_id}: {str(e)}")
+        return [], None
+
+@timed("db.search_messages", kind="db_read")
+def search_messages(user_id, query, limit=MESSAGE_SEARCH_PAGE_SIZE, cursor=None):
+    """Búsqueda de texto completo en todos los mensajes del usuario (RPC search_messages del README).
+
+    Devuelve (resultados, cursor): resultados ordenados por relevancia con message_id,
+    conversation_id, conversation_title, role, created_at, rank, snippet (fragmento con las
+    coincidencias en **negrita**) y content_md5; y el cursor de la página siguiente (o None).
+    Los turnos que siguen en la cola de escritura diferida aparecen cuando se guardan.
+    """
+    query = (query or "").strip()
+    if not query:
+        return [], None
+    try:
+        response = get_supabase().rpc("search_messages", {
+            "p_user_id": user_id,
+            "p_query": query,
+            "p_limit": limit + 1,
+            "p_cursor_rank": cursor["rank"] if cursor else None,
+            "p_cursor_id": cursor["message_id"] if cursor else None
+        }).execute()
+        fetched = response.data if response.data else []
+        results = fetched[:limit]
+        next_cursor = None
+        if len(fetched) > limit and results:
+            next_cursor = {"rank": results[-1]["rank"], "message_id": results[-1]["message_id"]}
+        return results, next_cursor
+    except Exception as e:
+        print(f"Error buscando mensajes para user_id {user_id}: {str(e)}")
+        return [], None
+
 
 # --- LLM Interaction ---
 
-def _get_openai_response(chat_history_for_llm, api_key):
-    client = OpenAI(api_key=api_key)
-    messages_to_send = [{"role": "system", "content": SYSTEM_PROMPT}]
-    start_index = max(0, len(chat_history_for_llm) - MAX_CONTEXT_MESSAGES)
-    messages_to_send.extend(chat_history_for_llm[start_index:])
+def _retrieve_passages(chat_history_for_llm):
+    """Pasajes de normativa para la última consulta del usuario (None si no hay índice RAG o nada pertinente)."""
+    retriever = get_retriever()
+    if retriever is None:
+        return None
+    query = next((msg["content"] for msg in reversed(chat_history_for_llm) if msg["role"] == "user"), None)
     try:
-        response = client.chat.completions.create(
-            model="gpt-4.1-nano",
-            messages=messages_to_send,
+        with span("rag.retrieve", kind="rag"):
+            return retriever.context_for(query)
+    except Exception as e:
+        print(f"Error recuperando normativa: {str(e)}")
+        return None
+
+def build_llm_context(chat_history_for_llm, provider):
+    """Contexto que se envía al proveedor: (mensajes, resumen, pasajes recuperados).
+
+    Los pasajes se descuentan del presupuesto de tokens antes de elegir el historial. Construirlo
+    cuesta la recuperación y el recuento de tokens de todo el historial, así que se construye una
+    vez por turno y se pasa como `llm_context` a los límites, la caché y el proveedor.
+    """
+    passages = _retrieve_passages(chat_history_for_llm)
+    token_budget = CONTEXT_TOKEN_BUDGET - (token_counter.count(passages, provider) if passages else 0)
+    context, summary = build_context(
+        chat_history_for_llm, provider=provider, token_budget=token_budget,
+        system_prompt=SYSTEM_PROMPT, summarize=SUMMARIZE_EVICTED_TURNS
+    )
+    return context, summary, passages
+
+def _build_openai_messages(chat_history_for_llm, llm_context=None):
+    context, summary, passages = llm_context or build_llm_context(chat_history_for_llm, "openai")
+    messages_to_send = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if passages:
+        messages_to_send.append({"role": "system", "content": passages})
+    if summary:
+        messages_to_send.append({"role": "system", "content": summary})
+    messages_to_send.extend(context)
+    return messages_to_send
+
+def _build_gemini_history(chat_history_for_llm, llm_context=None):
+    context, summary, passages = llm_context or build_llm_context(chat_history_for_llm, "gemini")
+    gemini_formatted_history = []
+    for msg in context:
+        role = "model" if msg["role"] == "assistant" else msg["role"]
+        gemini_formatted_history.append({"role": role, "parts": [msg["content"]]})
+    if summary and gemini_formatted_history:
+        # Gemini no admite mensajes de sistema en el historial: anteponemos el resumen al primer mensaje
+        gemini_formatted_history[0]["parts"].insert(0, summary)
+    if passages and gemini_formatted_history:
+        # Los pasajes van junto a la consulta a la que responden (el último mensaje)
+        gemini_formatted_history[-1]["parts"].insert(0, passages)
+    return gemini_formatted_history
+
+def _get_gemini_model(api_key):
+    return get_llm_client_registry().get_gemini_model(
+        api_key,
+        GEMINI_MODEL,
+        system_instruction=SYSTEM_PROMPT,
+        generation_config=import_provider_sdk("gemini").types.GenerationConfig(
             temperature=0.4,
-            max_tokens=4096 #8000
+            max_output_tokens=4096 #8000
         )
-        return response.choices[0].message.content
+    )
+
+def _gemini_error_message(e):
+    if "API_KEY_INVALID" in str(e).upper() or "API KEY NOT VALID" in str(e).upper():
+        return "Error con Gemini: API Key inválida o no configurada."
+    if "PERMISSION_DENIED" in str(e).upper():
+        return "Error con Gemini: Permiso denegado."
+    return f"Error con Gemini: {str(e)}"
+
+# --- Response Cache ---
+
+def _is_error_response(text):
+    """Las respuestas de error se devuelven como texto; nunca deben cachearse."""
+    return not text or text.startswith("Error") or text.startswith("Proveedor LLM")
+
+def _response_cache_key(chat_history_for_llm, provider, llm_context=None):
+    # La clave usa exactamente el contexto que se enviaría al proveedor (incluidos los pasajes recuperados)
+    context, summary, passages = llm_context or build_llm_context(chat_history_for_llm, provider)
+    if summary:
+        context = [{"role": "system", "content": summary}] + context
+    if passages:
+        context = [{"role": "system", "content": passages}] + context
+    model = OPENAI_MODEL if provider == "openai" else GEMINI_MODEL
+    return make_cache_key(provider, model, SYSTEM_PROMPT, context)
+
+def get_cached_llm_response(chat_history_for_llm, provider="openai", llm_context=None):
+    """Devuelve la respuesta cacheada para este contexto o None (también si la caché está desactivada)."""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    try:
+        return get_response_cache().get(_response_cache_key(chat_history_for_llm, provider, llm_context))
     except Exception as e:
-        print(f"Error en _get_openai_response: {str(e)}")
+        print(f"Error leyendo la caché de respuestas: {str(e)}")
+        return None
+
+def store_llm_response(chat_history_for_llm, provider, response_content, llm_context=None):
+    """Guarda una respuesta correcta del LLM en la caché de respuestas."""
+    if not RESPONSE_CACHE_ENABLED or _is_error_response(response_content):
+        return
+    try:
+        get_response_cache().set(_response_cache_key(chat_history_for_llm, provider, llm_context), response_content)
+    except Exception as e:
+        print(f"Error guardando en la caché de respuestas: {str(e)}")
+
+# --- LLM Streaming ---
+
+async def _astream_openai_raw(chat_history_for_llm, api_key, llm_context=None):
+    client = get_llm_client_registry().get_openai_client(api_key, OPENAI_MODEL)
+    messages_to_send = _build_openai_messages(chat_history_for_llm, llm_context)
+    stream = await client.chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=messages_to_send,
+        temperature=0.4,
+        max_tokens=4096,
+        stream=True
+    )
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+async def _astream_gemini_raw(chat_history_for_llm, api_key, llm_context=None):
+    model = _get_gemini_model(api_key)
+    gemini_formatted_history = _build_gemini_history(chat_history_for_llm, llm_context)
+    if not gemini_formatted_history:
+        raise ValueError("El historial inicial está vacío, no se puede generar respuesta.")
+    response = await model.generate_content_async(gemini_formatted_history, stream=True)
+    async for chunk in response:
+        # Los chunks bloqueados por seguridad no tienen texto y .text lanza excepción
+        if chunk.parts:
+            yield chunk.text
+
+# Generadores "crudos" por proveedor: lanzan excepción en caso de error (los usa el router).
+# `llm_context` es el de build_llm_context para ese proveedor, o None para que lo construya él
+LLM_STREAM_PROVIDERS = {
+    "openai": _astream_openai_raw,
+    "gemini": _astream_gemini_raw
+}
+
+def _provider_error_message(provider, e):
+    if is_rate_limit_error(e):
+        name = {"openai": "OpenAI", "gemini": "Gemini"}.get(provider, provider)
+        return f"Error con {name}: {RATE_LIMITED_MARKER}. Espera unos segundos y vuelve a intentarlo."
+    if provider == "gemini":
+        return _gemini_error_message(e)
+    if provider == "openai":
         return f"Error con OpenAI: {str(e)}"
+    return f"Error con {provider}: {str(e)}"
+
+def _open_provider_stream(provider, api_key, chat_history_for_llm, llm_context=None):
+    return LLM_STREAM_PROVIDERS[provider](chat_history_for_llm, api_key, llm_context=llm_context)
+
+async def astream_llm_response(chat_history_for_llm, api_key, provider="openai", fallback=None, hedge=False,
+                               retries=None, llm_context=None):
+    """Genera la respuesta del LLM fragmento a fragmento (generador asíncrono de str).
+
+    Con `fallback=(proveedor, api_key)` la petición pasa por el router (llm_router.py): si el
+    proveedor principal falla, tiene el circuito abierto o no da el primer token a tiempo se usa el
+    secundario; con hedge=True además se lanza el secundario en paralelo si el principal tarda más
+    que su p95 histórico en dar el primer token, y se cancela el que pierda.
+
+    `llm_context` (build_llm_context) es el contexto ya construido para `provider`; el de respaldo,
+    si llega a usarse, construye el suyo.
 
-def _get_gemini_response(chat_history_for_llm, api_key):
+    Sin proveedor de respaldo, los 429 se reintentan con backoff exponencial y jitter hasta
+    `retries` veces (por defecto rate_limits.RATE_LIMIT_RETRIES); con respaldo, el router cambia
+    de proveedor en su lugar.
+
+    Los errores se emiten como un último fragmento de texto, para que la UI pueda mostrarlos y
+    guardarlos sin tratamiento especial; el aviso de 429 (ver rate_limits.is_rate_limited_response)
+    se muestra pero no se guarda.
+    """
+    if provider not in LLM_STREAM_PROVIDERS:
+        yield f"Proveedor LLM '{provider}' no soportado."
+        return
+    candidates = [(provider, api_key)]
+    if fallback and fallback[0] in LLM_STREAM_PROVIDERS and fallback[1] and fallback[0] != provider:
+        candidates.append(tuple(fallback))
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            system_instruction=SYSTEM_PROMPT,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.4,
-                max_output_tokens=4096 #8000
+        if len(candidates) == 1:
+            stream = astream_with_rate_limit_retry(
+                lambda: _open_provider_stream(provider, api_key, chat_history_for_llm, llm_context),
+                retries=retries
+            )
+        else:
+            stream = get_llm_router().astream(
+                candidates,
+                lambda name, key: _open_provider_stream(
+                    name, key, chat_history_for_llm, llm_context if name == provider else None
+                ),
+                hedge=hedge
             )
+        async for chunk in stream:
+            yield chunk
+    except Exception as e:
+        failed_provider = getattr(e, "provider", provider)
+        print(f"Error en astream_llm_response ({failed_provider}): {str(e)}")
+        yield _provider_error_message(failed_provider, e)
+
+async def aget_llm_response(chat_history_for_llm, api_key, provider="openai", fallback=None, hedge=False):
+    """Respuesta completa (sin streaming): une los fragmentos de astream_llm_response."""
+    return "".join([chunk async for chunk in astream_llm_response(chat_history_for_llm, api_key, provider, fallback, hedge)])
+
+def get_llm_response(chat_history_for_llm, api_key, provider="openai", fallback=None, hedge=False):
+    """Versión síncrona de aget_llm_response, en el event loop compartido (async_runtime)."""
+    return run_sync(aget_llm_response(chat_history_for_llm, api_key, provider, fallback, hedge))
+
+def count_input_tokens(chat_history_for_llm, provider="openai", llm_context=None):
+    """Tokens de entrada de la petición tal como se enviará (prompt, historial recortado, resumen y pasajes)."""
+    context, summary, passages = llm_context or build_llm_context(chat_history_for_llm, provider)
+    return token_counter.count(SYSTEM_PROMPT, provider) \
+        + sum(token_counter.message_tokens(msg, provider) for msg in context) \
+        + (token_counter.count(summary, provider) if summary else 0) \
+        + (token_counter.count(passages, provider) if passages else 0)
+
+def stream_llm_response(chat_history_for_llm, api_key, provider="openai", fallback=None, hedge=False, llm_context=None):
+    """Versión síncrona de astream_llm_response (para st.write_stream).
+
+    Si hay un turno abierto en telemetry, registra tokens de entrada/salida, time-to-first-token
+    y tiempo total de generación.
+    """
+    turn = current_turn()
+    if provider in LLM_STREAM_PROVIDERS and llm_context is None:
+        llm_context = build_llm_context(chat_history_for_llm, provider)
+    if turn is not None and provider in LLM_STREAM_PROVIDERS:
+        turn.tokens_in = count_input_tokens(chat_history_for_llm, provider, llm_context)
+    yield from timed_stream(
+        iterate_sync(astream_llm_response(chat_history_for_llm, api_key, provider, fallback, hedge, llm_context=llm_context)),
+        tokens_out=lambda text: token_counter.count(text, provider)
+    )
+
+# --- Títulos automáticos ---
+
+def _title_request_text(prompt, answer):
+    return f"Consulta: {prompt[:TITLE_INPUT_CHARS]}\n\nRespuesta: {answer[:TITLE_INPUT_CHARS]}"
+
+async def _atitle_openai(text, api_key):
+    model = TITLE_MODELS["openai"]
+    response = await get_llm_client_registry().get_openai_client(api_key, model).chat.completions.create(
+        model=model,
+        messages=[{"role": "system", "content": TITLE_SYSTEM_PROMPT}, {"role": "user", "content": text}],
+        temperature=0.2,
+        max_tokens=TITLE_MAX_OUTPUT_TOKENS
+    )
+    return response.choices[0].message.content
+
+async def _atitle_gemini(text, api_key):
+    model = get_llm_client_registry().get_gemini_model(
+        api_key,
+        TITLE_MODELS["gemini"],
+        system_instruction=TITLE_SYSTEM_PROMPT,
+        generation_config=import_provider_sdk("gemini").types.GenerationConfig(
+            temperature=0.2,
+            max_output_tokens=TITLE_MAX_OUTPUT_TOKENS
         )
-        gemini_formatted_history = []
-        start_index = max(0, len(chat_history_for_llm) - MAX_CONTEXT_MESSAGES)
-        relevant_history = chat_history_for_llm[start_index:]
-        for msg in relevant_history:
-            role = "model" if msg["role"] == "assistant" else msg["role"]
-            gemini_formatted_history.append({"role": role, "parts": [msg["content"]]})
-        
-        if not gemini_formatted_history and not chat_history_for_llm : # Si no hay historial Y el prompt original está vacío (no debería pasar en el flujo normal)
-             return "Error: El historial inicial está vacío, no se puede generar respuesta."
-
-        response = model.generate_content(gemini_formatted_history)
-        return response.text
-    except Exception as e:
-        print(f"Error en _get_gemini_response: {str(e)}")
-        # ... (manejo de errores de API key) ...
-        if "API_KEY_INVALID" in str(e).upper() or "API KEY NOT VALID" in str(e).upper():
-             return "Error con Gemini: API Key inválida o no configurada."
-        if "PERMISSION_DENIED" in str(e).upper():
-            return "Error con Gemini: Permiso denegado."
-        return f"Error con Gemini: {str(e)}"
-
-def get_llm_response(chat_history_for_llm, api_key, provider="openai"):
-    if provider == "openai":
-        return _get_openai_response(chat_history_for_llm, api_key)
-    elif provider == "gemini":
-        return _get_gemini_response(chat_history_for_llm, api_key)
+    )
+    response = await model.generate_content_async(text)
+    return response.text
+
+# Como LLM_STREAM_PROVIDERS: lanzan excepción en caso de error (AutoTitler usa entonces el inicio de la consulta)
+LLM_TITLE_PROVIDERS = {
+    "openai": _atitle_openai,
+    "gemini": _atitle_gemini
+}
+
+async def _agenerate_title(job):
+    if not AUTO_TITLES_WITH_LLM or job["provider"] not in LLM_TITLE_PROVIDERS:
+        return None
+    text = _title_request_text(job["prompt"], job["answer"])
+    title = await LLM_TITLE_PROVIDERS[job["provider"]](text, job["api_key"])
+    # La llamada usa la API Key del usuario: cuenta para sus límites de tokens por minuto
+    get_rate_limiter().record_usage(
+        job["user_id"], job["api_key"],
+        token_counter.count(text, job["provider"]) + token_counter.count(title or "", job["provider"])
+    )
+    return title
+
+@timed("db.rename_conversations_rpc", kind="db_write")
+def _write_titles(user_id, renames):
+    """Llama a la RPC `rename_conversations` (ver README) con todos los títulos del lote de un usuario.
+
+    Devuelve los ids renombrados; lanza excepción si la escritura falla.
+    """
+    response = get_supabase().rpc("rename_conversations", {"p_renames": renames}).execute()
+    renamed = {row["id"] for row in response.data or []}
+    for rename in renames:
+        if rename["id"] in renamed:
+            _cache_rename_conversation(user_id, rename["id"], rename["title"])
+    return renamed
+
+def _cache_rename_conversation(user_id, conversation_id, title):
+    # A diferencia de _cache_touch_conversation no cambia updated_at ni el orden: renombrar no es actividad
+    def mutate(rows):
+        for row in rows:
+            if row["id"] == conversation_id:
+                old_size = estimate_size(row["title"])
+                row["title"] = title
+                return estimate_size(title) - old_size
+        return 0
+    get_chat_cache().update(_conversations_key(user_id), mutate)
+
+def request_auto_title(user_id, conversation_id, prompt, answer, provider, api_key, expected_title):
+    """Pide en segundo plano un título para la conversación a partir de su primer turno.
+
+    No bloquea: el título se genera con el modelo barato del proveedor y se guarda en lote
+    (auto_titles.py) solo si la conversación sigue llamándose `expected_title`. Devuelve None o el
+    mensaje de error si no se pudo encolar.
+    """
+    try:
+        get_auto_titler(_agenerate_title, _write_titles).request(
+            user_id, conversation_id, prompt, answer, provider, api_key, expected_title
+        )
+        return None
+    except Exception as e:
+        print(f"Error pidiendo el título de conv {conversation_id}: {str(e)}")
+        return str(e)
+
+def get_auto_title_updates(conversation_ids):
+    """Títulos ya guardados de entre `conversation_ids`. Devuelve ({id: título}, ids aún pendientes)."""
+    titler = get_auto_titler(_agenerate_title, _write_titles)
+    ready, pending = {}, set()
+    for conversation_id in conversation_ids:
+        # Primero is_pending: el resultado se publica antes de que la petición deje de estar pendiente
+        still_pending = titler.is_pending(conversation_id)
+        title = titler.result(conversation_id)
+        if title is not None:
+            ready[conversation_id] = title
+        elif still_pending:
+            pending.add(conversation_id)
+    return ready, pending
+
+def get_auto_title_stats():
+    return get_auto_titler(_agenerate_title, _write_titles).stats()
+
+# --- Límites de uso ---
+
+def acquire_rate_limit(user_id, api_key, chat_history_for_llm, provider="openai", llm_context=None):
+    """Admite (o no) una petición al LLM según los límites por usuario y por API Key.
+
+    Devuelve (admitida, segundos de espera, ámbito del límite: "user" o "api_key").
+    """
+    tokens = count_input_tokens(chat_history_for_llm, provider, llm_context) if provider in LLM_STREAM_PROVIDERS else 0
+    return get_rate_limiter().acquire(user_id, api_key, tokens)
+
+def record_llm_usage(user_id, api_key, response_content, provider="openai"):
+    """Cobra a los límites de tokens por minuto los tokens de salida de una respuesta."""
+    if response_content:
+        get_rate_limiter().record_usage(user_id, api_key, token_counter.count(response_content, provider))
+
+def reserve_llm_slot(provider):
+    """Plaza en el semáforo del proveedor (o puesto en su cola); hay que liberarla con release()."""
+    return get_provider_concurrency().reserve(provider)
+
+# --- Async API ---
+# El cliente Supabase es síncrono, así que las contrapartes asíncronas de la BD ejecutan las funciones
+# síncronas en un hilo del executor. asyncio.to_thread copia el contexto: el cliente de la petición
+# (supabase_client.use_client) sigue activo en el hilo.
+
+async def acreate_conversation(user_id, title="Nueva Conversación"):
+    return await asyncio.to_thread(create_conversation, user_id, title)
+
+async def aget_conversation(conversation_id, user_id):
+    return await asyncio.to_thread(get_conversation, conversation_id, user_id)
+
+async def aget_user_conversations(user_id):
+    return await asyncio.to_thread(get_user_conversations, user_id)
+
+async def adelete_conversation_and_messages(conversation_id, user_id=None):
+    return await asyncio.to_thread(delete_conversation_and_messages, conversation_id, user_id)
+
+async def arename_conversation(conversation_id, new_title, user_id=None):
+    return await asyncio.to_thread(rename_conversation, conversation_id, new_title, user_id)
+
+async def asave_message(user_id, conversation_id, role, content):
+    return await asyncio.to_thread(save_message, user_id, conversation_id, role, content)
+
+async def asave_turn(user_id, conversation_id, user_msg, assistant_msg, new_title=None):
+    return await asyncio.to_thread(save_turn, user_id, conversation_id, user_msg, assistant_msg, new_title)
+
+async def asave_turn_messages(user_id, conversation_id, rows, new_title=None):
+    return await asyncio.to_thread(save_turn_messages, user_id, conversation_id, rows, new_title)
+
+async def aget_messages_page(conversation_id, limit=MESSAGES_PAGE_SIZE, before=None, user_id=None):
+    return await asyncio.to_thread(get_messages_page, conversation_id, limit, before, user_id)
+
+async def arun_turn(user_id, conversation_id, chat_history_for_llm, api_key, provider="openai", fallback=None,
+                    hedge=False, new_title=None, on_chunk=None, on_queue_position=None, use_cache=True,
+                    llm_context=None):
+    """Turno completo asíncrono (lo usa api_server.post_message): respuesta del LLM y guardado.
+
+    El mensaje del usuario y el título se guardan (un round trip) mientras el LLM genera la
+    respuesta, en lugar de antes; al terminar se guarda la respuesta (otro round trip) a la vez
+    que se guarda en la caché de respuestas. La respuesta sale de esa caché o de
+    astream_llm_response (router, reintentos de 429) con una plaza del límite de concurrencia del
+    proveedor; cada fragmento se pasa a `await on_chunk(texto)` y, mientras espera plaza, el
+    puesto en cola a `on_queue_position`. Con un 429 persistente el turno no se guarda: el
+    mensaje del usuario ya guardado se borra. Con use_cache=False (el usuario la ha desactivado)
+    no se lee ni se escribe la caché de respuestas.
+
+    `chat_history_for_llm` debe terminar con el mensaje del usuario; `llm_context` es el de
+    build_llm_context si ya se construyó (p. ej. para acquire_rate_limit), y si no se construye
+    aquí una sola vez para la caché y el proveedor. Devuelve (respuesta, error);
+    error es None o el primer error de guardado. Si hay un turno abierto en telemetry registra
+    ttft y tiempo de generación.
+    """
+    turn = current_turn()
+    user_row = {"id": new_message_id(), "role": "user", "content": chat_history_for_llm[-1]["content"]}
+    user_side = asyncio.create_task(asave_turn_messages(user_id, conversation_id, [user_row], new_title))
+    started = time.perf_counter()
+    parts = []
+
+    async def emit(chunk):
+        if not parts and turn is not None:
+            turn.ttft_ms = round((time.perf_counter() - started) * 1000, 2)
+        parts.append(chunk)
+        if on_chunk is not None:
+            await on_chunk(chunk)
+
+    if llm_context is None and provider in LLM_STREAM_PROVIDERS:
+        llm_context = await asyncio.to_thread(build_llm_context, chat_history_for_llm, provider)
+    use_cache = use_cache and RESPONSE_CACHE_ENABLED
+    cached = await asyncio.to_thread(get_cached_llm_response, chat_history_for_llm, provider, llm_context) \
+        if use_cache else None
+    if cached is not None:
+        await emit(cached)
     else:
-        return f"Proveedor LLM '{provider}' no soportado."
\ No newline at end of file
+        with reserve_llm_slot(provider) as llm_slot:
+            await llm_slot.wait_async(on_queue_position)
+            async for chunk in iterate_in_loop(astream_llm_response(
+                chat_history_for_llm, api_key, provider, fallback, hedge, llm_context=llm_context
+            )):
+                await emit(chunk)
+    if turn is not None:
+        turn.generation_ms = round((time.perf_counter() - started) * 1000, 2)
+    response_content = "".join(parts)
+    save_error = await user_side
+    if is_rate_limited_response(response_content):
+        if save_error is None:
+            await asyncio.to_thread(_discard_messages, user_id, conversation_id, [user_row["id"]])
+        return response_content, None
+    if cached is None:
+        record_llm_usage(user_id, api_key, response_content, provider)
+    assistant_row = {"id": new_message_id(), "role": "assistant", "content": response_content}
+    assistant_error, _ = await asyncio.gather(
+        # Sin el mensaje del usuario la respuesta quedaría huérfana
+        asave_turn_messages(user_id, conversation_id, [assistant_row]) if save_error is None else asyncio.sleep(0),
+        asyncio.to_thread(store_llm_response, chat_history_for_llm, provider, response_content, llm_context) \
+            if use_cache and cached is None else asyncio.sleep(0)
+    )
+    return response_content, save_error or assistant_error
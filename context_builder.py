@@ -0,0 +1,136 @@
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError: # tiktoken es opcional: sin él usamos la aproximación por caracteres
+    tiktoken = None
+
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 8000 # Tokens de entrada (historial + prompt del sistema); la salida va aparte
+DEFAULT_SUMMARY_TOKEN_BUDGET = 400 # Parte del presupuesto reservada para el resumen de turnos descartados
+MAX_SUMMARIZED_MESSAGES = 20 # Mensajes descartados más recientes que entran en el resumen
+MESSAGE_OVERHEAD_TOKENS = 4 # Tokens de formato por mensaje (rol, separadores)
+CHARS_PER_TOKEN = 4 # Aproximación para Gemini o cuando tiktoken no está disponible
+MAX_CACHED_COUNTS = 20000
+OPENAI_ENCODING = "o200k_base" # Codificación de la familia gpt-4.1 / gpt-4o
+
+_encoding = None
+_encoding_failed = False # Un fallo de carga se recuerda: no se reintenta la descarga en cada recuento
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if tiktoken is None or _encoding_failed:
+        return None
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                _encoding = tiktoken.get_encoding(OPENAI_ENCODING)
+            except Exception as e: # p. ej. sin red para descargar el BPE la primera vez
+                _encoding_failed = True
+                print(f"Error cargando tiktoken, se usa la aproximación el resto del proceso: {str(e)}")
+        return _encoding
+
+def approximate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+class TokenCounter:
+    """Cuenta tokens por proveedor con una caché LRU por contenido del mensaje.
+
+    Los mensajes del historial no cambian entre turnos, así que cada uno se tokeniza una sola vez.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_COUNTS):
+        self.max_entries = max_entries
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, text, provider="openai"):
+        key = (provider, hashlib.sha1(text.encode("utf-8")).digest())
+        with self._lock:
+            cached = self._counts.get(key)
+            if cached is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return cached
+        tokens = self._tokenize(text, provider)
+        with self._lock:
+            self.misses += 1
+            self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+    @staticmethod
+    def _tokenize(text, provider):
+        if provider == "openai":
+            encoding = _get_encoding()
+            if encoding is not None:
+                return len(encoding.encode(text, disallowed_special=()))
+        return approximate_tokens(text)
+
+    def message_tokens(self, message, provider="openai"):
+        return self.count(message["content"], provider) + MESSAGE_OVERHEAD_TOKENS
+
+token_counter = TokenCounter()
+
+def _first_sentence(text, max_chars=200):
+    text = " ".join(text[:max_chars * 2].split()) # No normalizamos el mensaje entero: puede ser una ley pegada
+    for separator in (". ", "? ", "! ", "\n"):
+        idx = text.find(separator)
+        if 0 < idx < max_chars:
+            return text[:idx + 1]
+    return text[:max_chars] + ("..." if len(text) > max_chars else "")
+
+def extractive_summary(messages):
+    """Resumen barato sin LLM: la primera frase de cada mensaje descartado, en orden."""
+    labels = {"user": "Usuario", "assistant": "LexIA"}
+    lines = [f"- {labels.get(msg['role'], msg['role'])}: {_first_sentence(msg['content'])}" for msg in messages]
+    return "Resumen de la conversación anterior:\n" + "\n".join(lines)
+
+def build_context(chat_history, provider="openai", token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET,
+                  system_prompt="", summarize=False, summarizer=extractive_summary,
+                  summary_token_budget=DEFAULT_SUMMARY_TOKEN_BUDGET, counter=None):
+    """Selecciona el historial más reciente que cabe en `token_budget` tokens.
+
+    El prompt del sistema se descuenta del presupuesto antes de elegir mensajes y el último
+    mensaje se incluye siempre, aunque no quepa. Se recorre el historial desde el final y se para
+    al agotar el presupuesto, así que el coste depende de lo que entra en el contexto y no de la
+    longitud de la conversación.
+
+    Devuelve (mensajes, resumen). Con summarize=True, los mensajes descartados más recientes se
+    condensan con `summarizer(mensajes)` en un resumen de hasta `summary_token_budget` tokens
+    (None si no hay nada descartado o no cabe).
+    """
+    counter = counter or token_counter
+    remaining = token_budget - counter.count(system_prompt, provider) if system_prompt else token_budget
+    if summarize:
+        remaining -= summary_token_budget
+
+    selected = []
+    start = len(chat_history)
+    for idx in range(len(chat_history) - 1, -1, -1):
+        cost = counter.message_tokens(chat_history[idx], provider)
+        if selected and cost > remaining:
+            break
+        selected.append(chat_history[idx])
+        remaining -= cost
+        start = idx
+    selected.reverse()
+
+    summary = None
+    if summarize and start > 0:
+        evicted = chat_history[max(0, start - MAX_SUMMARIZED_MESSAGES):start]
+        while evicted:
+            summary = summarizer(evicted)
+            # El resumen cambia cada turno: no lo guardamos en la caché de recuentos
+            if counter._tokenize(summary, provider) <= summary_token_budget:
+                break
+            evicted = evicted[1:] # Quitamos el más antiguo hasta que el resumen quepa
+            summary = None
+    return selected, summary
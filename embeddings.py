@@ -0,0 +1,101 @@
+import functools
+import importlib
+import math
+import os
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+
+DEFAULT_EMBEDDER = os.getenv("LEXIA_RAG_EMBEDDER", "hashing") # "hashing", "sentence-transformers" o "modulo:Clase"
+DEFAULT_SENTENCE_TRANSFORMERS_MODEL = os.getenv(
+    "LEXIA_RAG_EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+)
+HASHING_DIM = 1024 # Dimensión del embedder por feature hashing
+
+_WORD = re.compile(r"\w+")
+
+def fold_text(text):
+    """Minúsculas y sin tildes: "Prescripción" y "prescripcion" deben coincidir."""
+    folded = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in folded if not unicodedata.combining(c))
+
+def l2_normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+class HashingEmbedder:
+    """Embeddings léxicos por feature hashing de raíces y bigramas: sin modelo, sin red y deterministas.
+
+    No capta sinónimos como un modelo neuronal, pero con texto legal (términos muy específicos,
+    números de artículo) da una recuperación razonable y sirve de embedder por defecto y de
+    referencia en los benchmarks offline.
+    """
+
+    def __init__(self, dim=HASHING_DIM, stem_length=6):
+        self.dim = dim
+        self.stem_length = stem_length
+        self.spec = f"hashing:{dim}:{stem_length}"
+
+    @functools.lru_cache(maxsize=200000)
+    def _bucket(self, feature):
+        digest = zlib.crc32(feature.encode("utf-8"))
+        return digest % self.dim, (1.0 if digest & 0x80000000 else -1.0)
+
+    def _features(self, text):
+        stems = [word[:self.stem_length] for word in _WORD.findall(fold_text(text)) if len(word) > 2]
+        return stems + [f"{a} {b}" for a, b in zip(stems, stems[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for feature in self._features(text):
+                counts[feature] = counts.get(feature, 0) + 1
+            for feature, count in counts.items():
+                idx, sign = self._bucket(feature)
+                vectors[row, idx] += sign * (1.0 + math.log(count)) # TF sublineal
+        return l2_normalize(vectors)
+
+class SentenceTransformerEmbedder:
+    """Modelo local de sentence-transformers (dependencia opcional, se importa solo si se usa)."""
+
+    def __init__(self, model_name=DEFAULT_SENTENCE_TRANSFORMERS_MODEL, batch_size=64):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.spec = f"sentence-transformers:{model_name}"
+
+    def embed(self, texts):
+        vectors = self.model.encode(
+            list(texts), batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True
+        )
+        return np.asarray(vectors, dtype=np.float32)
+
+EMBEDDERS = {
+    "hashing": HashingEmbedder,
+    "sentence-transformers": SentenceTransformerEmbedder
+}
+
+def get_embedder(spec=None):
+    """Crea un embedder a partir de su especificación.
+
+    "hashing[:dim[:stem]]", "sentence-transformers[:modelo]" o "paquete.modulo:Clase" para un
+    embedder propio (cualquier objeto con `dim`, `spec` y `embed(textos) -> ndarray (n, dim)`
+    normalizado). La especificación se guarda en el índice para usar el mismo embedder al consultar.
+    """
+    spec = spec or DEFAULT_EMBEDDER
+    name, _, arg = spec.partition(":")
+    if name == "hashing":
+        dim, _, stem_length = arg.partition(":")
+        return HashingEmbedder(int(dim or HASHING_DIM), int(stem_length or 6))
+    if name == "sentence-transformers":
+        return SentenceTransformerEmbedder(arg or DEFAULT_SENTENCE_TRANSFORMERS_MODEL)
+    if name in EMBEDDERS:
+        return EMBEDDERS[name]()
+    module = importlib.import_module(name)
+    return getattr(module, arg)()
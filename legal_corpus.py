@@ -0,0 +1,287 @@
+"""Recuperación de normativa local (RAG) para LexIA.
+
+Ingesta (desde la raíz del repositorio):
+    python -m legal_corpus ingest corpus/ --index .lexia_cache/legal_index [--quantize] [--ivf-lists 256]
+Consulta de prueba:
+    python -m legal_corpus query "plazo de prescripción de las acciones personales"
+
+La ingesta trocea los textos (BOE/EUR-Lex exportados como .txt/.md/.html/.xml) respetando los
+artículos, los convierte en vectores con el embedder configurado y los guarda en un índice
+mapeado en memoria (vector_index.py). En la app, chat_utils añade los pasajes más relevantes al
+contexto del LLM si LEXIA_RAG_INDEX apunta a un índice.
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+import streamlit as st
+
+from context_builder import approximate_tokens
+# embeddings y vector_index (numpy) se importan dentro de las funciones: sin LEXIA_RAG_INDEX la app no los carga
+
+
+RAG_INDEX_PATH = os.getenv("LEXIA_RAG_INDEX") # Sin índice configurado la recuperación está desactivada
+RAG_TOP_K = int(os.getenv("LEXIA_RAG_TOP_K", "4"))
+RAG_TOKEN_BUDGET = int(os.getenv("LEXIA_RAG_TOKEN_BUDGET", "1500")) # Tokens de pasajes por turno, dentro del presupuesto de contexto
+RAG_MIN_SCORE = float(os.getenv("LEXIA_RAG_MIN_SCORE", "0.08")) # Por debajo de esta similitud el pasaje no se usa
+CHUNK_TOKENS = 350
+CHUNK_OVERLAP_TOKENS = 50
+INGEST_BATCH_SIZE = 256
+MAX_CACHED_QUERIES = 256
+CORPUS_EXTENSIONS = {".txt", ".md", ".html", ".htm", ".xml"}
+
+# Encabezados que abren una unidad normativa: "Artículo 1964.", "Art. 5", "Disposición adicional primera"...
+_HEADING = re.compile(
+    r"^\s*((art[íi]culo|art\.)\s+\d+[\w.]*|disposici[óo]n\s+(adicional|transitoria|derogatoria|final)\b.*|"
+    r"(t[íi]tulo|cap[íi]tulo|secci[óo]n)\s+[\wivxlc]+\b.*)",
+    re.IGNORECASE
+)
+
+class _HTMLText(HTMLParser):
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "article", "section", "blockquote"}
+    SKIP_TAGS = {"script", "style", "head", "nav", "footer"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.title = None
+        self._skip_depth = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+        elif tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif tag in self.SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title = (self.title or "") + data.strip()
+        elif not self._skip_depth:
+            self.parts.append(data)
+
+def load_document(path):
+    """Devuelve {"source", "title", "text"} de un fichero de texto o HTML/XML."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        raw = f.read()
+    title = os.path.splitext(os.path.basename(path))[0]
+    if os.path.splitext(path)[1].lower() in {".html", ".htm", ".xml"}:
+        parser = _HTMLText()
+        parser.feed(raw)
+        raw = "".join(parser.parts)
+        title = parser.title or title
+    text = re.sub(r"\n{3,}", "\n\n", "\n".join(re.sub(r"[ \t\xa0]+", " ", line).strip() for line in raw.splitlines())).strip()
+    first_line = text.split("\n", 1)[0]
+    if title == os.path.splitext(os.path.basename(path))[0] and first_line and len(first_line) <= 200 \
+            and not _HEADING.match(first_line): # Las exportaciones en texto del BOE empiezan por el título
+        title = first_line
+        text = text[len(first_line):].strip()
+    return {"source": path, "title": title, "text": text}
+
+def iter_corpus_files(directory):
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in CORPUS_EXTENSIONS:
+                yield os.path.join(root, name)
+
+def chunk_document(document, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Trocea un documento en fragmentos de ~max_tokens que no cruzan encabezados de artículo.
+
+    Los artículos largos se parten por párrafos con solapamiento; cada fragmento lleva el
+    encabezado del artículo al que pertenece para que el LLM pueda citarlo.
+    """
+    sections, heading, paragraphs = [], None, []
+    for paragraph in (p.strip() for p in document["text"].split("\n")):
+        if not paragraph:
+            continue
+        if _HEADING.match(paragraph):
+            if paragraphs:
+                sections.append((heading, paragraphs))
+            heading, paragraphs = paragraph[:200], []
+            continue
+        paragraphs.append(paragraph)
+    if paragraphs:
+        sections.append((heading, paragraphs))
+
+    chunks = []
+    for heading, section_paragraphs in sections:
+        current, current_tokens = [], 0
+        for paragraph in _split_long(section_paragraphs, max_tokens):
+            tokens = approximate_tokens(paragraph)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append(_make_chunk(document, heading, current))
+                overlap = []
+                while current and approximate_tokens(" ".join(overlap + current[-1:])) <= overlap_tokens:
+                    overlap.insert(0, current.pop())
+                current, current_tokens = overlap, approximate_tokens(" ".join(overlap))
+            current.append(paragraph)
+            current_tokens += tokens
+        if current:
+            chunks.append(_make_chunk(document, heading, current))
+    return chunks
+
+def _split_long(paragraphs, max_tokens):
+    """Parte por frases los párrafos que por sí solos superan el tamaño de fragmento."""
+    for paragraph in paragraphs:
+        if approximate_tokens(paragraph) <= max_tokens:
+            yield paragraph
+            continue
+        piece = ""
+        for sentence in re.split(r"(?<=[.;:])\s+", paragraph):
+            if piece and approximate_tokens(piece + " " + sentence) > max_tokens:
+                yield piece
+                piece = ""
+            piece = f"{piece} {sentence}".strip()
+        if piece:
+            yield piece
+
+def _make_chunk(document, heading, paragraphs):
+    return {"source": document["source"], "title": document["title"], "heading": heading, "text": "\n".join(paragraphs)}
+
+def ingest_directory(directory, index_path, embedder=None, quantize=False, ivf_lists=0, batch_size=INGEST_BATCH_SIZE):
+    """Indexa todos los documentos de `directory` en `index_path` (se reemplaza si existe). Devuelve estadísticas."""
+    from embeddings import get_embedder
+    from vector_index import VectorIndexWriter, remove_index
+    embedder = embedder or get_embedder()
+    started = time.perf_counter()
+    remove_index(index_path)
+    writer = VectorIndexWriter(index_path, embedder.dim, embedder.spec)
+    stats = {"documents": 0, "chunks": 0, "bytes": 0, "embed_seconds": 0.0}
+    pending = []
+
+    def flush():
+        embed_started = time.perf_counter()
+        vectors = embedder.embed([_embedding_text(chunk) for chunk in pending])
+        stats["embed_seconds"] += time.perf_counter() - embed_started
+        writer.add(vectors, pending)
+        stats["chunks"] += len(pending)
+        pending.clear()
+
+    for path in iter_corpus_files(directory):
+        document = load_document(path)
+        stats["documents"] += 1
+        stats["bytes"] += len(document["text"].encode("utf-8"))
+        for chunk in chunk_document(document):
+            pending.append(chunk)
+            if len(pending) >= batch_size:
+                flush()
+    if pending:
+        flush()
+    finalize_started = time.perf_counter()
+    writer.finalize(quantize=quantize, ivf_lists=ivf_lists)
+    stats["finalize_seconds"] = time.perf_counter() - finalize_started
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+def _embedding_text(chunk):
+    # El título y el encabezado aportan contexto ("Código Civil, Artículo 1964") al vector del fragmento
+    return " ".join(part for part in (chunk["title"], chunk["heading"], chunk["text"]) if part)
+
+class Retriever:
+    """Busca los pasajes más relevantes para una consulta y los formatea para el prompt."""
+
+    def __init__(self, index, embedder=None, top_k=RAG_TOP_K, token_budget=RAG_TOKEN_BUDGET,
+                 min_score=RAG_MIN_SCORE, nprobe=None):
+        from embeddings import get_embedder
+        from vector_index import DEFAULT_NPROBE
+        self.index = index
+        self.embedder = embedder or get_embedder(index.embedder_spec)
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.min_score = min_score
+        self.nprobe = DEFAULT_NPROBE if nprobe is None else nprobe
+        # La misma consulta se recupera varias veces por turno (clave de caché, tokens, envío)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def retrieve(self, query):
+        """Lista de pasajes {"title", "heading", "text", "score", "source"} dentro del presupuesto de tokens."""
+        query = (query or "").strip()
+        if not query:
+            return []
+        with self._lock:
+            if query in self._cache:
+                self._cache.move_to_end(query)
+                return self._cache[query]
+        hits = self.index.search(self.embedder.embed([query]), k=self.top_k, nprobe=self.nprobe)[0]
+        passages, used_tokens = [], 0
+        for chunk_id, score in hits:
+            if score < self.min_score:
+                break
+            chunk = self.index.chunk(chunk_id)
+            tokens = approximate_tokens(chunk["text"])
+            if used_tokens + tokens > self.token_budget:
+                continue
+            passages.append({**chunk, "score": round(score, 4)})
+            used_tokens += tokens
+        with self._lock:
+            self._cache[query] = passages
+            while len(self._cache) > MAX_CACHED_QUERIES:
+                self._cache.popitem(last=False)
+        return passages
+
+    def context_for(self, query):
+        """Texto listo para el prompt con los pasajes recuperados, o None si no hay ninguno pertinente."""
+        passages = self.retrieve(query)
+        if not passages:
+            return None
+        lines = ["Fragmentos de normativa recuperados del corpus local. Úsalos si son pertinentes y cítalos por su título y artículo; no inventes normas que no aparezcan aquí ni conozcas con seguridad:"]
+        for idx, passage in enumerate(passages, start=1):
+            reference = " — ".join(part for part in (passage["title"], passage["heading"]) if part)
+            lines.append(f"[{idx}] {reference}\n{passage['text']}")
+        return "\n\n".join(lines)
+
+@st.cache_resource
+def get_retriever():
+    """Retriever compartido por el proceso (índice mapeado en memoria una sola vez), o None si no hay índice."""
+    if not RAG_INDEX_PATH:
+        return None
+    try:
+        from vector_index import VectorIndex
+        return Retriever(VectorIndex(RAG_INDEX_PATH))
+    except Exception as e:
+        print(f"Error cargando el índice de normativa {RAG_INDEX_PATH}: {str(e)}")
+        return None
+
+def _main():
+    parser = argparse.ArgumentParser(description="Índice local de normativa para LexIA")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest = subparsers.add_parser("ingest", help="Indexa un directorio de textos legales")
+    ingest.add_argument("directory")
+    ingest.add_argument("--index", default=RAG_INDEX_PATH or ".lexia_cache/legal_index")
+    ingest.add_argument("--embedder", default=None, help="Especificación del embedder (ver embeddings.get_embedder)")
+    ingest.add_argument("--quantize", action="store_true", help="Vectores int8 (4x menos disco y memoria)")
+    ingest.add_argument("--ivf-lists", type=int, default=0, help="Listas IVF para búsqueda aproximada (0: exacta)")
+    query = subparsers.add_parser("query", help="Muestra los pasajes recuperados para una consulta")
+    query.add_argument("text")
+    query.add_argument("--index", default=RAG_INDEX_PATH or ".lexia_cache/legal_index")
+    query.add_argument("--top-k", type=int, default=RAG_TOP_K)
+    args = parser.parse_args()
+    from embeddings import get_embedder
+    from vector_index import VectorIndex
+
+    if args.command == "ingest":
+        stats = ingest_directory(args.directory, args.index, get_embedder(args.embedder), args.quantize, args.ivf_lists)
+        print(f"{stats['documents']} documentos → {stats['chunks']} fragmentos en {stats['seconds']:.1f} s "
+              f"({stats['chunks'] / max(stats['seconds'], 1e-9):.0f} fragmentos/s); índice en {args.index}")
+    else:
+        retriever = Retriever(VectorIndex(args.index), top_k=args.top_k, min_score=0.0)
+        for passage in retriever.retrieve(args.text):
+            print(f"[{passage['score']:.3f}] {passage['title']} — {passage['heading'] or ''}\n{passage['text'][:300]}\n")
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import importlib
+import inspect
+import sys
+import threading
+from collections import OrderedDict
+
+import streamlit as st
+
+from async_runtime import get_event_loop_thread
+
+
+MAX_CACHED_CLIENTS = 32 # Clientes LLM vivos como máximo en el proceso
+PROVIDER_SDK_MODULES = {"openai": "openai", "gemini": "google.generativeai"}
+GEMINI_SERVICE_MODULE = "google.ai.generativelanguage" # Clientes de bajo nivel (glm) que usa google.generativeai
+
+def import_provider_sdk(provider):
+    """Importa (una sola vez por proceso) el SDK de un proveedor y devuelve el módulo.
+
+    Los SDK no se importan al cargar el módulo: google.generativeai tarda más de un segundo y
+    openai más de medio, y cada usuario solo usa uno de los dos. El import de Python ya es seguro
+    entre hilos: si dos hilos lo piden a la vez, el segundo espera a que termine el primero.
+    """
+    return importlib.import_module(PROVIDER_SDK_MODULES[provider])
+
+def preload_provider_sdk(provider):
+    """Importa el SDK en un hilo aparte para que el primer mensaje no pague el import."""
+    if provider not in PROVIDER_SDK_MODULES or PROVIDER_SDK_MODULES[provider] in sys.modules:
+        return
+    threading.Thread(target=import_provider_sdk, args=(provider,), name=f"lexia-preload-{provider}", daemon=True).start()
+
+def _hash_api_key(api_key):
+    """Nunca usamos la API Key en claro como clave de caché."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+
+class LLMClientRegistry:
+    """Registro LRU de clientes LLM por (proveedor, hash de API Key, modelo).
+
+    Reutilizar el cliente de OpenAI reutiliza su pool de conexiones httpx (keep-alive, sin
+    nuevo handshake TLS por mensaje). En Gemini se reutiliza el GenerativeModel ya construido.
+    Los clientes son asíncronos y se usan desde el event loop de `loop`, donde también se cierran.
+    """
+
+    def __init__(self, max_size=MAX_CACHED_CLIENTS, loop=None):
+        self.max_size = max_size
+        self._loop = loop
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, key, factory):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+            client = factory()
+            self._clients[key] = client
+            while len(self._clients) > self.max_size:
+                _, evicted = self._clients.popitem(last=False)
+                self._close(evicted)
+            return client
+
+    def _close(self, client):
+        close = getattr(client, "close", None)
+        if callable(close):
+            try:
+                result = close()
+                if inspect.isawaitable(result): # AsyncOpenAI.close() es una corrutina
+                    if self._loop is not None and not self._loop.is_closed():
+                        asyncio.run_coroutine_threadsafe(result, self._loop)
+                    else:
+                        result.close()
+            except Exception as e:
+                print(f"Error cerrando cliente LLM: {str(e)}")
+
+    def get_openai_client(self, api_key, model):
+        openai = import_provider_sdk("openai")
+        key = ("openai", _hash_api_key(api_key), model)
+        return self._get_or_create(key, lambda: openai.AsyncOpenAI(api_key=api_key))
+
+    def get_gemini_model(self, api_key, model, system_instruction, generation_config):
+        """GenerativeModel con clientes propios para su API Key. Se llama desde el event loop.
+
+        No usamos genai.configure: es global al proceso y el GenerativeModel enlaza su cliente en
+        la primera llamada, así que con dos claves activas una sesión podía enviar sus peticiones
+        (y facturarlas) con la clave de otro usuario.
+        """
+        genai = import_provider_sdk("gemini")
+        key = ("gemini", _hash_api_key(api_key), model)
+
+        def create():
+            glm = importlib.import_module(GEMINI_SERVICE_MODULE)
+            gemini_model = genai.GenerativeModel(
+                model_name=model,
+                system_instruction=system_instruction,
+                generation_config=generation_config
+            )
+            # El cliente asíncrono abre su canal grpc.aio en el loop actual (el compartido)
+            gemini_model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            gemini_model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+            return gemini_model
+
+        return self._get_or_create(key, create)
+
+    def clear(self):
+        with self._lock:
+            for client in self._clients.values():
+                self._close(client)
+            self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+@st.cache_resource
+def get_llm_client_registry():
+    """Registro compartido entre reruns y sesiones de Streamlit del mismo proceso."""
+    return LLMClientRegistry(loop=get_event_loop_thread().loop)
@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import deque
+
+import streamlit as st
+
+
+FAILURE_THRESHOLD = 3 # Fallos consecutivos que abren el circuito de un proveedor
+RESET_TIMEOUT_SECONDS = 30.0 # Tiempo con el circuito abierto antes de dejar pasar una petición de prueba
+FIRST_TOKEN_TIMEOUT_SECONDS = 30.0 # Sin primer token en este tiempo, el intento cuenta como fallo
+LATENCY_WINDOW = 100 # Muestras de time-to-first-token que se conservan por proveedor
+MIN_LATENCY_SAMPLES = 10 # Por debajo de esto se usa DEFAULT_HEDGE_DELAY_SECONDS
+DEFAULT_HEDGE_DELAY_SECONDS = 2.0
+MIN_HEDGE_DELAY_SECONDS = 0.3
+MAX_HEDGE_DELAY_SECONDS = 10.0
+
+class ProviderError(Exception):
+    """Error de un proveedor concreto; `provider` indica cuál falló."""
+
+    def __init__(self, provider, message):
+        super().__init__(message)
+        self.provider = provider
+
+class CircuitBreaker:
+    """Circuito cerrado → abierto tras N fallos seguidos → semiabierto pasado el reset_timeout."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT_SECONDS, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self._clock() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow_request(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True # Una sola petición de prueba a la vez
+            return True
+        return False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = self._clock()
+
+    def release(self):
+        """El intento se canceló sin resultado (p. ej. perdió un hedge): no cuenta ni a favor ni en contra."""
+        self._trial_in_flight = False
+
+class LatencyTracker:
+    """Ventana deslizante de time-to-first-token por proveedor para calcular el retraso del hedge."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+
+    def record(self, provider, seconds):
+        self._samples.setdefault(provider, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, provider, pct):
+        samples = sorted(self._samples.get(provider, ()))
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+        return samples[idx]
+
+    def hedge_delay(self, provider):
+        if len(self._samples.get(provider, ())) < MIN_LATENCY_SAMPLES:
+            return DEFAULT_HEDGE_DELAY_SECONDS
+        p95 = self.percentile(provider, 95)
+        return min(MAX_HEDGE_DELAY_SECONDS, max(MIN_HEDGE_DELAY_SECONDS, p95))
+
+class _Attempt:
+    def __init__(self, provider, breaker, stream, started_at, is_hedge=False):
+        self.provider = provider
+        self.is_hedge = is_hedge
+        self.breaker = breaker
+        self.stream = stream
+        self.started_at = started_at
+        self.task = None
+
+class LLMRouter:
+    """Failover y hedging entre proveedores LLM para respuestas en streaming.
+
+    Los candidatos son pares (proveedor, api_key) en orden de preferencia. Los circuitos se
+    indexan por (proveedor, hash de la API Key), para que una clave inválida de un usuario no
+    abra el circuito del proveedor para todos; las latencias se agregan por proveedor.
+    """
+
+    def __init__(self, clock=time.monotonic, first_token_timeout=FIRST_TOKEN_TIMEOUT_SECONDS):
+        self._clock = clock
+        self.first_token_timeout = first_token_timeout
+        self.latency = LatencyTracker()
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.failovers = 0
+
+    def breaker_for(self, provider, api_key):
+        key = (provider, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest())
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(clock=self._clock)
+            return self._breakers[key]
+
+    def _start(self, provider, api_key, open_stream, is_hedge=False):
+        breaker = self.breaker_for(provider, api_key)
+        attempt = _Attempt(provider, breaker, open_stream(provider, api_key), self._clock(), is_hedge)
+        attempt.task = asyncio.ensure_future(
+            asyncio.wait_for(attempt.stream.__anext__(), self.first_token_timeout)
+        )
+        return attempt
+
+    @staticmethod
+    async def _discard(attempt):
+        attempt.task.cancel()
+        try:
+            await attempt.task
+        except BaseException:
+            pass
+        try:
+            await attempt.stream.aclose()
+        except Exception:
+            pass
+
+    async def astream(self, candidates, open_stream, hedge=False):
+        """Generador asíncrono de fragmentos del primer candidato que dé el primer token.
+
+        `open_stream(proveedor, api_key)` debe devolver un generador asíncrono que lance una
+        excepción si el proveedor falla. Si fallan todos los candidatos se lanza ProviderError.
+        """
+        allowed = [c for c in candidates if self.breaker_for(*c).allow_request()]
+        if not allowed: # Todos los circuitos abiertos: probamos igualmente el preferido
+            allowed = candidates[:1]
+        waiting = list(allowed)
+        running = [self._start(*waiting.pop(0), open_stream)]
+        last_error = None
+        winner, first_chunk = None, None
+        try:
+            while running and winner is None:
+                timeout = None
+                if hedge and waiting and len(running) == 1:
+                    elapsed = self._clock() - running[0].started_at
+                    timeout = max(0.0, self.latency.hedge_delay(running[0].provider) - elapsed)
+                done, _ = await asyncio.wait([a.task for a in running], timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done: # El principal no ha dado el primer token a tiempo: lanzamos el hedge
+                    self.hedges_fired += 1
+                    running.append(self._start(*waiting.pop(0), open_stream, is_hedge=True))
+                    continue
+                for attempt in [a for a in running if a.task in done]:
+                    try:
+                        chunk = attempt.task.result()
+                    except StopAsyncIteration:
+                        chunk = ""
+                    except Exception as e:
+                        running.remove(attempt)
+                        attempt.breaker.record_failure()
+                        last_error = ProviderError(attempt.provider, str(e) or type(e).__name__)
+                        last_error.__cause__ = e # Conserva el tipo original (p. ej. un 429) para quien lo trate
+                        continue
+                    if winner is None:
+                        running.remove(attempt) # Los demás intentos se descartan en el finally
+                        winner, first_chunk = attempt, chunk
+                        self.latency.record(attempt.provider, self._clock() - attempt.started_at)
+                        if attempt.is_hedge:
+                            self.hedges_won += 1
+                if winner is None and not running and waiting: # Failover secuencial
+                    self.failovers += 1
+                    running.append(self._start(*waiting.pop(0), open_stream))
+        finally:
+            for attempt in running:
+                attempt.breaker.release()
+                await self._discard(attempt)
+            for provider, api_key in waiting: # Candidatos admitidos que no llegaron a lanzarse
+                self.breaker_for(provider, api_key).release()
+        if winner is None:
+            raise last_error or ProviderError(candidates[0][0], "Ningún proveedor disponible.")
+
+        outcome_recorded = False
+        try:
+            if first_chunk:
+                yield first_chunk
+            async for chunk in winner.stream:
+                yield chunk
+        except Exception as e:
+            outcome_recorded = True
+            winner.breaker.record_failure()
+            raise ProviderError(winner.provider, str(e) or type(e).__name__) from e
+        else:
+            outcome_recorded = True
+            winner.breaker.record_success()
+        finally:
+            if not outcome_recorded: # El consumidor abandonó el stream (aclose, cancelación): sin resultado
+                winner.breaker.release()
+                try:
+                    await winner.stream.aclose()
+                except Exception:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            breakers = {f"{provider}:{key_hash[:8]}": breaker.state for (provider, key_hash), breaker in self._breakers.items()}
+        return {
+            "hedges_fired": self.hedges_fired,
+            "hedges_won": self.hedges_won,
+            "failovers": self.failovers,
+            "breakers": breakers
+        }
+
+@st.cache_resource
+def get_llm_router():
+    """Router compartido: circuitos y latencias se acumulan entre sesiones del proceso."""
+    return LLMRouter()
@@ -1,19 +1,30 @@
 import streamlit as st
 from supabase_client import (
-    supabase, sign_up_user, sign_in_user, sign_out_user
+    sign_up_user, sign_in_user, sign_out_user, bind_client, use_client
 )
 from chat_utils import (
-    get_llm_response, SYSTEM_PROMPT,
-    save_message, get_messages_for_conversation,
-    create_conversation, get_user_conversations, 
-    delete_conversation_and_messages, rename_conversation
+    stream_llm_response, SYSTEM_PROMPT, RESPONSE_CACHE_ENABLED,
+    get_cached_llm_response, store_llm_response,
+    queue_turn, note_remote_turn, get_persistence_stats, get_messages_page,
+    create_conversation, get_user_conversations_page,
+    delete_conversation_and_messages, search_messages,
+    acquire_rate_limit, build_llm_context, record_llm_usage, reserve_llm_slot,
+    request_auto_title, get_auto_title_updates
 )
+from llm_clients import preload_provider_sdk
+from rate_limits import is_rate_limited_response
+from api_client import API_URL, ChatTurnStream
+from telemetry import start_turn, span, start_metrics_server, METRICS_PORT
+from collections import deque
+import hashlib
+import math
 
 # --- Page Configuration ---
 st.set_page_config(page_title="LexIA Chatbot", layout="wide", initial_sidebar_state="auto")
 
 # --- Session State Initialization (General Auth) ---
 if "user_session" not in st.session_state: st.session_state.user_session = None
+if "auth_session" not in st.session_state: st.session_state.auth_session = None # UserSession: tokens y cliente de Supabase del usuario
 if "show_signup_form" not in st.session_state: st.session_state.show_signup_form = False
 if "auth_error_message" not in st.session_state: st.session_state.auth_error_message = None
 if "auth_info_message" not in st.session_state: st.session_state.auth_info_message = None
@@ -21,30 +32,201 @@ if "auth_info_message" not in st.session_state: st.session_state.auth_info_messa
 
 # --- Constants ---
 DEFAULT_NEW_CONVERSATION_TITLE = "Nueva Conversación" 
-MAX_TITLE_LENGTH = 50 
+AUTO_TITLE_POLL_SECONDS = 1.0 # Cada cuánto se repinta la lista de conversaciones mientras se genera un título
+TURN_TIMINGS_TO_SHOW = 10 # Turnos recientes en el panel de depuración
+CONVERSATIONS_WINDOW = 20 # Conversaciones visibles en la barra lateral antes de "Mostrar más"
+LLM_QUEUE_POLL_SECONDS = 0.5 # Cada cuánto se refresca el puesto en la cola del proveedor
+
+@st.cache_resource
+def start_metrics_endpoint():
+    """Endpoint /metrics (Prometheus) una sola vez por proceso, si LEXIA_METRICS_PORT está definido."""
+    return start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+start_metrics_endpoint()
 
 # --- Session State Initialization (Chat & Conversation Specific) ---
 def initialize_chat_states():
     st.session_state.conversations_list = []
+    st.session_state.conversations_cursor = None # Cursor de la siguiente página de conversaciones
+    st.session_state.conversations_visible = CONVERSATIONS_WINDOW
+    st.session_state.conversation_search_query = ""
+    st.session_state.conversation_search_results = []
+    st.session_state.conversation_search_cursor = None
+    st.session_state.message_search_query = ""
+    st.session_state.message_search_results = []
+    st.session_state.message_search_cursor = None
+    st.session_state.search_jump = None # Resultado de búsqueda al que saltar en la conversación activa
     st.session_state.active_conversation_id = None
     st.session_state.active_conversation_title = "LexIA"
     st.session_state.messages = [] 
+    st.session_state.messages_cursor = None # Cursor de la página anterior (None: no hay mensajes más antiguos)
     st.session_state.history_loaded_for_active_conv = False
     st.session_state.api_key = st.session_state.get("api_key", None) 
     st.session_state.selected_provider = st.session_state.get("selected_provider", "openai") 
+    st.session_state.use_response_cache = st.session_state.get("use_response_cache", True)
+    st.session_state.fallback_api_key = st.session_state.get("fallback_api_key", None)
+    st.session_state.hedge_requests = st.session_state.get("hedge_requests", False)
+    st.session_state.turn_timings = st.session_state.get("turn_timings", deque(maxlen=TURN_TIMINGS_TO_SHOW))
     st.session_state.conversations_loaded = False
+    st.session_state.pending_titles = set() # Conversaciones cuyo título se está generando en segundo plano
 
 def clear_active_conversation_messages():
     st.session_state.messages = []
+    st.session_state.messages_cursor = None
     st.session_state.history_loaded_for_active_conv = False
+    st.session_state.search_jump = None
+
+def jump_to_search_hit(hit):
+    st.session_state.active_conversation_id = hit["conversation_id"]
+    st.session_state.active_conversation_title = hit["conversation_title"]
+    clear_active_conversation_messages()
+    st.session_state.search_jump = hit
+
+def content_md5(content):
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+# Actualizaciones incrementales de la lista de conversaciones (sin volver a consultarla)
+def move_conversation_to_top(conversation_id, title=None):
+    for conv_list in (st.session_state.conversations_list, st.session_state.conversation_search_results):
+        for conv_idx, c in enumerate(conv_list):
+            if c["id"] == conversation_id:
+                if title is not None:
+                    c["title"] = title
+                conv_list.insert(0, conv_list.pop(conv_idx))
+                break
+
+def remove_conversation_locally(conversation_id):
+    st.session_state.conversations_list = [c for c in st.session_state.conversations_list if c["id"] != conversation_id]
+    st.session_state.conversation_search_results = [
+        c for c in st.session_state.conversation_search_results if c["id"] != conversation_id
+    ]
+    st.session_state.message_search_results = [
+        hit for hit in st.session_state.message_search_results if hit["conversation_id"] != conversation_id
+    ]
+
+def wait_for_llm_slot(slot):
+    """Espera plaza en el semáforo del proveedor mostrando al usuario su puesto en la cola."""
+    if slot.wait(0):
+        return
+    queue_notice = st.empty()
+    while True:
+        queue_notice.info(f"⏳ Mucha demanda en {slot.provider.capitalize()}: tu consulta es la número {slot.position()} de la cola.")
+        if slot.wait(LLM_QUEUE_POLL_SECONDS):
+            break
+    queue_notice.empty()
+
+def rename_conversation_locally(conversation_id, title):
+    for conv_list in (st.session_state.conversations_list, st.session_state.conversation_search_results):
+        for c in conv_list:
+            if c["id"] == conversation_id:
+                c["title"] = title
+    if st.session_state.active_conversation_id == conversation_id:
+        st.session_state.active_conversation_title = title
+
+def apply_auto_titles():
+    """Aplica a la lista los títulos que ya se han generado y guardado en segundo plano."""
+    if not st.session_state.pending_titles:
+        return
+    ready, st.session_state.pending_titles = get_auto_title_updates(st.session_state.pending_titles)
+    for conversation_id, title in ready.items():
+        rename_conversation_locally(conversation_id, title)
+
+def render_conversation_list(user_id):
+    """Lista de conversaciones de la barra lateral.
+
+    Se ejecuta como fragmento (st.fragment): mientras haya títulos pendientes se repinta sola sin
+    rerun de toda la app. Seleccionar o borrar una conversación sí hace un rerun completo.
+    Un rerun del fragmento (el botón de borrar, "Mostrar más", el refresco periódico) se ejecuta
+    en otro hilo sin el bind_client del script, así que el cliente del usuario se fija aquí: si no,
+    el borrado iría con la anon key y RLS no borraría nada.
+    """
+    with use_client(st.session_state.auth_session.client() if st.session_state.auth_session else None):
+        _render_conversation_list(user_id)
+
+def _render_conversation_list(user_id):
+    apply_auto_titles()
+
+    # Si después de cargar y de la opción de "Nueva conversación", no hay ninguna conversación activa
+    # Y la lista de conversaciones está vacía, es el momento de indicar que no hay nada o crear una.
+    # Este chequeo se hace ANTES de intentar mostrar la lista.
+    if not st.session_state.conversations_list and st.session_state.conversations_loaded:
+        st.caption("No tienes conversaciones. ¡Crea una nueva!")
+        # Opcionalmente, podríamos forzar la creación de una aquí si es la política deseada
+        # if st.button("Crear mi primera conversación"): 
+
+    # Solo se pintan las conversaciones de la ventana visible (o los resultados de la búsqueda)
+    if st.session_state.conversation_search_query:
+        visible_conversations = st.session_state.conversation_search_results
+        if not visible_conversations:
+            st.caption("Ninguna conversación coincide con la búsqueda.")
+    else:
+        visible_conversations = st.session_state.conversations_list[:st.session_state.conversations_visible]
+
+    for conv_item in visible_conversations:
+        conv_id_item = conv_item["id"]
+        conv_title_item = conv_item["title"]
+        col1, col2 = st.columns([6,1])
+        with col1: 
+            is_active = (conv_id_item == st.session_state.active_conversation_id)
+            conv_button_label = f"💬 {conv_title_item}" if not is_active else f"▶️ **{conv_title_item}**"
+            if st.button(conv_button_label, key=f"conv_btn_{conv_id_item}", use_container_width=True, type="secondary" if not is_active else "primary"):
+                if not is_active:
+                    st.session_state.active_conversation_id = conv_id_item
+                    st.session_state.active_conversation_title = conv_title_item
+                    clear_active_conversation_messages()
+                    st.rerun()
+        with col2: 
+            if st.button("🗑️", key=f"delete_btn_{conv_id_item}", help="Borrar conversación"):
+                error_delete_conv = delete_conversation_and_messages(conv_id_item, user_id)
+                if error_delete_conv: 
+                    st.error(f"Error al borrar: {error_delete_conv}")
+                else:
+                    # Actualizar la lista en session_state ANTES de decidir qué hacer después
+                    remove_conversation_locally(conv_id_item)
+
+                    if st.session_state.active_conversation_id == conv_id_item: # Si se borró la activa
+                        st.session_state.active_conversation_id = None
+                        st.session_state.active_conversation_title = "LexIA" 
+                        clear_active_conversation_messages() # Limpia mensajes de la conv borrada
+
+                        # Si quedan otras conversaciones, seleccionar la primera de la lista actualizada
+                        if st.session_state.conversations_list: 
+                            new_active_conv = st.session_state.conversations_list[0]
+                            st.session_state.active_conversation_id = new_active_conv["id"]
+                            st.session_state.active_conversation_title = new_active_conv["title"]
+                            # No es necesario clear_active_conversation_messages() aquí porque la historia
+                            # de la nueva activa se cargará en el próximo ciclo.
+                        # else: # No quedan conversaciones. La UI mostrará "No tienes conversaciones."
+                              # Ya no creamos una nueva automáticamente aquí.
+                    st.rerun() 
+
+    if st.session_state.conversation_search_query:
+        if st.session_state.conversation_search_cursor and st.button("Mostrar más resultados", use_container_width=True):
+            more_results, st.session_state.conversation_search_cursor = get_user_conversations_page(
+                user_id, before=st.session_state.conversation_search_cursor, search=st.session_state.conversation_search_query
+            )
+            st.session_state.conversation_search_results.extend(more_results)
+            st.rerun()
+    elif len(st.session_state.conversations_list) > st.session_state.conversations_visible or st.session_state.conversations_cursor:
+        if st.button("Mostrar más", use_container_width=True):
+            st.session_state.conversations_visible += CONVERSATIONS_WINDOW
+            # Solo pedimos otra página cuando la ventana supera lo ya cargado
+            if len(st.session_state.conversations_list) < st.session_state.conversations_visible and st.session_state.conversations_cursor:
+                more_conversations, st.session_state.conversations_cursor = get_user_conversations_page(
+                    user_id, before=st.session_state.conversations_cursor
+                )
+                st.session_state.conversations_list.extend(more_conversations)
+            st.rerun()
+
 
 # --- Authentication Callbacks ---
 def app_login(email, password):
-    user, error = sign_in_user(email, password)
+    user, user_session, error = sign_in_user(email, password)
     if user:
         current_api_key = st.session_state.get("api_key", None)
         current_provider = st.session_state.get("selected_provider", "openai")
         st.session_state.user_session = user
+        st.session_state.auth_session = user_session
         st.session_state.auth_error_message = None
         st.session_state.auth_info_message = "Inicio de sesión exitoso."
         initialize_chat_states() 
@@ -73,8 +255,9 @@ def app_signup(email, password):
 def app_logout(): 
     api_key_before_logout = st.session_state.get("api_key", None)
     provider_before_logout = st.session_state.get("selected_provider", "openai")
-    error = sign_out_user()
+    error = sign_out_user(st.session_state.auth_session)
     st.session_state.user_session = None 
+    st.session_state.auth_session = None
     initialize_chat_states() 
     st.session_state.api_key = api_key_before_logout
     st.session_state.selected_provider = provider_before_logout
@@ -85,6 +268,10 @@ def app_logout():
     st.session_state.show_signup_form = False
     st.rerun()
 
+# Las consultas de esta ejecución del script usan el cliente con el JWT de este usuario (RLS por sesión);
+# el token se renueva en segundo plano antes de caducar
+bind_client(st.session_state.auth_session.client() if st.session_state.auth_session else None)
+
 # --- UI Rendering ---
 if st.session_state.user_session is None:
     col1, col2, col3 = st.columns([1, 2, 1]) 
@@ -150,7 +337,7 @@ else:
 
     # Cargar/Gestionar lista de conversaciones
     if not st.session_state.conversations_loaded:
-        st.session_state.conversations_list = get_user_conversations(user_id)
+        st.session_state.conversations_list, st.session_state.conversations_cursor = get_user_conversations_page(user_id)
         st.session_state.conversations_loaded = True
         if st.session_state.conversations_list: # Si hay conversaciones, seleccionar la primera
             conv = st.session_state.conversations_list[0]
@@ -172,51 +359,48 @@ else:
 
 
     st.sidebar.markdown("#### Mis Conversaciones")
-    # Si después de cargar y de la opción de "Nueva conversación", no hay ninguna conversación activa
-    # Y la lista de conversaciones está vacía, es el momento de indicar que no hay nada o crear una.
-    # Este chequeo se hace ANTES de intentar mostrar la lista.
-    if not st.session_state.conversations_list and st.session_state.conversations_loaded:
-        st.sidebar.caption("No tienes conversaciones. ¡Crea una nueva!")
-        # Opcionalmente, podríamos forzar la creación de una aquí si es la política deseada
-        # if st.button("Crear mi primera conversación"): 
+    search_query = st.sidebar.text_input(
+        "Buscar conversaciones", placeholder="🔎 Buscar por título...",
+        key="conversation_search_input", label_visibility="collapsed"
+    ).strip()
+    if search_query != st.session_state.conversation_search_query: # La búsqueda se hace en el servidor
+        st.session_state.conversation_search_query = search_query
+        if search_query:
+            st.session_state.conversation_search_results, st.session_state.conversation_search_cursor = \
+                get_user_conversations_page(user_id, search=search_query)
+        else:
+            st.session_state.conversation_search_results, st.session_state.conversation_search_cursor = [], None
+    with st.sidebar:
+        # Mientras haya un título generándose en segundo plano, la lista se repinta sola cada
+        # AUTO_TITLE_POLL_SECONDS; si este rerun trae el primer mensaje de una conversación, el
+        # título se pedirá al final del script, así que el sondeo empieza ya
+        title_incoming = bool(st.session_state.get("main_chat_input_multi")) and not API_URL and \
+            st.session_state.active_conversation_title == DEFAULT_NEW_CONVERSATION_TITLE
+        poll_seconds = AUTO_TITLE_POLL_SECONDS if st.session_state.pending_titles or title_incoming else None
+        st.fragment(render_conversation_list, run_every=poll_seconds)(user_id)
 
-    for conv_item in st.session_state.conversations_list: # Iterar sobre la lista actual
-        conv_id_item = conv_item["id"]
-        conv_title_item = conv_item["title"]
-        col1, col2 = st.sidebar.columns([6,1])
-        with col1: 
-            is_active = (conv_id_item == st.session_state.active_conversation_id)
-            conv_button_label = f"💬 {conv_title_item}" if not is_active else f"▶️ **{conv_title_item}**"
-            if st.button(conv_button_label, key=f"conv_btn_{conv_id_item}", use_container_width=True, type="secondary" if not is_active else "primary"):
-                if not is_active:
-                    st.session_state.active_conversation_id = conv_id_item
-                    st.session_state.active_conversation_title = conv_title_item
-                    clear_active_conversation_messages()
-                    st.rerun()
-        with col2: 
-            if st.button("🗑️", key=f"delete_btn_{conv_id_item}", help="Borrar conversación"):
-                error_delete_conv = delete_conversation_and_messages(conv_id_item)
-                if error_delete_conv: 
-                    st.sidebar.error(f"Error al borrar: {error_delete_conv}")
-                else:
-                    # Actualizar la lista en session_state ANTES de decidir qué hacer después
-                    st.session_state.conversations_list = [c for c in st.session_state.conversations_list if c["id"] != conv_id_item]
-                    
-                    if st.session_state.active_conversation_id == conv_id_item: # Si se borró la activa
-                        st.session_state.active_conversation_id = None
-                        st.session_state.active_conversation_title = "LexIA" 
-                        clear_active_conversation_messages() # Limpia mensajes de la conv borrada
-                        
-                        # Si quedan otras conversaciones, seleccionar la primera de la lista actualizada
-                        if st.session_state.conversations_list: 
-                            new_active_conv = st.session_state.conversations_list[0]
-                            st.session_state.active_conversation_id = new_active_conv["id"]
-                            st.session_state.active_conversation_title = new_active_conv["title"]
-                            # No es necesario clear_active_conversation_messages() aquí porque la historia
-                            # de la nueva activa se cargará en el próximo ciclo.
-                        # else: # No quedan conversaciones. La UI mostrará "No tienes conversaciones."
-                              # Ya no creamos una nueva automáticamente aquí.
-                    st.rerun() 
+    with st.sidebar.expander("🔎 Buscar en mis mensajes"):
+        message_query = st.text_input(
+            "Texto a buscar", placeholder="p. ej. arrendamientos urbanos", key="message_search_input"
+        ).strip()
+        if message_query != st.session_state.message_search_query:
+            st.session_state.message_search_query = message_query
+            st.session_state.message_search_results, st.session_state.message_search_cursor = search_messages(user_id, message_query)
+        if message_query and not st.session_state.message_search_results:
+            st.caption("Sin resultados.")
+        for hit in st.session_state.message_search_results:
+            author = "Tú" if hit["role"] == "user" else "LexIA"
+            st.markdown(f"**{hit['conversation_title']}** · {author}")
+            st.caption(hit["snippet"])
+            if st.button("Ir al mensaje", key=f"search_hit_{hit['message_id']}", use_container_width=True):
+                jump_to_search_hit(hit)
+                st.rerun()
+        if st.session_state.message_search_cursor and st.button("Más resultados", key="message_search_more_btn"):
+            more_hits, st.session_state.message_search_cursor = search_messages(
+                user_id, st.session_state.message_search_query, cursor=st.session_state.message_search_cursor
+            )
+            st.session_state.message_search_results.extend(more_hits)
+            st.rerun()
     
     st.sidebar.markdown("---")
     # Configuración API Key, Provider, System Prompt, Cerrar Sesión ...
@@ -235,24 +419,85 @@ else:
     )
     if selected_provider_display_sb.lower() != st.session_state.selected_provider:
         st.session_state.selected_provider = selected_provider_display_sb.lower()
+    fallback_provider = "gemini" if st.session_state.selected_provider == "openai" else "openai"
+    if st.session_state.api_key and not API_URL:
+        # El SDK del proveedor se importa mientras el usuario escribe, no al enviar el primer mensaje
+        preload_provider_sdk(st.session_state.selected_provider)
+    with st.sidebar.expander("Proveedor de respaldo"):
+        st.session_state.fallback_api_key = st.text_input(
+            f"API Key de {fallback_provider.capitalize()} (opcional)", type="password",
+            value=st.session_state.fallback_api_key if st.session_state.fallback_api_key else "",
+            help="Si el proveedor principal falla o no responde, se usa este.",
+            key="fallback_api_key_input_sidebar"
+        )
+        st.session_state.hedge_requests = st.checkbox(
+            "Lanzar también el respaldo si el principal tarda", value=st.session_state.hedge_requests,
+            help="Reduce la latencia en los casos lentos a costa de alguna petición duplicada.",
+            key="hedge_requests_checkbox", disabled=not st.session_state.fallback_api_key
+        )
+    if RESPONSE_CACHE_ENABLED:
+        st.session_state.use_response_cache = st.sidebar.checkbox(
+            "Usar caché de respuestas", value=st.session_state.use_response_cache,
+            help="Reutiliza respuestas anteriores a consultas idénticas sin llamar al proveedor LLM.",
+            key="use_response_cache_checkbox"
+        )
     with st.sidebar.expander("Prompt del Sistema (LexIA)"): st.caption(SYSTEM_PROMPT)
+    persistence_stats = get_persistence_stats()
+    if persistence_stats["depth"]:
+        st.sidebar.caption(f"Guardando {persistence_stats['depth']} turno(s) pendiente(s) (retraso: {persistence_stats['lag_seconds']:.1f} s)")
+    with st.sidebar.expander("Depuración: tiempos por turno"):
+        if not st.session_state.turn_timings:
+            st.caption("Aún no hay turnos en esta sesión.")
+        for timing in reversed(st.session_state.turn_timings):
+            record = timing.as_dict()
+            st.caption(
+                f"Total {record['total_ms']} ms · TTFT {record['ttft_ms']} ms · "
+                f"generación {record['generation_ms']} ms · tokens {record['tokens_in']}→{record['tokens_out']}"
+            )
+            st.json(record["by_kind_ms"], expanded=False)
     st.sidebar.markdown("---")
     if st.sidebar.button("Cerrar Sesión", key="logout_button_sidebar_multi", use_container_width=True): app_logout()
 
     # --- Main Chat Area ---
     st.title(st.session_state.active_conversation_title or "LexIA") # Título por defecto si no hay conv activa
-    st.caption(f"Usando: {st.session_state.selected_provider.capitalize()}")
+    provider_caption = st.empty()
+    provider_caption.caption(f"Usando: {st.session_state.selected_provider.capitalize()}")
 
     if st.session_state.active_conversation_id and not st.session_state.history_loaded_for_active_conv:
         with st.spinner("Cargando mensajes..."):
-            st.session_state.messages = get_messages_for_conversation(st.session_state.active_conversation_id)
+            # Solo la página más reciente; las anteriores se cargan bajo demanda
+            st.session_state.messages, st.session_state.messages_cursor = get_messages_page(
+                st.session_state.active_conversation_id, user_id=user_id
+            )
+            # Si venimos de un resultado de búsqueda, cargamos páginas anteriores hasta llegar a él
+            jump = st.session_state.search_jump
+            while jump and st.session_state.messages_cursor and \
+                    jump["content_md5"] not in {content_md5(m["content"]) for m in st.session_state.messages}:
+                older_messages, st.session_state.messages_cursor = get_messages_page(
+                    st.session_state.active_conversation_id,
+                    before=st.session_state.messages_cursor, user_id=user_id
+                )
+                st.session_state.messages = older_messages + st.session_state.messages
             st.session_state.history_loaded_for_active_conv = True
             st.rerun() 
 
     if st.session_state.active_conversation_id: # Si hay una conversación activa, mostrar sus mensajes
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        if st.session_state.messages_cursor:
+            if st.button("⬆️ Cargar mensajes anteriores", key="load_older_messages_btn"):
+                older_messages, st.session_state.messages_cursor = get_messages_page(
+                    st.session_state.active_conversation_id,
+                    before=st.session_state.messages_cursor, user_id=user_id
+                )
+                st.session_state.messages = older_messages + st.session_state.messages
+                st.rerun()
+        jump = st.session_state.search_jump
+        with span("render.history", kind="render"):
+            for message in st.session_state.messages:
+                if jump and message["role"] == jump["role"] and content_md5(message["content"]) == jump["content_md5"]:
+                    st.info(f"🔎 Resultado de la búsqueda: {jump['snippet']}")
+                    jump = None # Solo marcamos la primera coincidencia
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
     elif st.session_state.conversations_loaded and not st.session_state.conversations_list : # Si se cargaron las conversaciones y no hay ninguna
         st.info("No tienes conversaciones. Crea una nueva desde la barra lateral para comenzar.")
     elif not st.session_state.conversations_loaded: 
@@ -270,38 +515,95 @@ else:
             st.warning("Por favor, selecciona o crea una conversación para chatear.")
             st.stop()
 
-        is_first_message_in_conv = len(st.session_state.messages) == 0 
-        conv_needs_autotitle = st.session_state.active_conversation_title == DEFAULT_NEW_CONVERSATION_TITLE
-        rename_succeeded_this_turn = False
-
-        if is_first_message_in_conv and conv_needs_autotitle:
-            new_title_from_prompt = prompt[:MAX_TITLE_LENGTH] + ("..." if len(prompt) > MAX_TITLE_LENGTH else "")
-            error_rename = rename_conversation(st.session_state.active_conversation_id, new_title_from_prompt)
-            if error_rename is None: 
-                st.session_state.active_conversation_title = new_title_from_prompt
-                for conv_idx, c in enumerate(st.session_state.conversations_list):
-                    if c["id"] == st.session_state.active_conversation_id:
-                        st.session_state.conversations_list[conv_idx]["title"] = new_title_from_prompt
-                        break
-                rename_succeeded_this_turn = True
+        # Con LEXIA_API_URL, main.py es un cliente ligero: la API construye el contexto, aplica los límites, llama al LLM y guarda el turno
+        use_api = bool(API_URL and st.session_state.auth_session)
+        llm_context = None
+        if not use_api:
+            # Contexto (recuperación + recuento de tokens) una sola vez: lo reutilizan el límite, la caché y el proveedor
+            pending_history = st.session_state.messages + [{"role": "user", "content": prompt}]
+            llm_context = build_llm_context(pending_history, st.session_state.selected_provider)
+            admitted, retry_in, limited_scope = acquire_rate_limit(
+                user_id, st.session_state.api_key, pending_history, st.session_state.selected_provider, llm_context
+            )
+            if not admitted:
+                limited_by = "tu usuario" if limited_scope == "user" else "esta API Key"
+                st.warning(f"Has alcanzado el límite de consultas por minuto de {limited_by}. Vuelve a intentarlo en {math.ceil(retry_in)} s.")
+                st.stop()
+
+        with start_turn(provider=st.session_state.selected_provider) as turn_record:
+            st.session_state.turn_timings.append(turn_record)
+            is_first_message_in_conv = len(st.session_state.messages) == 0 and not st.session_state.messages_cursor
+            # El título lo genera un modelo barato en segundo plano después de la respuesta (auto_titles.py)
+            conv_needs_autotitle = is_first_message_in_conv and \
+                st.session_state.active_conversation_title == DEFAULT_NEW_CONVERSATION_TITLE
+
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            with span("render.user_message", kind="render"):
+                with st.chat_message("user"): st.markdown(prompt)
+
+            # El constructor de contexto elige cuántos mensajes recientes caben en el presupuesto de tokens
+            llm_history = list(st.session_state.messages)
+            fallback = (fallback_provider, st.session_state.fallback_api_key) if st.session_state.fallback_api_key else None
+            cached_response = None
+            if st.session_state.use_response_cache and not use_api:
+                cached_response = get_cached_llm_response(llm_history, st.session_state.selected_provider, llm_context)
+            with st.chat_message("assistant"):
+                if use_api:
+                    turn_stream = ChatTurnStream(
+                        API_URL, st.session_state.auth_session.access_token, st.session_state.active_conversation_id,
+                        prompt, st.session_state.selected_provider, st.session_state.api_key,
+                        auto_title=conv_needs_autotitle, fallback=fallback, hedge=st.session_state.hedge_requests,
+                        use_cache=st.session_state.use_response_cache
+                    )
+                    response_content = st.write_stream(turn_stream)
+                elif cached_response is not None: # Acierto de caché: no se llama al proveedor
+                    st.markdown(cached_response)
+                    response_content = cached_response
+                else:
+                    # Como mucho LEXIA_LLM_CONCURRENCY llamadas simultáneas por proveedor; el resto espera en cola
+                    with reserve_llm_slot(st.session_state.selected_provider) as llm_slot:
+                        wait_for_llm_slot(llm_slot)
+                        # st.write_stream pinta cada fragmento según llega y devuelve el texto completo
+                        response_content = st.write_stream(
+                            stream_llm_response(
+                                llm_history, st.session_state.api_key, st.session_state.selected_provider,
+                                fallback=fallback, hedge=st.session_state.hedge_requests, llm_context=llm_context
+                            )
+                        )
+            if not isinstance(response_content, str): # write_stream devuelve lista si hay fragmentos no-str
+                response_content = "".join(str(part) for part in response_content)
+            if not use_api and cached_response is None:
+                record_llm_usage(user_id, st.session_state.api_key, response_content, st.session_state.selected_provider)
+            if is_rate_limited_response(response_content) or (use_api and turn_stream.rate_limited):
+                # 429 (del proveedor tras los reintentos, o de los límites de la API): el turno no se guarda
+                st.session_state.messages.pop()
+                st.warning("No se ha guardado esta consulta. Vuelve a enviarla en unos segundos.")
+                st.stop()
+            if cached_response is not None:
+                provider_caption.caption(f"Usando: {st.session_state.selected_provider.capitalize()} · respuesta desde caché")
+            elif st.session_state.use_response_cache and not use_api:
+                store_llm_response(llm_history, st.session_state.selected_provider, response_content, llm_context)
+
+            st.session_state.messages.append({"role": "assistant", "content": response_content})
+
+            if use_api:
+                save_err_turn = turn_stream.save_error
+                if not save_err_turn:
+                    note_remote_turn(user_id, st.session_state.active_conversation_id)
+            else:
+                # Escritura diferida: el turno (ambos mensajes + updated_at + título) se guarda en segundo plano
+                save_err_turn = queue_turn(
+                    user_id, st.session_state.active_conversation_id, prompt, response_content
+                )
+            if save_err_turn:
+                st.error(f"Error guardando la conversación: {save_err_turn}")
             else:
-                st.error(f"No se pudo actualizar el título de la conversación: {error_rename}")
-        
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"): st.markdown(prompt)
-        
-        save_err_user = save_message(user_id, st.session_state.active_conversation_id, "user", prompt)
-        if save_err_user: st.error(f"Error guardando tu mensaje: {save_err_user}")
-
-        with st.spinner("LexIA está pensando..."):
-            llm_history = st.session_state.messages
-            response_content = get_llm_response(llm_history, st.session_state.api_key, st.session_state.selected_provider)
-        
-        st.session_state.messages.append({"role": "assistant", "content": response_content})
-        with st.chat_message("assistant"): st.markdown(response_content)
-
-        save_err_assistant = save_message(user_id, st.session_state.active_conversation_id, "assistant", response_content)
-        if save_err_assistant: st.error(f"Error guardando respuesta de LexIA: {save_err_assistant}")
-        
-        if rename_succeeded_this_turn: # Solo rerun si se renombró con éxito en este turno
-            st.rerun()
\ No newline at end of file
+                # updated_at cambió: la conversación pasa a encabezar la lista
+                move_conversation_to_top(st.session_state.active_conversation_id)
+                if conv_needs_autotitle and not use_api: # Con la API, el título lo pide el propio servidor
+                    title_error = request_auto_title(
+                        user_id, st.session_state.active_conversation_id, prompt, response_content,
+                        st.session_state.selected_provider, st.session_state.api_key, DEFAULT_NEW_CONVERSATION_TITLE
+                    )
+                    if not title_error: # Sin rerun: el fragmento de la barra lateral lo recoge al llegar
+                        st.session_state.pending_titles.add(st.session_state.active_conversation_id)
@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import streamlit as st
+
+
+# Límites por minuto (0 desactiva el límite). Son por proceso: con varios workers de la API, cada uno aplica los suyos
+USER_REQUESTS_PER_MINUTE = int(os.getenv("LEXIA_RATE_USER_RPM", "20"))
+USER_TOKENS_PER_MINUTE = int(os.getenv("LEXIA_RATE_USER_TPM", "100000"))
+KEY_REQUESTS_PER_MINUTE = int(os.getenv("LEXIA_RATE_KEY_RPM", "60"))
+KEY_TOKENS_PER_MINUTE = int(os.getenv("LEXIA_RATE_KEY_TPM", "400000"))
+PROVIDER_CONCURRENCY = int(os.getenv("LEXIA_LLM_CONCURRENCY", "8")) # Llamadas simultáneas al LLM por proveedor (0: sin límite)
+MAX_TRACKED_BUCKETS = 10000 # Por encima se olvidan los cubos llenos (equivalen a uno nuevo)
+RATE_LIMIT_RETRIES = 3 # Reintentos ante un 429 del proveedor antes de rendirse
+RATE_LIMIT_BASE_BACKOFF = 1.0
+RATE_LIMIT_MAX_BACKOFF = 20.0
+RATE_LIMITED_MARKER = "límite de peticiones del proveedor (429)"
+
+def hash_api_key(api_key):
+    """Las API Keys nunca se guardan en claro como clave de un diccionario."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest() if api_key else None
+
+class TokenBucket:
+    """Cubo de tokens: admite ráfagas de hasta `capacity` unidades y se rellena a `rate` por segundo."""
+
+    def __init__(self, capacity, rate, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self._clock = clock
+        self.level = float(capacity)
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """Segundos hasta poder consumir `amount` (0 si ya se puede)."""
+        self._refill()
+        amount = min(amount, self.capacity) # Lo que no cabe ni en una ráfaga pasa con el cubo lleno
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.level -= amount # Puede quedar en negativo: los tokens de salida se cobran a posteriori
+
+    def is_full(self):
+        self._refill()
+        return self.level >= self.capacity
+
+class RateLimiter:
+    """Límites de peticiones y de tokens por minuto, por usuario y por API Key (hasheada).
+
+    Una petición se admite solo si cabe en todos sus cubos a la vez; si no, no consume nada y se
+    devuelve cuánto esperar. Los tokens de entrada se cobran al admitir y los de salida al terminar
+    (record_usage), así que tras una respuesta larga el cubo de tokens puede quedar en negativo.
+    """
+
+    def __init__(self, user_rpm=USER_REQUESTS_PER_MINUTE, user_tpm=USER_TOKENS_PER_MINUTE,
+                 key_rpm=KEY_REQUESTS_PER_MINUTE, key_tpm=KEY_TOKENS_PER_MINUTE, clock=time.monotonic):
+        self.limits = {"user": (user_rpm, user_tpm), "api_key": (key_rpm, key_tpm)}
+        self._clock = clock
+        self._buckets = {} # (ámbito, clave) -> (cubo de peticiones, cubo de tokens)
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _bucket(self, capacity_per_minute):
+        if not capacity_per_minute:
+            return None
+        return TokenBucket(capacity_per_minute, capacity_per_minute / 60.0, self._clock)
+
+    def _buckets_for(self, user_id, api_key):
+        entries = []
+        for scope, key in (("user", user_id), ("api_key", hash_api_key(api_key))):
+            if key is None:
+                continue
+            entry = self._buckets.get((scope, key))
+            if entry is None:
+                rpm, tpm = self.limits[scope]
+                entry = self._buckets[(scope, key)] = (self._bucket(rpm), self._bucket(tpm))
+            entries.append((scope, entry))
+        return entries
+
+    def acquire(self, user_id, api_key, tokens=0):
+        """Intenta admitir una petición con `tokens` de entrada. Devuelve (admitida, segundos de espera, ámbito)."""
+        with self._lock:
+            entries = self._buckets_for(user_id, api_key)
+            wait, limited_scope = 0.0, None
+            for scope, (requests, token_bucket) in entries:
+                for bucket, amount in ((requests, 1), (token_bucket, tokens)):
+                    if bucket is not None and bucket.wait_time(amount) > wait:
+                        wait, limited_scope = bucket.wait_time(amount), scope
+            if limited_scope is not None:
+                self.rejected += 1
+                return False, wait, limited_scope
+            for _, (requests, token_bucket) in entries:
+                if requests is not None:
+                    requests.consume(1)
+                if token_bucket is not None:
+                    token_bucket.consume(tokens)
+            self.admitted += 1
+            if len(self._buckets) > MAX_TRACKED_BUCKETS:
+                self._prune()
+            return True, 0.0, None
+
+    def record_usage(self, user_id, api_key, tokens):
+        """Cobra los tokens de salida de una respuesta ya terminada."""
+        with self._lock:
+            for _, (_, token_bucket) in self._buckets_for(user_id, api_key):
+                if token_bucket is not None:
+                    token_bucket.consume(tokens)
+
+    def _prune(self):
+        for key in [k for k, buckets in self._buckets.items() if all(b is None or b.is_full() for b in buckets)]:
+            del self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            return {"admitted": self.admitted, "rejected": self.rejected, "tracked_buckets": len(self._buckets)}
+
+class LLMSlot:
+    """Plaza (o puesto en la cola) para una llamada al LLM; se obtiene con ProviderConcurrency.reserve."""
+
+    def __init__(self, limiter, provider):
+        self._limiter = limiter
+        self.provider = provider
+        self.granted = False
+        self.released = False
+
+    def position(self):
+        """Puesto en la cola (1 = el siguiente); 0 si ya tiene plaza."""
+        return self._limiter._position(self)
+
+    def wait(self, timeout=None):
+        """Espera a tener plaza. Devuelve False si vence el timeout."""
+        return self._limiter._wait(self, timeout)
+
+    async def wait_async(self, on_position=None, poll_seconds=0.05):
+        """Versión para event loops: sondea en lugar de bloquear un hilo por petición en espera.
+
+        `on_position(puesto)` (corrutina) se llama cada vez que cambia el puesto en la cola.
+        """
+        position = None
+        while not self.wait(0):
+            if on_position is not None and self.position() != position:
+                position = self.position()
+                await on_position(position)
+            await asyncio.sleep(poll_seconds)
+
+    def release(self):
+        """Libera la plaza, o abandona la cola si aún no la tenía. Idempotente."""
+        self._limiter._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class ProviderConcurrency:
+    """Semáforo FIFO por proveedor: como mucho `limit` llamadas simultáneas al LLM en el proceso.
+
+    Las peticiones que no caben esperan en orden de llegada; position() permite mostrar al
+    usuario su puesto en la cola mientras espera.
+    """
+
+    def __init__(self, limit=PROVIDER_CONCURRENCY):
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._active = {}
+        self._queues = {}
+
+    def reserve(self, provider):
+        slot = LLMSlot(self, provider)
+        with self._cond:
+            self._queues.setdefault(provider, deque()).append(slot)
+            self._promote(provider)
+        return slot
+
+    def _promote(self, provider):
+        queue = self._queues[provider]
+        while queue and (self.limit <= 0 or self._active.get(provider, 0) < self.limit):
+            slot = queue.popleft()
+            slot.granted = True
+            self._active[provider] = self._active.get(provider, 0) + 1
+        self._cond.notify_all()
+
+    def _position(self, slot):
+        with self._cond:
+            if slot.granted or slot.released:
+                return 0
+            return self._queues[slot.provider].index(slot) + 1
+
+    def _wait(self, slot, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: slot.granted, timeout)
+
+    def _release(self, slot):
+        with self._cond:
+            if slot.released:
+                return
+            slot.released = True
+            if slot.granted:
+                self._active[slot.provider] -= 1
+            else:
+                self._queues[slot.provider].remove(slot)
+            self._promote(slot.provider)
+
+    def stats(self):
+        with self._cond:
+            return {provider: {"active": self._active.get(provider, 0), "waiting": len(queue)}
+                    for provider, queue in self._queues.items()}
+
+# --- 429 del proveedor ---
+
+def is_rate_limit_error(e):
+    """429 de OpenAI (RateLimitError), de Gemini (ResourceExhausted) o de cualquier cliente HTTP."""
+    while e is not None:
+        status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+        if status == 429 or getattr(e, "code", None) == 429 or type(e).__name__ in ("RateLimitError", "ResourceExhausted"):
+            return True
+        e = e.__cause__
+    return False
+
+def _retry_after(e):
+    try:
+        return float(e.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def rate_limit_backoff(attempt, retry_after=None, base=RATE_LIMIT_BASE_BACKOFF, maximum=RATE_LIMIT_MAX_BACKOFF, rng=random):
+    """Backoff exponencial con jitter completo; nunca menos de lo que pida la cabecera Retry-After."""
+    delay = rng.uniform(0, min(maximum, base * (2 ** attempt)))
+    return max(delay, min(maximum, retry_after or 0.0))
+
+async def astream_with_rate_limit_retry(open_stream, retries=None, sleep=asyncio.sleep, rng=random):
+    """Reintenta con backoff los 429 del proveedor mientras no haya llegado el primer fragmento.
+
+    `open_stream()` debe devolver un generador asíncrono nuevo en cada intento. Después del
+    primer fragmento ya no se puede reintentar sin duplicar texto, así que el error se propaga.
+    """
+    retries = RATE_LIMIT_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        stream = open_stream()
+        try:
+            first_chunk = await stream.__anext__()
+        except StopAsyncIteration:
+            return
+        except Exception as e:
+            await stream.aclose()
+            if not is_rate_limit_error(e) or attempt >= retries:
+                raise
+            delay = rate_limit_backoff(attempt, _retry_after(e), rng=rng)
+            attempt += 1
+            print(f"429 del proveedor: reintento {attempt}/{retries} en {delay:.1f} s")
+            await sleep(delay)
+            continue
+        try:
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+        return
+
+def is_rate_limited_response(text):
+    """Respuesta que solo contiene el aviso de 429: se muestra, pero no se guarda como mensaje."""
+    return bool(text) and text.startswith("Error") and RATE_LIMITED_MARKER in text
+
+@st.cache_resource
+def get_rate_limiter():
+    """Limitador compartido por todas las sesiones del proceso."""
+    return RateLimiter()
+
+@st.cache_resource
+def get_provider_concurrency():
+    """Semáforos por proveedor compartidos por todas las sesiones del proceso."""
+    return ProviderConcurrency()
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import streamlit as st
+
+
+DEFAULT_CACHE_PATH = os.path.join(".lexia_cache", "responses.sqlite3")
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600 # Las respuestas jurídicas pueden quedar obsoletas: una semana
+
+def normalize_text(text):
+    """Normaliza una consulta para que variantes triviales compartan entrada de caché."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip("¿?¡!.,;: ")
+
+def make_cache_key(provider, model, system_prompt, context_messages):
+    """Clave exacta: proveedor, modelo, hash del prompt del sistema y contexto normalizado."""
+    payload = {
+        "provider": provider,
+        "model": model,
+        "system_prompt": hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(),
+        "context": [[msg["role"], normalize_text(msg["content"])] for msg in context_messages]
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Caché de respuestas en SQLite con TTL y expulsión LRU por número de entradas."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES,
+                 ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, response TEXT NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access_idx ON responses (last_access)")
+
+    def get(self, key):
+        now = self._clock()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] + self.ttl_seconds <= now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, response):
+        now = self._clock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+@st.cache_resource
+def get_response_cache():
+    """Caché de respuestas compartida por el proceso (ruta configurable con LEXIA_RESPONSE_CACHE_PATH)."""
+    return ResponseCache(os.getenv("LEXIA_RESPONSE_CACHE_PATH", DEFAULT_CACHE_PATH))
@@ -1,24 +1,227 @@
-from supabase import create_client, Client
+import contextvars
+import functools
+import hashlib
 import os
+import threading
+import time
+from contextlib import contextmanager
+import streamlit as st
 from dotenv import load_dotenv
+from telemetry import timed
 
+# Solo se lee el .env: es barato y el resto de módulos toma su configuración (LEXIA_*) al importarse.
+# Los SDK (supabase, gotrue, postgrest, httpx) se importan la primera vez que se usan.
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY") # Asegúrate que esta es tu ANON KEY
 
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    print(f"Error al inicializar Supabase client: {e}")
-    supabase = None
+TOKEN_CACHE_SECONDS = 60 # Un token verificado se da por bueno este tiempo sin volver a preguntar a Supabase Auth
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("LEXIA_TOKEN_REFRESH_MARGIN", "300")) # Renovar cuando quede menos que esto
+HTTP_POOL_SIZE = int(os.getenv("LEXIA_SUPABASE_POOL_SIZE", "100")) # Conexiones a Supabase compartidas por todo el proceso
+HTTP_TIMEOUT_SECONDS = 30.0
+HTTP_CONNECT_TIMEOUT_SECONDS = 10.0
 
+# Cliente de la operación en curso (petición de la API o ejecución del script de una sesión de Streamlit):
+# lleva el token del usuario, no la sesión del cliente global
+_request_client = contextvars.ContextVar("lexia_supabase_client", default=None)
+_verified_tokens = {} # sha256(token) -> (usuario, caduca_en)
+_verified_tokens_lock = threading.Lock()
+_http_transport = None
+_http_transport_lock = threading.Lock()
+
+def is_configured():
+    return bool(SUPABASE_URL and SUPABASE_KEY)
+
+@st.cache_resource
+def get_supabase_client():
+    """Cliente global (anon key) del proceso, creado la primera vez que se necesita. None si falla."""
+    try:
+        from supabase import create_client
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
+    except Exception as e:
+        print(f"Error al inicializar Supabase client: {e}")
+        return None
+
+def get_supabase():
+    """Cliente para la operación actual: el de la petición (use_client/bind_client) o, si no hay, el global."""
+    return _request_client.get() or get_supabase_client()
+
+@contextmanager
+def use_client(client):
+    """Hace que get_supabase() devuelva `client` en este contexto (y en los hilos lanzados con asyncio.to_thread)."""
+    token = _request_client.set(client)
+    try:
+        yield client
+    finally:
+        _request_client.reset(token)
+
+def bind_client(client):
+    """Fija el cliente de get_supabase() para el resto del contexto actual (p. ej. una ejecución del script)."""
+    _request_client.set(client)
+
+def _http_timeout():
+    import httpx
+    return httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+
+def _shared_transport():
+    """Pool de conexiones HTTP (keep-alive, HTTP/2) común a todos los clientes por usuario del proceso."""
+    global _http_transport
+    with _http_transport_lock:
+        if _http_transport is None:
+            import httpx
+            _http_transport = httpx.HTTPTransport(
+                http2=True, limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+            )
+        return _http_transport
+
+@functools.cache
+def _pooled_postgrest_class():
+    # La subclase se define al primer uso para no importar postgrest al cargar el módulo
+    from postgrest import SyncPostgrestClient
+    from postgrest.utils import SyncClient as PostgrestHttpClient
+
+    class PooledPostgrestClient(SyncPostgrestClient):
+        def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+            # Cada usuario tiene su httpx.Client (cabeceras propias) sobre el transporte compartido.
+            # No llamar a aclose(): cerraría el transporte de todos.
+            return PostgrestHttpClient(base_url=base_url, headers=headers, timeout=timeout,
+                                       transport=_shared_transport(), follow_redirects=True)
+
+    return PooledPostgrestClient
+
+class UserClient:
+    """Cliente de PostgREST con el JWT de un usuario: lo que usa chat_utils (table y rpc).
+
+    A diferencia de create_client no crea clientes de auth, storage ni realtime, y comparte el pool
+    de conexiones del proceso, así que crear uno por sesión o por petición es barato.
+    """
+
+    def __init__(self, access_token):
+        self.postgrest = _pooled_postgrest_class()(
+            f"{SUPABASE_URL}/rest/v1",
+            headers={"apiKey": SUPABASE_KEY, "Authorization": f"Bearer {access_token}"},
+            timeout=_http_timeout()
+        )
+
+    def set_access_token(self, access_token):
+        self.postgrest.auth(access_token)
+
+    def table(self, table_name):
+        return self.postgrest.from_(table_name)
+
+    def rpc(self, fn, params=None, count=None, head=False, get=False):
+        return self.postgrest.rpc(fn, params or {}, count, head, get)
+
+def create_user_client(access_token):
+    """Cliente cuyas consultas a PostgREST van con el JWT del usuario, de modo que RLS lo identifica."""
+    return UserClient(access_token)
+
+def get_auth():
+    """Cliente de Supabase Auth para una sola operación (login, registro, refresco, validación).
+
+    El cliente global guarda la sesión del último login y la aplica a todas sus consultas, así que
+    con varias sesiones de Streamlit en el mismo proceso las identidades se mezclaban. Este no
+    guarda nada que otra sesión pueda ver: los tokens viven en la UserSession de cada usuario.
+    """
+    from gotrue import SyncGoTrueClient
+    from gotrue.http_clients import SyncClient as AuthHttpClient
+    return SyncGoTrueClient(
+        url=f"{SUPABASE_URL}/auth/v1",
+        headers={"apiKey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+        auto_refresh_token=False,
+        persist_session=False,
+        http_client=AuthHttpClient(transport=_shared_transport(), timeout=_http_timeout(), follow_redirects=True)
+    )
+
+class UserSession:
+    """Tokens de un usuario y su cliente de Supabase; se guarda en st.session_state.
+
+    El cliente se crea una vez por sesión y se reutiliza en cada rerun. Cuando al access token le
+    quedan menos de TOKEN_REFRESH_MARGIN_SECONDS se renueva en un hilo aparte, fuera del camino de
+    la petición; solo si ya ha caducado se renueva de forma síncrona. El token nuevo se aplica al
+    mismo cliente, de modo que quien lo haya capturado (p. ej. la cola de escritura) también lo usa.
+    """
+
+    def __init__(self, session, clock=time.time):
+        self._clock = clock
+        self._refresh_lock = threading.Lock() # Un solo refresco a la vez por sesión
+        self._thread_lock = threading.Lock()
+        self._refresh_thread = None
+        self.user = session.user
+        self._apply(session)
+        self._client = create_user_client(self.access_token)
+
+    def _apply(self, session):
+        self.access_token = session.access_token
+        self.refresh_token = session.refresh_token
+        self.expires_at = session.expires_at or self._clock() + (session.expires_in or 3600)
+
+    def client(self):
+        """Cliente con el token vigente."""
+        remaining = self.expires_at - self._clock()
+        if remaining <= 0:
+            self.refresh()
+        elif remaining < TOKEN_REFRESH_MARGIN_SECONDS:
+            self._refresh_in_background()
+        return self._client
+
+    def _refresh_in_background(self):
+        with self._thread_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self.refresh, name="lexia-token-refresh", daemon=True)
+            self._refresh_thread.start()
+
+    @timed("auth.refresh_token", kind="auth")
+    def refresh(self):
+        """Renueva el access token con el refresh token. Devuelve None o el mensaje de error."""
+        with self._refresh_lock:
+            if self.expires_at - self._clock() >= TOKEN_REFRESH_MARGIN_SECONDS:
+                return None # Ya lo renovó otro hilo
+            try:
+                response = get_auth().refresh_session(self.refresh_token)
+                if not response.session:
+                    return "Supabase no devolvió una sesión nueva."
+                self._apply(response.session)
+                self._client.set_access_token(self.access_token)
+                return None
+            except Exception as e:
+                print(f"Error renovando el token de acceso: {str(e)}")
+                return str(e)
+
+@timed("auth.verify_token", kind="auth")
+def verify_access_token(access_token):
+    """Valida un access token con Supabase Auth. Devuelve (usuario, error)."""
+    if not is_configured():
+        return None, "Supabase client no inicializado."
+    if not access_token:
+        return None, "Falta el token de acceso."
+    key = hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+    now = time.monotonic()
+    with _verified_tokens_lock:
+        cached = _verified_tokens.get(key)
+        if cached and cached[1] > now:
+            return cached[0], None
+    try:
+        response = get_auth().get_user(access_token)
+        if response and response.user:
+            with _verified_tokens_lock:
+                _verified_tokens[key] = (response.user, now + TOKEN_CACHE_SECONDS)
+                for expired in [k for k, (_, expires) in _verified_tokens.items() if expires <= now]:
+                    del _verified_tokens[expired]
+            return response.user, None
+        return None, "Token de acceso no válido."
+    except Exception as e:
+        return None, f"Excepción al validar el token: {str(e)}"
+
+@timed("auth.sign_up", kind="auth")
 def sign_up_user(email, password):
     """Registra un nuevo usuario."""
-    if not supabase:
+    if not is_configured():
         return None, "Supabase client no inicializado."
     try:
-        response = supabase.auth.sign_up({"email": email, "password": password})
+        response = get_auth().sign_up({"email": email, "password": password})
         # response tiene .user, .session, .error
         if response.user and response.user.id: # Éxito si hay un usuario y tiene ID
             return response.user, None
@@ -29,47 +232,39 @@ def sign_up_user(email, password):
     except Exception as e:
         return None, f"Excepción durante el registro: {str(e)}"
 
+@timed("auth.sign_in", kind="auth")
 def sign_in_user(email, password):
-    """Inicia sesión de un usuario existente."""
-    if not supabase:
-        return None, "Supabase client no inicializado."
+    """Inicia sesión de un usuario existente. Devuelve (usuario, UserSession, error)."""
+    if not is_configured():
+        return None, None, "Supabase client no inicializado."
     try:
-        response = supabase.auth.sign_in_with_password({"email": email, "password": password})
+        response = get_auth().sign_in_with_password({"email": email, "password": password})
         if response.user and response.user.id:
-            return response.user, None
+            return response.user, UserSession(response.session), None
         elif response.error:
-            return None, response.error.message
+            return None, None, response.error.message
         else: # Caso inesperado
-            return None, "Error desconocido durante el inicio de sesión."
+            return None, None, "Error desconocido durante el inicio de sesión."
     except Exception as e:
-        return None, f"Excepción durante el inicio de sesión: {str(e)}"
+        return None, None, f"Excepción durante el inicio de sesión: {str(e)}"
 
-def sign_out_user():
-    """Cierra la sesión del usuario actual."""
-    if not supabase:
+@timed("auth.sign_out", kind="auth")
+def sign_out_user(user_session):
+    """Cierra la sesión del usuario (revoca su refresh token en Supabase)."""
+    if not is_configured():
         return "Supabase client no inicializado."
+    if user_session is None:
+        return None
     try:
-        error = supabase.auth.sign_out() # Devuelve None en éxito, o un AuthError
-        if error: 
-            if hasattr(error, 'message'):
-                return error.message
-            return "Error desconocido durante el cierre de sesión."
+        get_auth().admin.sign_out(user_session.access_token, "local")
         return None # Éxito
     except Exception as e:
         return f"Excepción durante el cierre de sesión: {str(e)}"
 
-def get_current_user():
-    """Obtiene el usuario actualmente autenticado."""
-    if not supabase:
-        return None, "Supabase client no inicializado."
-    try:
-        # get_user() intentará refrescar el token si es necesario y está presente.
-        # Si no hay sesión válida (token expirado o no presente), response.user será None.
-        response = supabase.auth.get_user()
-        if response and response.user: # Asegurarse de que response no es None antes de acceder a .user
-            return response.user, None
-        # Si response.user es None, puede no haber error explícito, simplemente no hay sesión.
-        # Devolveremos None, None para indicar "no usuario, no error de operación".
-        return None, None
-    except Exception as e:
-        return None, f"Excepción al obtener usuario: {str(e)}"
\ No newline at end of file
+@timed("auth.get_current_user", kind="auth")
+def get_current_user(user_session):
+    """Obtiene el usuario de una UserSession, validando su token con Supabase Auth."""
+    if user_session is None:
+        return None, None # Sin sesión: "no usuario, no error de operación"
+    user_session.client() # Renueva el token si hace falta
+    return verify_access_token(user_session.access_token)
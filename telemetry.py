@@ -0,0 +1,217 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Segundos
+METRICS_FILE = os.getenv("LEXIA_METRICS_FILE") # Si se define, se reescribe en formato Prometheus tras cada turno
+METRICS_PORT = os.getenv("LEXIA_METRICS_PORT") # Si se define, se sirve /metrics en ese puerto
+JSON_LOGS_ENABLED = os.getenv("LEXIA_TELEMETRY_JSON_LOGS", "1") == "1"
+
+logger = logging.getLogger("lexia.telemetry")
+if JSON_LOGS_ENABLED and not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current_turn = contextvars.ContextVar("lexia_current_turn", default=None)
+
+class Metrics:
+    """Histogramas de duración por span, exportables en formato de texto de Prometheus."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {} # (name, kind) -> [counts por bucket..., +Inf], suma, total
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, kind, seconds):
+        with self._lock:
+            hist = self._histograms.setdefault((name, kind), {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for idx, upper in enumerate(self.buckets):
+                if seconds <= upper:
+                    hist["buckets"][idx] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP lexia_span_seconds Duración de las operaciones instrumentadas.",
+            "# TYPE lexia_span_seconds histogram"
+        ]
+        with self._lock:
+            for (name, kind), hist in sorted(self._histograms.items()):
+                labels = f'span="{name}",kind="{kind}"'
+                for upper, count in zip(self.buckets, hist["buckets"]):
+                    lines.append(f'lexia_span_seconds_bucket{{{labels},le="{upper}"}} {count}')
+                lines.append(f'lexia_span_seconds_bucket{{{labels},le="+Inf"}} {hist["count"]}')
+                lines.append(f"lexia_span_seconds_sum{{{labels}}} {hist['sum']:.6f}")
+                lines.append(f"lexia_span_seconds_count{{{labels}}} {hist['count']}")
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE lexia_{name}_total counter")
+                lines.append(f"lexia_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path) # Escritura atómica para el textfile collector de node_exporter
+
+metrics = Metrics()
+
+class TurnRecord:
+    """Desglose de tiempos de un turno de chat: spans, time-to-first-token y tokens."""
+
+    def __init__(self, provider=None):
+        self.turn_id = str(uuid.uuid4())
+        self.provider = provider
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+        self.ttft_ms = None
+        self.generation_ms = None
+        self.tokens_in = None
+        self.tokens_out = None
+        self.total_ms = None
+
+    def add_span(self, name, kind, duration_ms):
+        self.spans.append({"name": name, "kind": kind, "duration_ms": round(duration_ms, 2)})
+
+    def totals_by_kind(self):
+        totals = {}
+        for span in self.spans:
+            totals[span["kind"]] = round(totals.get(span["kind"], 0.0) + span["duration_ms"], 2)
+        return totals
+
+    def finish(self):
+        self.total_ms = round((time.perf_counter() - self._start) * 1000, 2)
+
+    def as_dict(self):
+        return {
+            "turn_id": self.turn_id,
+            "provider": self.provider,
+            "started_at": self.started_at,
+            "total_ms": self.total_ms,
+            "ttft_ms": self.ttft_ms,
+            "generation_ms": self.generation_ms,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "by_kind_ms": self.totals_by_kind(),
+            "spans": self.spans
+        }
+
+def current_turn():
+    return _current_turn.get()
+
+@contextmanager
+def start_turn(provider=None):
+    """Abre el registro de un turno; los spans del mismo hilo/contexto se asocian a él."""
+    turn = TurnRecord(provider)
+    token = _current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        _current_turn.reset(token)
+        turn.finish()
+        metrics.observe("turn", "turn", turn.total_ms / 1000)
+        metrics.increment("turns")
+        if JSON_LOGS_ENABLED:
+            logger.info(json.dumps({"event": "turn", **turn.as_dict()}, ensure_ascii=False))
+        if METRICS_FILE:
+            try:
+                metrics.write_file(METRICS_FILE)
+            except OSError as e:
+                print(f"Error escribiendo métricas en {METRICS_FILE}: {str(e)}")
+
+@contextmanager
+def span(name, kind="other"):
+    """Mide un bloque y lo registra en las métricas y, si hay uno abierto, en el turno actual.
+
+    kind agrupa los spans en el desglose: db_read, db_write, auth, llm, render...
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(name, kind, elapsed)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn.add_span(name, kind, elapsed * 1000)
+
+def timed(name, kind="other"):
+    """Decorador equivalente a envolver la función en span(name, kind)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_stream(chunks, name="llm.stream", tokens_out=None):
+    """Envuelve un generador de fragmentos midiendo time-to-first-token y generación total.
+
+    `tokens_out(texto)` (opcional) calcula los tokens de salida sobre la respuesta completa.
+    """
+    turn = _current_turn.get()
+    started = time.perf_counter()
+    first_chunk_at = None
+    parts = []
+    try:
+        for chunk in chunks:
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+                metrics.observe(f"{name}.ttft", "llm", first_chunk_at - started)
+                if turn is not None:
+                    turn.ttft_ms = round((first_chunk_at - started) * 1000, 2)
+            parts.append(chunk)
+            yield chunk
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe(name, "llm", elapsed)
+        if turn is not None:
+            turn.generation_ms = round(elapsed * 1000, 2)
+            turn.add_span(name, "llm", elapsed * 1000)
+            if tokens_out is not None:
+                turn.tokens_out = tokens_out("".join(parts))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # Sin log por petición de scraping
+        pass
+
+def start_metrics_server(port):
+    """Sirve /metrics en un hilo aparte. Devuelve el servidor (o None si el puerto está ocupado)."""
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+    except OSError as e:
+        print(f"No se pudo iniciar el endpoint de métricas en el puerto {port}: {str(e)}")
+        return None
+    threading.Thread(target=server.serve_forever, name="lexia-metrics", daemon=True).start()
+    return server
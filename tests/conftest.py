@@ -0,0 +1,27 @@
+"""Fixtures comunes: Supabase falso en memoria (benchmarks/fakes.py) ligado con use_client."""
+import logging
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("LEXIA_TELEMETRY_JSON_LOGS", "0")
+os.environ.setdefault("LEXIA_RESPONSE_CACHE", "0")
+
+import pytest
+
+from benchmarks.fakes import FakeSupabase
+from chat_cache import get_chat_cache
+from supabase_client import use_client
+
+
+logging.getLogger("streamlit").setLevel(logging.ERROR) # st.cache_resource fuera de `streamlit run`
+
+@pytest.fixture
+def fake_db():
+    """FakeSupabase sin latencia como cliente de get_supabase() durante el test, con la caché vacía."""
+    db = FakeSupabase(latency=0.0)
+    get_chat_cache().clear()
+    with use_client(db):
+        yield db
+    get_chat_cache().clear()
@@ -0,0 +1,70 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import api_server
+import chat_utils
+from benchmarks.fakes import FakeProvider
+from rate_limits import get_rate_limiter
+
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+OTHER_USER_ID = "00000000-0000-0000-0000-000000000002"
+
+@pytest.fixture
+def api(fake_db, monkeypatch):
+    """api_server.app con el Supabase falso, un usuario ya autenticado y un proveedor LLM falso."""
+    monkeypatch.setattr(api_server, "verify_access_token", lambda access_token: (SimpleNamespace(id=USER_ID), None))
+    monkeypatch.setattr(api_server, "create_user_client", lambda access_token: fake_db)
+    provider = FakeProvider(ttft=0, tokens_per_second=0, output_tokens=3)
+    monkeypatch.setitem(chat_utils.LLM_STREAM_PROVIDERS, "openai", provider)
+    return provider
+
+def post(path, body):
+    """Una petición ASGI a api_server.app. Devuelve (status, cuerpo)."""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps(body).encode("utf-8"), "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "query_string": b"",
+             "headers": [(b"authorization", b"Bearer token"), (b"x-llm-api-key", b"sk-test")]}
+    asyncio.run(api_server.app(scope, receive, send))
+    return messages[0]["status"], b"".join(m.get("body", b"") for m in messages[1:]).decode("utf-8")
+
+@pytest.mark.parametrize("owner", [OTHER_USER_ID, None])
+def test_posting_to_a_foreign_or_deleted_conversation_is_a_404_before_the_llm_call(api, fake_db, owner):
+    conversation = chat_utils.create_conversation(owner or USER_ID)
+    if owner is None:
+        chat_utils.delete_conversation_and_messages(conversation["id"], USER_ID)
+    admitted = get_rate_limiter().stats()["admitted"]
+
+    status, body = post(f"/conversations/{conversation['id']}/messages", {"content": "¿Fianza?"})
+
+    assert status == 404
+    assert json.loads(body) == {"error": "Conversación no encontrada."}
+    assert api.calls == 0
+    assert get_rate_limiter().stats()["admitted"] == admitted # No consume el límite del usuario
+    assert fake_db.tables["messages"] == []
+
+def test_posting_to_an_own_conversation_streams_and_saves_the_turn(api, fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+
+    status, body = post(f"/conversations/{conversation['id']}/messages", {"content": "¿Fianza?"})
+
+    assert status == 200
+    assert "event: done" in body
+    assert [m["content"] for m in fake_db.tables["messages"]] == ["¿Fianza?", "tok0 tok1 tok2 "]
+
+def test_use_cache_must_be_a_boolean(api, fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+
+    status, body = post(f"/conversations/{conversation['id']}/messages", {"content": "¿Fianza?", "use_cache": "no"})
+
+    assert status == 400
+    assert api.calls == 0
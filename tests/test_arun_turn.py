@@ -0,0 +1,123 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import chat_utils
+from benchmarks.fakes import FakeProvider, FakeSupabase
+from rate_limits import RATE_LIMITED_MARKER
+from supabase_client import use_client
+
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+DB_LATENCY = 0.2
+LLM_SECONDS = 0.3
+
+@pytest.fixture
+def slow_db(fake_db):
+    db = FakeSupabase(latency=DB_LATENCY, jitter=0.0)
+    with use_client(db):
+        yield db
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    provider = FakeProvider(ttft=LLM_SECONDS, tokens_per_second=0, output_tokens=5)
+    monkeypatch.setitem(chat_utils.LLM_STREAM_PROVIDERS, "openai", provider)
+    return provider
+
+def run_turn(conversation_id, question, **kwargs):
+    chunks = []
+
+    async def on_chunk(chunk):
+        chunks.append(chunk)
+
+    history = [{"role": "user", "content": question}]
+    response, error = asyncio.run(chat_utils.arun_turn(USER_ID, conversation_id, history, "sk-test", on_chunk=on_chunk, **kwargs))
+    return response, error, chunks
+
+def test_arun_turn_streams_and_saves_both_sides_of_the_turn(slow_db, fake_llm):
+    conversation = chat_utils.create_conversation(USER_ID)
+    before = slow_db.round_trips
+
+    response, error, chunks = run_turn(conversation["id"], "¿Plazo de prescripción?", new_title="Prescripción")
+
+    assert error is None
+    assert response == "".join(chunks) == "".join(f"tok{idx} " for idx in range(5))
+    assert slow_db.round_trips - before == 2 # Mensaje del usuario + título, y después la respuesta
+    assert [m["content"] for m in slow_db.tables["messages"]] == ["¿Plazo de prescripción?", response]
+    assert slow_db.tables["messages"][0]["created_at"] < slow_db.tables["messages"][1]["created_at"]
+    assert slow_db.tables["conversations"][0]["title"] == "Prescripción"
+
+def test_the_user_side_save_overlaps_the_llm_call(slow_db, fake_llm):
+    conversation = chat_utils.create_conversation(USER_ID)
+
+    started = time.perf_counter()
+    _, error, _ = run_turn(conversation["id"], "¿Fianza?", new_title="Fianza")
+    elapsed = time.perf_counter() - started
+
+    assert error is None
+    # Hasta la respuesta completa: max(LLM, guardado del usuario), no su suma; luego el guardado de la respuesta
+    overlapped = max(LLM_SECONDS, DB_LATENCY) + DB_LATENCY
+    serial = DB_LATENCY + LLM_SECONDS + DB_LATENCY
+    assert overlapped <= elapsed < overlapped + (serial - overlapped) / 2
+
+def test_a_persistent_429_leaves_the_turn_unsaved(fake_db, monkeypatch):
+    notice = f"Error con OpenAI: {RATE_LIMITED_MARKER}. Espera unos segundos y vuelve a intentarlo."
+
+    async def rate_limited(chat_history_for_llm, api_key, llm_context=None):
+        yield notice
+
+    monkeypatch.setitem(chat_utils.LLM_STREAM_PROVIDERS, "openai", rate_limited)
+    conversation = chat_utils.create_conversation(USER_ID)
+
+    response, error, _ = run_turn(conversation["id"], "¿Usucapión?")
+
+    assert (response, error) == (notice, None)
+    assert fake_db.tables["messages"] == []
+
+def test_get_llm_response_is_a_sync_wrapper_over_the_stream(fake_llm):
+    history = [{"role": "user", "content": "¿Plazo?"}]
+
+    assert chat_utils.get_llm_response(history, "sk-test") == "".join(f"tok{idx} " for idx in range(5))
+
+def test_the_llm_context_is_built_once_per_turn(fake_db, monkeypatch):
+    builds = []
+    build_context = chat_utils.build_context
+    monkeypatch.setattr(chat_utils, "build_context", lambda *args, **kwargs: builds.append(1) or build_context(*args, **kwargs))
+    cache = {}
+    monkeypatch.setattr(chat_utils, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(chat_utils, "get_response_cache", lambda: SimpleNamespace(get=cache.get, set=cache.__setitem__))
+    sent = []
+
+    async def provider(chat_history_for_llm, api_key, llm_context=None):
+        sent.append(chat_utils._build_openai_messages(chat_history_for_llm, llm_context))
+        yield "Cinco años."
+
+    monkeypatch.setitem(chat_utils.LLM_STREAM_PROVIDERS, "openai", provider)
+    conversation = chat_utils.create_conversation(USER_ID)
+    history = [{"role": "user", "content": "¿Plazo de prescripción?"}]
+
+    # Como api_server.post_message: límite de uso, caché, proveedor y guardado en la caché con un solo contexto
+    llm_context = chat_utils.build_llm_context(history, "openai")
+    assert chat_utils.acquire_rate_limit(USER_ID, "sk-test", history, "openai", llm_context)[0]
+    response, error = asyncio.run(chat_utils.arun_turn(USER_ID, conversation["id"], history, "sk-test", llm_context=llm_context))
+
+    assert (response, error) == ("Cinco años.", None)
+    assert sent[0][-1] == history[-1]
+    assert list(cache.values()) == ["Cinco años."]
+    assert len(builds) == 1
+
+@pytest.mark.parametrize("use_cache", [True, False])
+def test_the_response_cache_opt_out_skips_both_lookup_and_store(fake_db, fake_llm, monkeypatch, use_cache):
+    cache = {}
+    monkeypatch.setattr(chat_utils, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(chat_utils, "get_response_cache", lambda: SimpleNamespace(get=cache.get, set=cache.__setitem__))
+    conversation = chat_utils.create_conversation(USER_ID)
+
+    first, _, _ = run_turn(conversation["id"], "¿Plazo?", use_cache=use_cache)
+    second, _, _ = run_turn(conversation["id"], "¿Plazo?", use_cache=use_cache)
+
+    assert first == second
+    assert len(cache) == (1 if use_cache else 0)
+    assert fake_llm.calls == (1 if use_cache else 2)
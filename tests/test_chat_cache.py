@@ -0,0 +1,164 @@
+import pytest
+
+import chat_utils
+from benchmarks.fakes import FakeClock
+from chat_cache import ChatCache, estimate_size
+from write_queue import WriteBehindQueue
+
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+OTHER_USER_ID = "00000000-0000-0000-0000-000000000002"
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def cache(fake_db, clock, monkeypatch):
+    """chat_utils con una caché propia sobre el reloj falso."""
+    cache = ChatCache(max_bytes=1024 * 1024, ttl_seconds=60, clock=clock)
+    monkeypatch.setattr(chat_utils, "get_chat_cache", lambda: cache)
+    return cache
+
+def entry_bytes(cache):
+    return sum(estimate_size(rows) for rows, _, _ in cache._entries.values())
+
+# --- ChatCache ---
+
+def test_entries_expire_after_the_ttl_and_update_does_not_renew_it(clock):
+    cache = ChatCache(ttl_seconds=60, clock=clock)
+    cache.set(("messages", USER_ID, "c1"), [{"content": "hola"}])
+    clock.advance(59)
+    assert cache.update(("messages", USER_ID, "c1"), lambda rows: rows.append({"content": "adiós"}))
+    assert len(cache.get(("messages", USER_ID, "c1"))) == 2
+    clock.advance(1)
+    assert cache.get(("messages", USER_ID, "c1")) is None
+    assert cache.stats()["bytes"] == 0
+
+def test_update_tracks_size_deltas(clock):
+    cache = ChatCache(clock=clock)
+    cache.set(("messages", USER_ID, "c1"), [{"id": "m0", "content": "hola"}])
+    for idx in range(1, 4):
+        row = {"id": f"m{idx}", "content": "respuesta " * idx}
+        cache.update(("messages", USER_ID, "c1"), lambda rows: rows.append(row) or estimate_size(row))
+    def drop_first(rows):
+        return -estimate_size(rows.pop(0))
+    cache.update(("messages", USER_ID, "c1"), drop_first)
+
+    assert cache.stats()["bytes"] == entry_bytes(cache)
+
+def test_update_that_grows_an_entry_evicts_the_least_recently_used(clock):
+    row = {"content": "x" * 100}
+    size = estimate_size([row])
+    cache = ChatCache(max_bytes=3 * size, clock=clock)
+    for name in ("a", "b", "c"):
+        cache.set(("messages", USER_ID, name), [row])
+    cache.get(("messages", USER_ID, "a")) # "b" pasa a ser la menos usada
+
+    cache.update(("messages", USER_ID, "c"), lambda rows: rows.append(dict(row)) or estimate_size(row))
+
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.get(("messages", USER_ID, "b")) is None
+    assert cache.get(("messages", USER_ID, "a")) is not None
+    assert len(cache.get(("messages", USER_ID, "c"))) == 2
+    assert cache.stats()["evictions"] == 1
+
+def test_an_entry_that_outgrows_the_cache_is_dropped(clock):
+    cache = ChatCache(max_bytes=500, clock=clock)
+    cache.set(("messages", USER_ID, "c1"), [{"content": "hola"}])
+    big = {"content": "x" * 600}
+
+    cache.update(("messages", USER_ID, "c1"), lambda rows: rows.append(big) or estimate_size(big))
+
+    assert cache.get(("messages", USER_ID, "c1")) is None
+    assert cache.stats()["bytes"] == 0
+
+# --- Escrituras de chat_utils ---
+
+def test_save_turn_updates_the_cached_messages_and_conversation_list(cache):
+    older = chat_utils.create_conversation(USER_ID, "Arrendamiento")
+    newer = chat_utils.create_conversation(USER_ID, "Herencia")
+    assert [c["id"] for c in chat_utils.get_user_conversations(USER_ID)] == [newer["id"], older["id"]]
+    assert chat_utils.get_messages_page(older["id"], user_id=USER_ID)[0] == []
+    misses = cache.stats()["misses"]
+
+    assert chat_utils.save_turn(USER_ID, older["id"], "¿Fianza?", "Un mes de renta.", "Fianza") is None
+
+    cached = chat_utils.get_user_conversations(USER_ID)
+    assert [(c["id"], c["title"]) for c in cached] == [(older["id"], "Fianza"), (newer["id"], "Herencia")]
+    assert chat_utils.get_messages_page(older["id"], user_id=USER_ID)[0] == [
+        {"role": "user", "content": "¿Fianza?"}, {"role": "assistant", "content": "Un mes de renta."}
+    ]
+    assert cache.stats()["misses"] == misses # Servido desde la caché
+    assert cache.stats()["bytes"] == entry_bytes(cache)
+
+def test_writes_only_touch_the_owners_entries(cache):
+    conversation = chat_utils.create_conversation(USER_ID, "Despido")
+    chat_utils.get_user_conversations(USER_ID)
+    # Una lista de otro usuario con la misma conversación no debe tocarse (solo ve sus propias filas)
+    foreign = [dict(conversation)]
+    cache.set(chat_utils._conversations_key(OTHER_USER_ID), foreign)
+
+    chat_utils.save_turn(USER_ID, conversation["id"], "¿Indemnización?", "33 días por año.", "Indemnización")
+    chat_utils.rename_conversation(conversation["id"], "Despido improcedente", USER_ID)
+
+    assert cache.get(chat_utils._conversations_key(OTHER_USER_ID)) == foreign
+    assert chat_utils.get_user_conversations(USER_ID)[0]["title"] == "Despido improcedente"
+
+def test_delete_drops_the_conversation_and_its_messages(cache, fake_db):
+    kept = chat_utils.create_conversation(USER_ID, "Se queda")
+    deleted = chat_utils.create_conversation(USER_ID, "Se borra")
+    chat_utils.save_turn(USER_ID, deleted["id"], "P", "R")
+    chat_utils.get_user_conversations(USER_ID)
+    chat_utils.get_messages_page(deleted["id"], user_id=USER_ID)
+
+    assert chat_utils.delete_conversation_and_messages(deleted["id"], USER_ID) is None
+
+    assert [c["id"] for c in chat_utils.get_user_conversations(USER_ID)] == [kept["id"]]
+    assert cache.get(chat_utils._messages_key(USER_ID, deleted["id"])) is None
+    assert cache.stats()["bytes"] == entry_bytes(cache)
+    assert fake_db.tables["messages"] == []
+
+def test_a_remote_turn_invalidates_the_cached_messages(cache, fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    chat_utils.get_messages_page(conversation["id"], user_id=USER_ID)
+    # Otro proceso (la API) guarda un turno directamente en la base de datos
+    chat_utils._write_turn_rows(USER_ID, conversation["id"], [
+        {"id": chat_utils.new_message_id(), "role": "user", "content": "desde la API"}
+    ])
+
+    chat_utils.note_remote_turn(USER_ID, conversation["id"])
+
+    assert chat_utils.get_messages_page(conversation["id"], user_id=USER_ID)[0] == [
+        {"role": "user", "content": "desde la API"}
+    ]
+
+def test_expired_entries_are_read_again_from_the_database(cache, clock, fake_db):
+    conversation = chat_utils.create_conversation(USER_ID, "Antes")
+    chat_utils.get_user_conversations(USER_ID)
+    fake_db.tables["conversations"][0]["title"] = "Cambiado en otro proceso"
+
+    assert chat_utils.get_user_conversations(USER_ID)[0]["title"] == "Antes"
+    clock.advance(cache.ttl_seconds)
+    assert chat_utils.get_user_conversations(USER_ID)[0]["title"] == "Cambiado en otro proceso"
+    assert conversation["id"] == fake_db.tables["conversations"][0]["id"]
+
+def test_a_page_that_starts_with_pending_writes_still_has_a_cursor(cache, fake_db, monkeypatch):
+    queue = WriteBehindQueue(chat_utils._write_turn_rows) # Sin arrancar: los turnos se quedan pendientes
+    monkeypatch.setattr(chat_utils, "get_write_behind_queue", lambda writer: queue)
+    conversation = chat_utils.create_conversation(USER_ID)
+    chat_utils.save_turn(USER_ID, conversation["id"], "P0", "R0")
+    for idx in (1, 2):
+        chat_utils.queue_turn(USER_ID, conversation["id"], f"P{idx}", f"R{idx}")
+    cache.invalidate(chat_utils._messages_key(USER_ID, conversation["id"]))
+    # La lectura de la base de datos añade los pendientes (sin created_at de la BD) a la ventana cacheada
+    assert len(chat_utils.get_messages_page(conversation["id"], limit=2, user_id=USER_ID)[0]) == 6
+
+    pages, cursor = [], None
+    while True:
+        messages, cursor = chat_utils.get_messages_page(conversation["id"], limit=2, before=cursor, user_id=USER_ID)
+        pages.insert(0, [m["content"] for m in messages])
+        if cursor is None:
+            break
+
+    assert pages == [["P0", "R0"], ["P1", "R1"], ["P2", "R2"]]
@@ -0,0 +1,25 @@
+import context_builder
+from context_builder import TokenCounter, approximate_tokens
+
+
+class FailingTiktoken:
+    """tiktoken sin red: get_encoding no puede descargar el BPE."""
+
+    def __init__(self):
+        self.loads = 0
+
+    def get_encoding(self, name):
+        self.loads += 1
+        raise ConnectionError("No se pudo descargar o200k_base.tiktoken")
+
+def test_a_failed_tiktoken_load_is_not_retried(monkeypatch):
+    failing = FailingTiktoken()
+    monkeypatch.setattr(context_builder, "tiktoken", failing)
+    monkeypatch.setattr(context_builder, "_encoding", None)
+    monkeypatch.setattr(context_builder, "_encoding_failed", False)
+    counter = TokenCounter()
+
+    counts = [counter.count(f"Mensaje {idx} sobre el plazo de prescripción", "openai") for idx in range(5)]
+
+    assert failing.loads == 1
+    assert counts == [approximate_tokens(f"Mensaje {idx} sobre el plazo de prescripción") for idx in range(5)]
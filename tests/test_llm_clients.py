@@ -0,0 +1,27 @@
+import asyncio
+
+from llm_clients import LLMClientRegistry, import_provider_sdk
+
+
+def bound_keys(model):
+    """API Keys con las que saldrían las peticiones del modelo (cliente síncrono y asíncrono)."""
+    return (model._client._transport._credentials.token,
+            model._async_client._client._transport._credentials.token)
+
+def test_gemini_models_keep_their_own_key_when_sessions_interleave():
+    registry = LLMClientRegistry()
+
+    async def interleave():
+        first = registry.get_gemini_model("key-alice", "gemini-test", "sistema", None)
+        second = registry.get_gemini_model("key-bob", "gemini-test", "sistema", None)
+        # Una configuración global posterior (otra librería, otra sesión) no cambia la clave enlazada
+        import_provider_sdk("gemini").configure(api_key="key-global")
+        again = registry.get_gemini_model("key-alice", "gemini-test", "sistema", None)
+        return first, second, again
+
+    first, second, again = asyncio.run(interleave())
+
+    assert again is first
+    assert bound_keys(first) == ("key-alice", "key-alice")
+    assert bound_keys(second) == ("key-bob", "key-bob")
+    assert len(registry) == 2
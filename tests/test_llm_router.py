@@ -0,0 +1,159 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeClock
+from llm_router import LLMRouter
+
+
+API_KEY = "sk-test"
+
+def open_circuit(router, clock):
+    breaker = router.breaker_for("openai", API_KEY)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    clock.advance(breaker.reset_timeout)
+    assert breaker.state == "half_open"
+    return breaker
+
+def test_an_abandoned_half_open_trial_releases_the_breaker():
+    clock = FakeClock()
+    router = LLMRouter(clock=clock)
+    breaker = open_circuit(router, clock)
+    closed = []
+
+    async def provider_stream(provider, api_key):
+        try:
+            for idx in range(10):
+                yield f"tok{idx} "
+        finally:
+            closed.append(provider)
+
+    async def read_first_chunk_and_leave():
+        stream = router.astream([("openai", API_KEY)], provider_stream)
+        first = await stream.__anext__()
+        await stream.aclose() # Un rerun de Streamlit en mitad de la respuesta
+        return first
+
+    assert asyncio.run(read_first_chunk_and_leave()) == "tok0 "
+    assert closed == ["openai"]
+    assert breaker.state == "half_open" # Sin resultado: ni éxito ni fallo
+    assert breaker.allow_request() # Admite una nueva petición de prueba
+
+def test_a_completed_half_open_trial_closes_the_breaker():
+    clock = FakeClock()
+    router = LLMRouter(clock=clock)
+    breaker = open_circuit(router, clock)
+
+    async def provider_stream(provider, api_key):
+        yield "respuesta"
+
+    async def read_all():
+        return [chunk async for chunk in router.astream([("openai", API_KEY)], provider_stream)]
+
+    assert asyncio.run(read_all()) == ["respuesta"]
+    assert breaker.state == "closed"
+
+class Providers:
+    """open_stream falso para el router: cada proveedor con su time-to-first-token o su error.
+
+    Registra cuándo se abrió cada stream y cómo terminó ("ok", "error", "cancelled")."""
+
+    def __init__(self, **behaviour):
+        self.behaviour = behaviour # proveedor -> segundos hasta el primer token, o una excepción
+        self.started = {}
+        self.outcomes = {}
+        self._t0 = time.monotonic()
+
+    async def __call__(self, provider, api_key):
+        self.started[provider] = time.monotonic() - self._t0
+        behaviour = self.behaviour[provider]
+        try:
+            if isinstance(behaviour, Exception):
+                raise behaviour
+            await asyncio.sleep(behaviour)
+            for idx in range(3):
+                yield f"{provider}{idx} "
+        except asyncio.CancelledError:
+            self.outcomes[provider] = "cancelled"
+            raise
+        except Exception:
+            self.outcomes[provider] = "error"
+            raise
+        else:
+            self.outcomes[provider] = "ok"
+
+def read_all(router, providers, candidates, hedge=False):
+    async def consume():
+        return "".join([chunk async for chunk in router.astream(candidates, providers, hedge=hedge)])
+    return asyncio.run(consume())
+
+CANDIDATES = [("openai", API_KEY), ("gemini", "gm-test")]
+
+def test_the_hedge_fires_at_the_primary_p95_and_the_loser_is_cancelled():
+    router = LLMRouter()
+    for idx in range(20): # p95 de 0,4 s
+        router.latency.record("openai", 0.1 + 0.3 * idx / 19)
+    providers = Providers(openai=2.0, gemini=0.05)
+
+    started = time.monotonic()
+    text = read_all(router, providers, CANDIDATES, hedge=True)
+    elapsed = time.monotonic() - started
+
+    assert text == "gemini0 gemini1 gemini2 "
+    assert providers.started["gemini"] == pytest.approx(0.4, abs=0.1)
+    assert providers.outcomes["openai"] == "cancelled"
+    assert elapsed < 1.0 # No esperó al principal
+    assert (router.hedges_fired, router.hedges_won, router.failovers) == (1, 1, 0)
+    assert router.breaker_for("openai", API_KEY).consecutive_failures == 0 # Perder el hedge no es un fallo
+
+def test_no_hedge_when_the_primary_answers_within_its_p95():
+    router = LLMRouter()
+    for _ in range(20):
+        router.latency.record("openai", 0.5)
+    providers = Providers(openai=0.1, gemini=0.05)
+
+    assert read_all(router, providers, CANDIDATES, hedge=True) == "openai0 openai1 openai2 "
+    assert "gemini" not in providers.started
+    assert router.hedges_fired == 0
+
+def test_an_error_fails_over_to_the_next_provider():
+    router = LLMRouter(clock=FakeClock())
+    providers = Providers(openai=ConnectionError("Connection reset"), gemini=0.0)
+
+    assert read_all(router, providers, CANDIDATES) == "gemini0 gemini1 gemini2 "
+    assert providers.outcomes == {"openai": "error", "gemini": "ok"}
+    assert router.failovers == 1
+    assert router.breaker_for("openai", API_KEY).consecutive_failures == 1
+    assert router.breaker_for("gemini", "gm-test").state == "closed"
+
+def test_a_first_token_timeout_fails_over_and_cancels_the_slow_stream():
+    router = LLMRouter(clock=FakeClock(), first_token_timeout=0.1)
+    providers = Providers(openai=5.0, gemini=0.0)
+
+    started = time.monotonic()
+    assert read_all(router, providers, CANDIDATES) == "gemini0 gemini1 gemini2 "
+    assert time.monotonic() - started < 1.0
+    assert providers.outcomes["openai"] == "cancelled"
+    assert router.failovers == 1
+    assert router.breaker_for("openai", API_KEY).consecutive_failures == 1
+
+def test_the_breaker_opens_after_n_failures_and_half_opens_after_the_cooldown():
+    clock = FakeClock()
+    router = LLMRouter(clock=clock)
+    breaker = router.breaker_for("openai", API_KEY)
+    providers = Providers(openai=ConnectionError("Connection reset"), gemini=0.0)
+    for _ in range(breaker.failure_threshold):
+        read_all(router, providers, CANDIDATES)
+    assert breaker.state == "open"
+
+    providers.started.clear()
+    assert read_all(router, providers, CANDIDATES) == "gemini0 gemini1 gemini2 "
+    assert "openai" not in providers.started # Con el circuito abierto ni se intenta
+
+    clock.advance(breaker.reset_timeout)
+    assert breaker.state == "half_open"
+    providers.behaviour["openai"] = 0.0
+    assert read_all(router, providers, CANDIDATES) == "openai0 openai1 openai2 " # Petición de prueba
+    assert breaker.state == "closed"
@@ -0,0 +1,121 @@
+import asyncio
+import random
+
+import pytest
+
+import chat_utils
+from benchmarks.fakes import FakeClock, FakeProvider
+from rate_limits import (
+    RATE_LIMIT_MAX_BACKOFF, ProviderConcurrency, RateLimiter, astream_with_rate_limit_retry,
+    is_rate_limited_response
+)
+
+
+async def collect(stream):
+    return "".join([chunk async for chunk in stream])
+
+# --- Cubos de tokens ---
+
+def test_a_burst_is_admitted_up_to_the_limit_and_then_refills():
+    clock = FakeClock()
+    limiter = RateLimiter(user_rpm=6, user_tpm=0, key_rpm=0, key_tpm=0, clock=clock)
+
+    assert all(limiter.acquire("u1", "sk-1")[0] for _ in range(6))
+    ok, wait, scope = limiter.acquire("u1", "sk-1")
+    assert (ok, scope) == (False, "user")
+    assert wait == pytest.approx(10.0) # 6 por minuto: una cada 10 s
+    assert limiter.acquire("u2", "sk-2")[0] # Otro usuario tiene su propio cubo
+
+    clock.advance(wait)
+    assert limiter.acquire("u1", "sk-1")[0]
+    assert limiter.stats()["rejected"] == 1
+
+def test_no_user_exceeds_burst_plus_refill_over_simulated_minutes():
+    clock = FakeClock()
+    limiter = RateLimiter(user_rpm=20, user_tpm=100000, key_rpm=60, key_tpm=0, clock=clock)
+    rng = random.Random(0)
+    admitted = {idx: 0 for idx in range(30)}
+    minutes, attempts_per_minute = 5, 120
+    for _ in range(minutes * attempts_per_minute):
+        for idx in admitted:
+            ok, wait, _ = limiter.acquire(f"user-{idx}", f"sk-{idx}", tokens=rng.randint(200, 2000))
+            if ok:
+                admitted[idx] += 1
+                limiter.record_usage(f"user-{idx}", f"sk-{idx}", rng.randint(100, 800))
+            else:
+                assert wait > 0 # Una petición rechazada indica cuánto esperar
+        clock.advance(60.0 / attempts_per_minute)
+
+    assert max(admitted.values()) <= 20 * (minutes + 1) # Ráfaga inicial + relleno
+
+def test_a_shared_api_key_is_limited_across_users():
+    limiter = RateLimiter(user_rpm=0, user_tpm=0, key_rpm=3, key_tpm=0, clock=FakeClock())
+
+    results = [limiter.acquire(f"user-{idx}", "sk-compartida") for idx in range(4)]
+
+    assert [ok for ok, _, _ in results] == [True, True, True, False]
+    assert results[-1][2] == "api_key"
+
+# --- Cola por proveedor ---
+
+def test_provider_slots_are_granted_in_arrival_order():
+    concurrency = ProviderConcurrency(limit=3)
+    slots = [concurrency.reserve("openai") for _ in range(10)]
+
+    assert [slot.position() for slot in slots] == [0, 0, 0] + list(range(1, 8))
+
+    granted_order = [idx for idx, slot in enumerate(slots) if slot.granted]
+    for slot in slots: # Cada plaza liberada pasa al primero de la cola
+        if slot.granted:
+            slot.release()
+            granted_order.extend(idx for idx, other in enumerate(slots) if other.granted and idx not in granted_order)
+    assert granted_order == list(range(10))
+
+def test_a_slot_that_leaves_the_queue_moves_the_rest_forward():
+    concurrency = ProviderConcurrency(limit=1)
+    first, second, third = (concurrency.reserve("openai") for _ in range(3))
+    other = concurrency.reserve("gemini")
+
+    second.release()
+
+    assert third.position() == 1
+    assert other.granted # Otro proveedor no comparte semáforo
+    first.release()
+    assert third.granted
+
+# --- 429 del proveedor ---
+
+@pytest.mark.parametrize("failures, retry_after", [(2, None), (1, 7)])
+def test_429s_are_retried_with_jittered_backoff(failures, retry_after):
+    clock = FakeClock()
+    provider = FakeProvider(ttft=0, tokens_per_second=0, output_tokens=3, rate_limited_calls=failures, retry_after=retry_after)
+
+    text = asyncio.run(collect(astream_with_rate_limit_retry(
+        lambda: provider([], "sk-test"), retries=3, sleep=clock.asleep, rng=random.Random(1)
+    )))
+
+    assert text == "tok0 tok1 tok2 "
+    assert provider.calls == failures + 1
+    assert len(clock.sleeps) == failures
+    assert all(0 <= delay <= RATE_LIMIT_MAX_BACKOFF for delay in clock.sleeps)
+    assert all(delay >= (retry_after or 0) for delay in clock.sleeps) # Respeta Retry-After
+
+def test_the_error_propagates_once_the_retries_run_out():
+    clock = FakeClock()
+    provider = FakeProvider(ttft=0, rate_limited_calls=100)
+
+    with pytest.raises(Exception) as raised:
+        asyncio.run(collect(astream_with_rate_limit_retry(
+            lambda: provider([], "sk-test"), retries=2, sleep=clock.asleep, rng=random.Random(1)
+        )))
+
+    assert type(raised.value).__name__ == "FakeRateLimitError"
+    assert (provider.calls, len(clock.sleeps)) == (3, 2)
+
+def test_the_final_429_notice_is_not_persisted(monkeypatch):
+    monkeypatch.setitem(chat_utils.LLM_STREAM_PROVIDERS, "openai", FakeProvider(ttft=0, rate_limited_calls=100))
+
+    text = asyncio.run(collect(chat_utils.astream_llm_response([{"role": "user", "content": "hola"}], "sk-test", retries=0)))
+
+    assert is_rate_limited_response(text) # arun_turn no guarda el turno (ver test_arun_turn)
+    assert not is_rate_limited_response("Error con OpenAI: API Key inválida.")
@@ -0,0 +1,42 @@
+import chat_utils
+
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+
+def test_save_turn_is_a_single_round_trip(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID, "Nueva Conversación")
+    before = fake_db.round_trips
+
+    error = chat_utils.save_turn(USER_ID, conversation["id"], "¿Plazo de prescripción?", "Cinco años.", "Prescripción")
+
+    assert error is None
+    assert fake_db.round_trips - before == 1
+    messages = fake_db.tables["messages"]
+    assert [(m["role"], m["content"]) for m in messages] == [("user", "¿Plazo de prescripción?"), ("assistant", "Cinco años.")]
+    assert messages[0]["created_at"] < messages[1]["created_at"]
+    stored = fake_db.tables["conversations"][0]
+    assert stored["title"] == "Prescripción"
+    assert stored["updated_at"] > conversation["updated_at"]
+
+def test_each_turn_costs_one_round_trip(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    before = fake_db.round_trips
+
+    for turn in range(5):
+        assert chat_utils.save_turn(USER_ID, conversation["id"], f"Pregunta {turn}", f"Respuesta {turn}") is None
+
+    assert fake_db.round_trips - before == 5
+    assert len(fake_db.tables["messages"]) == 10
+    assert fake_db.tables["conversations"][0]["title"] == "Nueva Conversación" # Sin new_title no se toca
+
+def test_retrying_a_turn_with_the_same_ids_does_not_duplicate(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    rows = [
+        {"id": chat_utils.new_message_id(), "role": "user", "content": "hola"},
+        {"id": chat_utils.new_message_id(), "role": "assistant", "content": "buenas"}
+    ]
+
+    chat_utils._write_turn_rows(USER_ID, conversation["id"], rows)
+    chat_utils._write_turn_rows(USER_ID, conversation["id"], rows) # Reintento tras un fallo ambiguo
+
+    assert len(fake_db.tables["messages"]) == 2
@@ -0,0 +1,62 @@
+import chat_utils
+
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+OTHER_USER_ID = "00000000-0000-0000-0000-000000000002"
+
+def seed_turn(user_id, conversation_id, question, answer):
+    assert chat_utils.save_turn(user_id, conversation_id, question, answer) is None
+
+def test_results_are_ranked_by_relevance_and_scoped_to_the_user(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID, "Alquiler")
+    seed_turn(USER_ID, conversation["id"], "Fianza del arrendamiento",
+              "El arrendador debe devolver la fianza al terminar el arrendamiento, salvo daños en la vivienda y otros gastos pendientes.")
+    seed_turn(USER_ID, conversation["id"], "¿Y si no hay contrato escrito?", "Se aplica igualmente la Ley de Arrendamientos Urbanos.")
+    seed_turn(USER_ID, conversation["id"], "¿Qué es una fianza?", "Una garantía.")
+    foreign = chat_utils.create_conversation(OTHER_USER_ID, "Ajena")
+    seed_turn(OTHER_USER_ID, foreign["id"], "Fianza del arrendamiento", "Fianza y arrendamiento")
+
+    results, cursor = chat_utils.search_messages(USER_ID, "fianza arrendamiento")
+
+    assert cursor is None
+    assert [r["conversation_id"] for r in results] == [conversation["id"]] * 2 # Ambos términos (AND), solo del usuario
+    assert results[0]["snippet"] == "**Fianza** del **arrendamiento**" # El más denso en coincidencias va primero
+    assert results[0]["rank"] > results[1]["rank"]
+    assert "la **fianza** al terminar" in results[1]["snippet"]
+    assert results[0]["conversation_title"] == "Alquiler"
+
+def test_search_ignores_accents_and_case(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    seed_turn(USER_ID, conversation["id"], "Plazo de PRESCRIPCIÓN", "Cinco años.")
+
+    results, _ = chat_utils.search_messages(USER_ID, "prescripcion")
+
+    assert [r["role"] for r in results] == ["user"]
+
+def test_cursor_paging_returns_every_hit_once_in_rank_order(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    for idx in range(12): # Muchos empates de rank: el cursor desempata por id
+        seed_turn(USER_ID, conversation["id"], f"Consulta {idx} sobre la usucapión", f"La usucapión {'ordinaria ' * (idx % 3)}exige posesión.")
+    expected, _ = chat_utils.search_messages(USER_ID, "usucapión", limit=1000)
+    before = fake_db.round_trips
+
+    pages, cursor = [], None
+    while True:
+        results, cursor = chat_utils.search_messages(USER_ID, "usucapión", limit=5, cursor=cursor)
+        pages.append(results)
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 4]
+    assert fake_db.round_trips - before == len(pages)
+    flat = [r["message_id"] for page in pages for r in page]
+    assert flat == [r["message_id"] for r in expected]
+    assert len(set(flat)) == 24
+    ranks = [(r["rank"], r["message_id"]) for page in pages for r in page]
+    assert ranks == sorted(ranks, reverse=True)
+
+def test_an_empty_query_does_not_hit_the_database(fake_db):
+    before = fake_db.round_trips
+
+    assert chat_utils.search_messages(USER_ID, "   ") == ([], None)
+    assert fake_db.round_trips == before
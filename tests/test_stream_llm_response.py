@@ -0,0 +1,28 @@
+import time
+
+import chat_utils
+from benchmarks.fakes import FakeProvider
+
+
+TTFT = 0.05
+OUTPUT_TOKENS = 10
+TOKENS_PER_SECOND = 20 # 0,5 s de generación tras el primer token
+
+def test_the_first_chunk_reaches_the_consumer_before_the_response_is_finished(monkeypatch):
+    provider = FakeProvider(ttft=TTFT, tokens_per_second=TOKENS_PER_SECOND, output_tokens=OUTPUT_TOKENS)
+    monkeypatch.setitem(chat_utils.LLM_STREAM_PROVIDERS, "openai", provider)
+    history = [{"role": "user", "content": "¿Plazo de prescripción?"}]
+
+    started = time.perf_counter()
+    arrivals = [] # (segundos desde el inicio, fragmento)
+    for chunk in chat_utils.stream_llm_response(history, "sk-test"):
+        arrivals.append((time.perf_counter() - started, chunk))
+    total = time.perf_counter() - started
+
+    first_token_at, first_chunk = arrivals[0]
+    assert first_chunk == "tok0 "
+    assert "".join(chunk for _, chunk in arrivals) == "".join(f"tok{idx} " for idx in range(OUTPUT_TOKENS))
+    assert total >= TTFT + (OUTPUT_TOKENS - 1) / TOKENS_PER_SECOND
+    # El primer fragmento llega con el primer token, no cuando el proveedor ha terminado
+    assert first_token_at < TTFT + (total - TTFT) / 4
+    assert len(arrivals) == OUTPUT_TOKENS # Cada fragmento se entrega según llega, sin agrupar
@@ -0,0 +1,179 @@
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import chat_utils
+from benchmarks.fakes import FakeAPIError, FakeRateLimitError
+from write_queue import WriteBehindQueue, is_permanent_write_error
+
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+
+class RecordingWriter:
+    """_write_turn_rows sobre el Supabase falso; las primeras `fail_after_commit` llamadas
+    escriben y luego fallan con un timeout (el caso ambiguo: el commit llegó, la respuesta no)."""
+
+    def __init__(self, fail_after_commit=0):
+        self.fail_after_commit = fail_after_commit
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, user_id, conversation_id, rows, title):
+        try:
+            chat_utils._write_turn_rows(user_id, conversation_id, rows, title)
+        except Exception:
+            self._record(conversation_id, "error")
+            raise
+        with self._lock:
+            fail, self.fail_after_commit = self.fail_after_commit > 0, self.fail_after_commit - 1
+        if fail:
+            self._record(conversation_id, "timeout")
+            raise TimeoutError("The read operation timed out")
+        self._record(conversation_id, "ok")
+
+    def _record(self, conversation_id, outcome):
+        with self._lock:
+            self.calls.append((conversation_id, outcome))
+
+def make_queue(writer, **kwargs):
+    options = {"linger_seconds": 0.0, "base_backoff": 0.02, "max_backoff": 0.1}
+    options.update(kwargs)
+    return WriteBehindQueue(writer, **options).start()
+
+def turn(question, answer):
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+def contents(fake_db, conversation_id):
+    return [m["content"] for m in fake_db.tables["messages"] if m["conversation_id"] == conversation_id]
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condición no alcanzada"
+        time.sleep(0.005)
+
+def test_ambiguous_failures_are_retried_without_duplicating_rows(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    writer = RecordingWriter(fail_after_commit=2)
+    queue = make_queue(writer)
+    try:
+        queue.enqueue_turn(USER_ID, conversation["id"], turn("¿Plazo?", "Cinco años."))
+        assert queue.flush(timeout=5)
+    finally:
+        queue.close(timeout=1)
+
+    assert [outcome for _, outcome in writer.calls] == ["timeout", "timeout", "ok"]
+    assert contents(fake_db, conversation["id"]) == ["¿Plazo?", "Cinco años."]
+    stats = queue.stats()
+    assert (stats["written_turns"], stats["failed_attempts"], stats["dead_lettered_turns"]) == (1, 2, 0)
+
+def test_a_permanent_error_is_dead_lettered_without_blocking_other_conversations(fake_db):
+    deleted_conversation = str(uuid.uuid4()) # Borrada desde otro proceso: el insert viola la FK
+    conversation = chat_utils.create_conversation(USER_ID)
+    writer = RecordingWriter()
+    queue = make_queue(writer, base_backoff=0.05, permanent_attempts=3)
+    try:
+        queue.enqueue_turn(USER_ID, deleted_conversation, turn("perdida", "perdida"))
+        queue.enqueue_turn(USER_ID, conversation["id"], turn("¿Fianza?", "Un mes de renta."))
+        assert queue.flush(timeout=5)
+    finally:
+        queue.close(timeout=1)
+
+    assert contents(fake_db, conversation["id"]) == ["¿Fianza?", "Un mes de renta."]
+    failures = [idx for idx, (conv_id, _) in enumerate(writer.calls) if conv_id == deleted_conversation]
+    assert len(failures) == 3
+    assert writer.calls.index((conversation["id"], "ok")) < failures[1] # No esperó a los reintentos
+    dead = queue.dead_letters()
+    assert [(d["conversation_id"], d["attempts"]) for d in dead] == [(deleted_conversation, 3)]
+    assert [row["content"] for row in dead[0]["rows"]] == ["perdida", "perdida"]
+    assert queue.stats()["dead_lettered_turns"] == 1
+    assert queue.pending_messages(deleted_conversation) == []
+
+def test_later_turns_wait_for_an_earlier_turn_being_retried(fake_db):
+    conversation = chat_utils.create_conversation(USER_ID)
+    writer = RecordingWriter(fail_after_commit=1)
+    queue = make_queue(writer, base_backoff=0.1, max_backoff=0.1)
+    try:
+        queue.enqueue_turn(USER_ID, conversation["id"], turn("P1", "R1"))
+        wait_until(lambda: queue.stats()["failed_attempts"] == 1)
+        queue.enqueue_turn(USER_ID, conversation["id"], turn("P2", "R2"))
+        assert queue.flush(timeout=5)
+    finally:
+        queue.close(timeout=1)
+
+    assert contents(fake_db, conversation["id"]) == ["P1", "R1", "P2", "R2"]
+    assert queue.stats()["written_turns"] == 2
+
+def test_close_flushes_pending_turns(fake_db):
+    conversations = [chat_utils.create_conversation(USER_ID) for _ in range(2)]
+    queue = make_queue(RecordingWriter(), linger_seconds=0.2)
+    for idx in range(3):
+        for conversation in conversations:
+            queue.enqueue_turn(USER_ID, conversation["id"], turn(f"P{idx}", f"R{idx}"))
+    assert queue.depth() == 6
+
+    assert queue.close(timeout=5)
+
+    for conversation in conversations:
+        assert contents(fake_db, conversation["id"]) == ["P0", "R0", "P1", "R1", "P2", "R2"]
+    assert queue.stats()["depth"] == 0
+    with pytest.raises(RuntimeError):
+        queue.enqueue_turn(USER_ID, conversations[0]["id"], turn("tarde", "tarde"))
+
+def test_close_drops_what_it_cannot_write_in_time(fake_db):
+    def unreachable(user_id, conversation_id, rows, title):
+        raise ConnectionError("Connection refused")
+
+    queue = make_queue(unreachable)
+    queue.enqueue_turn(USER_ID, str(uuid.uuid4()), turn("P", "R"))
+
+    assert not queue.close(timeout=0.2)
+    assert queue.stats()["dropped_turns"] == 1
+
+def test_permanent_error_classification():
+    assert is_permanent_write_error(FakeAPIError("23503", "violates foreign key constraint"))
+    assert is_permanent_write_error(FakeAPIError("42501", "new row violates row-level security policy"))
+    assert is_permanent_write_error(FakeAPIError("PGRST301", "JWT expired"))
+    assert is_permanent_write_error(SimpleNamespace(code=None, status_code=401, __cause__=None))
+    assert not is_permanent_write_error(FakeAPIError("PGRST000", "Could not connect"))
+    assert not is_permanent_write_error(FakeAPIError("40001", "could not serialize access"))
+    assert not is_permanent_write_error(FakeRateLimitError())
+    assert not is_permanent_write_error(ConnectionError("Connection refused"))
+    try:
+        try:
+            raise FakeAPIError("23503", "violates foreign key constraint")
+        except FakeAPIError as cause:
+            raise RuntimeError("save_turn falló") from cause
+    except RuntimeError as wrapped:
+        assert is_permanent_write_error(wrapped)
+
+def test_discarded_conversations_are_forgotten_once_nothing_references_them(fake_db):
+    conversations = [chat_utils.create_conversation(USER_ID) for _ in range(2)]
+    writing, release = threading.Event(), threading.Event()
+    writer = RecordingWriter()
+
+    def blocking_writer(user_id, conversation_id, rows, title):
+        writing.set()
+        release.wait(5)
+        writer(user_id, conversation_id, rows, title)
+
+    queue = WriteBehindQueue(blocking_writer, linger_seconds=0.0)
+    try:
+        queue.enqueue_turn(USER_ID, conversations[0]["id"], turn("P1", "R1"))
+        queue.enqueue_turn(USER_ID, conversations[1]["id"], turn("P1", "R1"))
+        queue.start() # Los dos turnos van en el mismo lote
+        assert writing.wait(5)
+        queue.discard_conversation(conversations[1]["id"]) # Su grupo está en vuelo, aún sin escribir
+        queue.discard_conversation(str(uuid.uuid4())) # Nada la referencia: no hace falta recordarla
+        assert queue._discarded_conversations == {conversations[1]["id"]}
+        release.set()
+        assert queue.flush(timeout=5)
+    finally:
+        queue.close(timeout=1)
+
+    assert contents(fake_db, conversations[0]["id"]) == ["P1", "R1"]
+    assert contents(fake_db, conversations[1]["id"]) == []
+    assert queue._discarded_conversations == set()
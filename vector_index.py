@@ -0,0 +1,210 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+INDEX_VERSION = 1
+SEARCH_BLOCK_ROWS = 65536 # Filas por bloque en la búsqueda exacta (acota la memoria de las puntuaciones)
+KMEANS_SAMPLE_ROWS = 50000 # Filas usadas para entrenar los centroides IVF
+DEFAULT_NPROBE = 8 # Listas IVF exploradas por consulta
+
+def _top_k(scores, ids, k):
+    """Los k mejores (ids, scores) de una fila de puntuaciones, ordenados de mayor a menor."""
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[part], ids[part]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+def _merge_top_k(current, candidate, k):
+    if current is None:
+        return candidate
+    return _top_k(np.concatenate([current[1], candidate[1]]), np.concatenate([current[0], candidate[0]]), k)
+
+def _kmeans(sample, n_lists, iterations, seed):
+    """k-means esférico (coseno) sencillo sobre una muestra; suficiente para repartir listas IVF."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for list_id in range(n_lists):
+            members = sample[assignment == list_id]
+            if len(members): # Las listas vacías conservan su centroide anterior
+                centroid = members.sum(axis=0)
+                centroids[list_id] = centroid / (np.linalg.norm(centroid) or 1.0)
+    return centroids.astype(np.float32)
+
+class VectorIndexWriter:
+    """Construye un índice en disco por lotes, sin mantener todos los vectores en memoria.
+
+    Estructura del directorio:
+        manifest.json         dimensión, nº de vectores, embedder, cuantización, listas IVF
+        vectors.npy           float32 (n, dim), o int8 si quantize=True (más scales.npy)
+        ids.npy               posición en vectors.npy → id de fragmento (el orden IVF agrupa por lista)
+        chunks.jsonl          metadatos y texto de cada fragmento, en orden de id
+        chunk_offsets.npy     desplazamiento en bytes de cada línea de chunks.jsonl
+        centroids.npy, list_offsets.npy   solo en modo IVF
+    """
+
+    def __init__(self, path, dim, embedder_spec):
+        self.path = path
+        self.dim = dim
+        self.embedder_spec = embedder_spec
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+        self._raw_path = os.path.join(path, "vectors.f32.tmp")
+        self._raw = open(self._raw_path, "wb")
+        self._chunks = open(os.path.join(path, "chunks.jsonl"), "wb")
+        self._chunk_offsets = []
+
+    def add(self, vectors, chunks):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if vectors.shape != (len(chunks), self.dim):
+            raise ValueError(f"Se esperaban {len(chunks)} vectores de dimensión {self.dim}, llegaron {vectors.shape}")
+        vectors.tofile(self._raw)
+        for chunk in chunks:
+            self._chunk_offsets.append(self._chunks.tell())
+            self._chunks.write(json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.count += len(chunks)
+
+    def finalize(self, quantize=False, ivf_lists=0, kmeans_iterations=10, seed=0):
+        """Escribe los ficheros definitivos. Devuelve la ruta del índice."""
+        self._raw.close()
+        self._chunks.close()
+        np.save(os.path.join(self.path, "chunk_offsets.npy"), np.asarray(self._chunk_offsets, dtype=np.int64))
+        raw = np.memmap(self._raw_path, dtype=np.float32, mode="r", shape=(self.count, self.dim)) if self.count \
+            else np.zeros((0, self.dim), dtype=np.float32)
+
+        ids = np.arange(self.count, dtype=np.int64)
+        ivf_lists = min(ivf_lists, self.count)
+        if ivf_lists:
+            rng = np.random.default_rng(seed)
+            sample_ids = np.sort(rng.choice(self.count, size=min(self.count, KMEANS_SAMPLE_ROWS), replace=False))
+            centroids = _kmeans(np.asarray(raw[sample_ids]), ivf_lists, kmeans_iterations, seed)
+            assignment = np.empty(self.count, dtype=np.int32)
+            for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+                block = np.asarray(raw[start:start + SEARCH_BLOCK_ROWS])
+                assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            ids = np.argsort(assignment, kind="stable").astype(np.int64) # Cada lista queda contigua en disco
+            list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=ivf_lists))]).astype(np.int64)
+            np.save(os.path.join(self.path, "centroids.npy"), centroids)
+            np.save(os.path.join(self.path, "list_offsets.npy"), list_offsets)
+        np.save(os.path.join(self.path, "ids.npy"), ids)
+
+        dtype = np.int8 if quantize else np.float32
+        vectors = np.lib.format.open_memmap(os.path.join(self.path, "vectors.npy"), mode="w+", dtype=dtype, shape=(self.count, self.dim))
+        scales = np.empty(self.count, dtype=np.float32) if quantize else None
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            block = np.asarray(raw[ids[start:start + SEARCH_BLOCK_ROWS]])
+            if quantize: # int8 simétrico por fila: vector ≈ q * scale
+                block_scales = np.abs(block).max(axis=1) / 127.0
+                block_scales[block_scales == 0] = 1.0
+                vectors[start:start + len(block)] = np.round(block / block_scales[:, None]).astype(np.int8)
+                scales[start:start + len(block)] = block_scales
+            else:
+                vectors[start:start + len(block)] = block
+        vectors.flush()
+        del vectors, raw
+        if quantize:
+            np.save(os.path.join(self.path, "scales.npy"), scales)
+        os.remove(self._raw_path)
+
+        with open(os.path.join(self.path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "dim": self.dim,
+                "count": self.count,
+                "embedder": self.embedder_spec,
+                "quantized": bool(quantize),
+                "ivf_lists": int(ivf_lists),
+                "created_at": time.time()
+            }, f, indent=2)
+        return self.path
+
+class VectorIndex:
+    """Índice de similitud coseno sobre vectores normalizados, mapeado en memoria (np.load mmap_mode="r").
+
+    Solo se lee de disco lo que se toca: en modo exacto se recorre el índice por bloques con un
+    producto matricial por lote de consultas; en modo IVF solo las `nprobe` listas más cercanas.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.dim = self.manifest["dim"]
+        self.embedder_spec = self.manifest["embedder"]
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r") if self.manifest["quantized"] else None
+        self.chunk_offsets = np.load(os.path.join(path, "chunk_offsets.npy"), mmap_mode="r")
+        if self.manifest["ivf_lists"]:
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.list_offsets = np.load(os.path.join(path, "list_offsets.npy"))
+        else:
+            self.centroids = self.list_offsets = None
+        self._chunks_fd = os.open(os.path.join(path, "chunks.jsonl"), os.O_RDONLY)
+        self._chunks_size = os.fstat(self._chunks_fd).st_size
+
+    def __len__(self):
+        return self.manifest["count"]
+
+    def _score(self, start, stop, queries):
+        block = self.vectors[start:stop]
+        if self.scales is None:
+            return queries @ block.T
+        return (queries @ block.T.astype(np.float32)) * self.scales[start:stop]
+
+    def search(self, queries, k=4, nprobe=DEFAULT_NPROBE, exact=False):
+        """Devuelve, por cada consulta, una lista [(id_fragmento, puntuación)] de los k más similares.
+
+        `queries` es un array (n, dim) ya normalizado. En un índice IVF, exact=True fuerza la
+        búsqueda exhaustiva (útil para medir el recall del modo aproximado).
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if not len(self) or not len(queries):
+            return [[] for _ in queries]
+        if self.centroids is None or exact:
+            best = [None] * len(queries)
+            for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+                stop = min(start + SEARCH_BLOCK_ROWS, len(self))
+                scores = self._score(start, stop, queries)
+                positions = np.arange(start, stop)
+                for row in range(len(queries)):
+                    best[row] = _merge_top_k(best[row], _top_k(scores[row], positions, k), k)
+        else:
+            best = []
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+            for row, query in enumerate(queries):
+                current = None
+                for list_id in probes[row]:
+                    start, stop = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+                    if start == stop:
+                        continue
+                    scores = self._score(start, stop, query[None, :])[0]
+                    current = _merge_top_k(current, _top_k(scores, np.arange(start, stop), k), k)
+                best.append(current)
+        results = []
+        for found in best:
+            if found is None:
+                results.append([])
+                continue
+            positions, scores = found
+            results.append([(int(self.ids[pos]), float(score)) for pos, score in zip(positions, scores)])
+        return results
+
+    def chunk(self, chunk_id):
+        """Lee el fragmento `chunk_id` de chunks.jsonl sin cargar el fichero entero (pread: seguro entre hilos)."""
+        start = int(self.chunk_offsets[chunk_id])
+        stop = int(self.chunk_offsets[chunk_id + 1]) if chunk_id + 1 < len(self) else self._chunks_size
+        return json.loads(os.pread(self._chunks_fd, stop - start, start))
+
+    def close(self):
+        os.close(self._chunks_fd)
+
+def remove_index(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
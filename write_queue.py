@@ -0,0 +1,304 @@
+import atexit
+import contextvars
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+import streamlit as st
+
+
+DEFAULT_BATCH_SIZE = 50 # Turnos como máximo por vaciado del worker
+DEFAULT_LINGER_SECONDS = 0.05 # Espera breve para agrupar turnos que llegan juntos
+DEFAULT_BASE_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+DEFAULT_SHUTDOWN_TIMEOUT = 10.0
+DEFAULT_MAX_ATTEMPTS = 20 # Errores transitorios: ~8 min de reintentos con el backoff máximo
+DEFAULT_PERMANENT_ATTEMPTS = 3 # Errores permanentes: se reintentan poco, no se arreglan solos
+MAX_DEAD_LETTERS = 1000
+# SQLSTATE de clase 22 (datos), 23 (integridad: 23503 es la FK) y 42 (42501 es RLS/permisos) y los
+# errores de petición, esquema y JWT de PostgREST (PGRST1xx-3xx; los PGRST0xx son de conexión)
+PERMANENT_ERROR_CODES = ("22", "23", "42", "PGRST1", "PGRST2", "PGRST3")
+
+def new_message_id():
+    """Id generado en el cliente: permite reintentar inserts sin duplicar filas."""
+    return str(uuid.uuid4())
+
+def is_permanent_write_error(e):
+    """True si reintentar no va a arreglar el error: 4xx de PostgREST (salvo 408 y 429) o un código
+    de PERMANENT_ERROR_CODES. Revisa también las excepciones encadenadas (__cause__)."""
+    while e is not None:
+        code = getattr(e, "code", None)
+        if isinstance(code, str) and code.startswith(PERMANENT_ERROR_CODES):
+            return True
+        status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+        if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429):
+            return True
+        e = e.__cause__
+    return False
+
+class WriteBehindQueue:
+    """Cola de escritura diferida para los turnos de chat.
+
+    Semántica de durabilidad: at-least-once mientras el proceso siga vivo. Cada mensaje lleva un
+    id generado en el cliente y el writer debe insertar con ON CONFLICT (id) DO NOTHING, de modo
+    que un reintento tras un fallo ambiguo (timeout después del commit) no duplica filas.
+    Un grupo fallido no bloquea el worker: se reprograma con backoff exponencial con jitter
+    (`next_attempt_at`) y mientras tanto se escriben las demás conversaciones. Los turnos de una
+    misma conversación se escriben siempre en orden. Tras `max_attempts` fallos transitorios, o
+    `permanent_attempts` permanentes (ver is_permanent_write_error: FK de una conversación
+    borrada desde otro proceso, RLS o token caducado), el grupo se aparta a dead_letters() y se
+    registra en el log. Al cerrar el proceso (close) se intenta vaciar la cola durante `timeout`
+    segundos y lo que quede pendiente se descarta (y se registra en el log).
+
+    `writer(user_id, conversation_id, rows, title)` recibe todas las filas pendientes de una
+    misma conversación en orden de llegada y debe lanzar una excepción si la escritura falla.
+    Se ejecuta en el contexto (contextvars) capturado al encolar el último turno del grupo, así
+    que usa el cliente de Supabase con el token de ese usuario y no el global del proceso.
+    """
+
+    def __init__(self, writer, batch_size=DEFAULT_BATCH_SIZE, linger_seconds=DEFAULT_LINGER_SECONDS,
+                 base_backoff=DEFAULT_BASE_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, permanent_attempts=DEFAULT_PERMANENT_ATTEMPTS,
+                 sleep=time.sleep, clock=time.monotonic):
+        self._writer = writer
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.permanent_attempts = permanent_attempts
+        self._sleep = sleep
+        self._clock = clock
+        self._pending = deque()
+        self._in_flight = []
+        self._cond = threading.Condition()
+        self._closing = False
+        self._abandon = False
+        self._thread = None
+        self._discarded_conversations = set() # Borradas con un grupo en vuelo; se olvidan al terminar el lote
+        self._dead_letters = deque(maxlen=MAX_DEAD_LETTERS)
+        self.written_turns = 0
+        self.failed_attempts = 0
+        self.dropped_turns = 0
+        self.dead_lettered_turns = 0
+
+    # --- Productor ---
+
+    def enqueue_turn(self, user_id, conversation_id, messages, title=None):
+        """Encola los mensajes de un turno. Devuelve las filas encoladas (con su id)."""
+        rows = [{
+            "id": msg.get("id") or new_message_id(),
+            "role": msg["role"],
+            "content": msg["content"]
+        } for msg in messages]
+        item = {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "rows": rows,
+            "title": title,
+            "context": contextvars.copy_context(),
+            "created_at": datetime.now(timezone.utc).isoformat(), # Provisional, hasta que la BD ponga el suyo
+            "enqueued_at": self._clock(),
+            "attempts": 0
+        }
+        item["next_attempt_at"] = item["enqueued_at"]
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("La cola de escritura está cerrada.")
+            self._pending.append(item)
+            self._cond.notify_all()
+        return rows
+
+    def discard_conversation(self, conversation_id):
+        """Descarta lo pendiente de una conversación borrada (su insert fallaría por la FK)."""
+        with self._cond:
+            self._pending = deque(item for item in self._pending if item["conversation_id"] != conversation_id)
+            if any(item["conversation_id"] == conversation_id for item in self._in_flight):
+                self._discarded_conversations.add(conversation_id) # El worker lo salta si aún no lo ha escrito
+            self._cond.notify_all()
+
+    def pending_messages(self, conversation_id):
+        """Mensajes aún no confirmados por la base de datos para una conversación.
+
+        Llevan como created_at la hora de encolado (la del cliente), para que puedan servir de
+        cursor de paginación; al escribirse, la base de datos les asigna la suya.
+        """
+        with self._cond:
+            items = list(self._in_flight) + list(self._pending)
+        return [dict(row, created_at=item["created_at"])
+                for item in items if item["conversation_id"] == conversation_id for row in item["rows"]]
+
+    # --- Métricas ---
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending) + len(self._in_flight)
+
+    def lag_seconds(self):
+        """Antigüedad del turno pendiente más antiguo (0 si la cola está vacía)."""
+        with self._cond:
+            items = list(self._in_flight) + list(self._pending)
+        if not items:
+            return 0.0
+        return max(0.0, self._clock() - min(item["enqueued_at"] for item in items))
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "lag_seconds": self.lag_seconds(),
+            "written_turns": self.written_turns,
+            "failed_attempts": self.failed_attempts,
+            "dropped_turns": self.dropped_turns,
+            "dead_lettered_turns": self.dead_lettered_turns
+        }
+
+    def dead_letters(self):
+        """Grupos apartados tras agotar sus intentos (los MAX_DEAD_LETTERS más recientes)."""
+        with self._cond:
+            return list(self._dead_letters)
+
+    # --- Worker ---
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lexia-write-behind", daemon=True)
+                self._thread.start()
+        return self
+
+    def _split_ready(self, now):
+        """Reparte lo pendiente en (listos, resto, próximo next_attempt_at del resto).
+
+        Un turno no adelanta a uno anterior de su conversación que espera reintento."""
+        ready, rest, waiting, next_at = [], deque(), set(), None
+        for item in self._pending:
+            key = (item["user_id"], item["conversation_id"])
+            if key not in waiting and len(ready) < self.batch_size and item["next_attempt_at"] <= now:
+                ready.append(item)
+                continue
+            if key not in waiting and item["next_attempt_at"] > now:
+                waiting.add(key)
+                next_at = item["next_attempt_at"] if next_at is None else min(next_at, item["next_attempt_at"])
+            rest.append(item)
+        return ready, rest, next_at
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                if not self._pending and self._closing:
+                    return None
+                ready, _, next_at = self._split_ready(self._clock())
+                if ready:
+                    break
+                self._cond.wait(None if next_at is None else max(0.0, next_at - self._clock()))
+        if self.linger_seconds and not self._closing:
+            self._sleep(self.linger_seconds)
+        with self._cond:
+            self._in_flight, self._pending, _ = self._split_ready(self._clock())
+            return list(self._in_flight)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            retry = []
+            for group in self._group_by_conversation(batch):
+                retry.extend(self._write_group(group))
+            with self._cond:
+                self._in_flight = []
+                # Un id descartado solo hace falta mientras algo lo referencie: el conjunto no crece sin límite
+                self._discarded_conversations.intersection_update(item["conversation_id"] for item in self._pending)
+                if self._abandon:
+                    self.dropped_turns += len(retry)
+                else:
+                    # Lo reprogramado es anterior a todo lo que sigue en la cola: vuelve al principio
+                    self._pending.extendleft(reversed(retry))
+                self._cond.notify_all()
+
+    @staticmethod
+    def _group_by_conversation(batch):
+        groups = {}
+        for item in batch:
+            key = (item["user_id"], item["conversation_id"])
+            group = groups.setdefault(key, {"items": [], "rows": [], "title": None})
+            group["items"].append(item)
+            group["context"] = item["context"]
+            group["rows"].extend(item["rows"])
+            if item["title"] is not None:
+                group["title"] = item["title"]
+        return [(key, group) for key, group in groups.items()]
+
+    def _write_group(self, keyed_group):
+        """Escribe un grupo. Devuelve sus turnos si hay que reintentarlo, ya reprogramados."""
+        (user_id, conversation_id), group = keyed_group
+        if conversation_id in self._discarded_conversations:
+            return []
+        try:
+            group["context"].run(self._writer, user_id, conversation_id, group["rows"], group["title"])
+            self.written_turns += len(group["items"])
+            return []
+        except Exception as e:
+            attempt = max(item["attempts"] for item in group["items"]) + 1
+            permanent = is_permanent_write_error(e)
+            self.failed_attempts += 1
+            print(f"Error {'permanente' if permanent else 'transitorio'} en escritura diferida para "
+                  f"conv {conversation_id} (intento {attempt}): {str(e)}")
+            if attempt >= (self.permanent_attempts if permanent else self.max_attempts):
+                self._dead_letter(user_id, conversation_id, group, attempt, e)
+                return []
+            delay = min(self.max_backoff, self.base_backoff * (2 ** (attempt - 1)))
+            next_attempt_at = self._clock() + delay * random.uniform(0.5, 1.0)
+            for item in group["items"]:
+                item["attempts"] = attempt
+                item["next_attempt_at"] = next_attempt_at
+            return group["items"]
+
+    def _dead_letter(self, user_id, conversation_id, group, attempts, error):
+        with self._cond:
+            self._dead_letters.append({
+                "user_id": user_id,
+                "conversation_id": conversation_id,
+                "rows": group["rows"],
+                "title": group["title"],
+                "attempts": attempts,
+                "error": str(error)
+            })
+            self.dead_lettered_turns += len(group["items"])
+        print(f"Apartados {len(group['items'])} turnos de conv {conversation_id} tras {attempts} intentos: {str(error)}")
+
+    # --- Cierre ---
+
+    def flush(self, timeout=None):
+        """Espera a que la cola se vacíe. Devuelve False si vence el timeout."""
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - self._clock()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        flushed = self.flush(timeout)
+        if not flushed:
+            self._abandon = True
+            with self._cond:
+                self.dropped_turns += len(self._pending)
+                self._pending.clear()
+            print(f"Cola de escritura cerrada con datos pendientes: {self.stats()}")
+        return flushed
+
+@st.cache_resource
+def get_write_behind_queue(_writer):
+    """Cola compartida por todas las sesiones del proceso; se vacía al terminar el proceso."""
+    queue = WriteBehindQueue(_writer).start()
+    atexit.register(queue.close)
+    return queue